@@ -0,0 +1,56 @@
+"""
+Import synthetic posts into a fresh database and report posts per second
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/import_posts.py [--posts N] [--tags N] [--batch-size N]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from flaskr import create_app
+from flaskr.blog.importer import import_posts
+from flaskr.db import close_database, get_db, init_db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "posts.jsonl")
+        random.seed(0)
+        with open(source, "w") as fd:
+            for ii in range(args.posts):
+                record = {
+                    "author": f"user{ii % 10}",
+                    "title": f"Post {ii}",
+                    "body": "Lorem ipsum dolor sit amet. " * 20,
+                    "tags": [f"tag{random.randrange(args.tags)}" for _ in range(3)],
+                    "created": f"2020-01-01T00:00:{ii % 60:02}",
+                }
+                fd.write(json.dumps(record) + "\n")
+        database = os.path.join(directory, "flaskr.sqlite")
+        app = create_app({"SECRET_KEY": "benchmark", "DATABASE": database})
+        with app.app_context():
+            init_db()
+            get_db().executemany(
+                "INSERT INTO user (username, password, registration_ip)"
+                " VALUES (?, '', '')",
+                ((f"user{ii}",) for ii in range(10)),
+            )
+            get_db().commit()
+            start = time.monotonic()
+            import_posts(source, batch_size=args.batch_size, echo=lambda message: None)
+            elapsed = time.monotonic() - start
+        close_database(database)
+    print(f"{args.posts} posts in {elapsed:.2f} s: {args.posts / elapsed:.0f} posts/s")
+
+
+if __name__ == "__main__":
+    main()
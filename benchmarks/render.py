@@ -0,0 +1,73 @@
+"""
+Compare rendering the post summaries of index pages with and without Renderer
+
+"per call" is what the render_sanitize_markdown filter did before: build a
+Cleaner and run markdown() for every fragment. The Renderer reuses its
+parser and cleaner, and with a warm cache skips rendering altogether.
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/render.py [--posts N] [--pages N]
+"""
+import argparse
+import random
+import time
+
+from bleach import Cleaner
+from bleach.linkifier import LinkifyFilter
+from bleach.sanitizer import ALLOWED_TAGS
+from markdown import markdown
+
+from flaskr.blog.render import Renderer
+
+SUMMARY_LENGTH = 300
+PAGE_SIZE = 5
+
+
+def per_call(markdown_markup):
+    cleaner = Cleaner(tags=ALLOWED_TAGS + ["p"], filters=[LinkifyFilter])
+    return cleaner.clean(markdown(markdown_markup))
+
+
+def make_body(rng, index):
+    words = [f"word{rng.randrange(5000)}" for _ in range(rng.randrange(50, 400))]
+    paragraphs = [" ".join(words[start : start + 60]) for start in range(0, 400, 60)]
+    return (
+        f"# Post {index}\n\nSome *emphasis*, a **bold** word and a link to"
+        f" http://example.com/{index}.\n\n- item one\n- item two\n\n"
+        + "\n\n".join(paragraph for paragraph in paragraphs if paragraph)
+    )
+
+
+def measure(render, summaries, pages):
+    start = time.perf_counter()
+    for page in range(pages):
+        first = page * PAGE_SIZE % len(summaries)
+        for summary in summaries[first : first + PAGE_SIZE]:
+            render(summary)
+    return pages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--pages", type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    bodies = [make_body(rng, ii) for ii in range(args.posts)]
+    summaries = [body[:SUMMARY_LENGTH] + "[...]" for body in bodies]
+    cold = Renderer(cache_size=0)
+    warm = Renderer(cache_size=len(summaries))
+    for summary in summaries:
+        assert per_call(summary) == cold.render(summary) == warm.render(summary)
+    for name, render in [
+        ("per call", per_call),
+        ("Renderer, no cache", cold.render),
+        ("Renderer, warm cache", warm.render),
+    ]:
+        pages_per_second = measure(render, summaries, args.pages)
+        print(f"{name:22} {pages_per_second:8.0f} index pages/s")
+    print(f"Warm cache: {warm.stats()}")
+
+
+if __name__ == "__main__":
+    main()
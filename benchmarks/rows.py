@@ -0,0 +1,90 @@
+"""
+Compare listing rows as sqlite3.Row copied into dicts against Records
+
+The dict path is what the post listings did before: copy each row into a
+dict, delete the window count column and coerce has_image.
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/rows.py [--rows N] [--repeat N]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import timeit
+import tracemalloc
+
+from flaskr.db import connect
+
+QUERY = (
+    "SELECT id, title, body, created, author_id, username, has_image,"
+    " COUNT(*) OVER () AS resultcount FROM post LIMIT ?"
+)
+
+
+def build(path, rows):
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE post (id INTEGER PRIMARY KEY, title TEXT, body TEXT,"
+        " created INTEGER, author_id INTEGER, username TEXT, has_image INTEGER)"
+    )
+    db.executemany(
+        "INSERT INTO post VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            (ii, f"title {ii}", "body " * 50, ii * 10**6, ii % 10, "user", ii % 2)
+            for ii in range(rows)
+        ),
+    )
+    db.commit()
+    db.close()
+
+
+def dict_rows(db, rows):
+    posts = [dict(row) for row in db.execute(QUERY, (rows,)).fetchall()]
+    for post in posts:
+        del post["resultcount"]
+        post["has_image"] = bool(post["has_image"])
+    return posts
+
+
+def record_rows(db, rows):
+    return db.execute(QUERY, (rows,)).fetchall()
+
+
+def measure(function, db, rows, repeat):
+    seconds = min(timeit.repeat(lambda: function(db, rows), number=1, repeat=repeat))
+    tracemalloc.start()
+    result = function(db, rows)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rows.sqlite")
+        build(path, args.rows)
+        plain = sqlite3.connect(path)
+        plain.row_factory = sqlite3.Row
+        records = connect(path, {})
+        for name, function, db in [
+            ("sqlite3.Row + dict", dict_rows, plain),
+            ("Record", record_rows, records),
+        ]:
+            seconds, retained, peak = measure(function, db, args.rows, args.repeat)
+            print(
+                f"{name:20} {seconds / args.rows * 1e9:6.0f} ns/row,"
+                f" {retained / args.rows:5.0f} B/row retained,"
+                f" {peak / args.rows:5.0f} B/row peak"
+            )
+        plain.close()
+        records.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compare searching posts with LIKE against the FTS5 index
+
+Builds a corpus of random posts with the application schema, then times
+the first page of results of a few searches both ways, plus counting the
+results as the listing does.
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/search.py [--posts N] [--repeat N]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import timeit
+
+from flaskr.blog.search import build_match_query
+
+VOCABULARY = [f"w{ii}" for ii in range(20000)]
+SEARCHES = ["w17", "w123 w456", '"w1 w2"', "w1999*"]
+
+LIKE = (
+    "SELECT post.id FROM posts_view post"
+    " WHERE post.title LIKE :like OR post.body LIKE :like"
+    " ORDER BY created DESC LIMIT 5"
+)
+LIKE_COUNT = "SELECT COUNT(*) FROM post WHERE title LIKE :like OR body LIKE :like"
+FTS = (
+    "SELECT post.id FROM post_fts JOIN posts_view post ON post.id == post_fts.rowid"
+    " WHERE post_fts MATCH :query ORDER BY bm25(post_fts, 10.0, 1.0) LIMIT 5"
+)
+FTS_COUNT = "SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH :query"
+
+
+def build(path, posts):
+    db = sqlite3.connect(path)
+    with open(os.path.join("flaskr", "schema.sql")) as fd:
+        db.executescript(fd.read())
+    db.execute(
+        "INSERT INTO user (username, password, registration_ip) VALUES ('a', '', '')"
+    )
+    random.seed(0)
+    start = time.monotonic()
+    db.executemany(
+        "INSERT INTO post (author_id, title, body, created) VALUES (1, ?, ?, ?)",
+        (
+            (
+                " ".join(random.choices(VOCABULARY, k=5)),
+                " ".join(random.choices(VOCABULARY, k=60)),
+                ii,
+            )
+            for ii in range(posts)
+        ),
+    )
+    db.commit()
+    print(f"Inserted and indexed {posts} posts in {time.monotonic() - start:.0f} s")
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        db = build(os.path.join(directory, "search.sqlite"), args.posts)
+        for search in SEARCHES:
+            # LIKE can only look for the text as typed
+            like = "%" + search.strip('"*') + "%"
+            query = build_match_query(search)
+            for name, sql, count_sql, parameters in [
+                ("LIKE", LIKE, LIKE_COUNT, {"like": like}),
+                ("FTS5", FTS, FTS_COUNT, {"query": query}),
+            ]:
+                times = []
+                for statement in (sql, count_sql):
+                    times.append(
+                        min(
+                            timeit.repeat(
+                                lambda: db.execute(statement, parameters).fetchall(),
+                                number=1,
+                                repeat=args.repeat,
+                            )
+                        )
+                    )
+                print(
+                    f"{search:12} {name} page {times[0] * 1e3:8.1f} ms,"
+                    f" count {times[1] * 1e3:8.1f} ms"
+                )
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
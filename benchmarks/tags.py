@@ -0,0 +1,115 @@
+"""
+Compare writing the tags of posts one at a time against set-based writes
+
+"per tag" is what create_post and update_post did before: look up or insert
+each tag, then insert or delete its post_tag row, one statement at a time.
+Each post gets --tags tags, then is edited --edits times, replacing half of
+its tags each time.
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/tags.py [--posts N] [--tags N] [--edits N]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from importlib.resources import files
+
+from flaskr.blog.blogdb import _set_post_tags
+from flaskr.db import connect
+
+
+def per_tag(db, post_id, tags):
+    current = {
+        row[0]
+        for row in db.execute(
+            "SELECT tag.name FROM tag JOIN post_tag ON tag.id == post_tag.tag_id"
+            " WHERE post_tag.post_id == ?",
+            (post_id,),
+        )
+    }
+    for tag in current - tags:
+        tag_id = db.execute("SELECT id FROM tag WHERE name == ?", (tag,)).fetchone()[0]
+        db.execute(
+            "DELETE FROM post_tag WHERE post_id == ? AND tag_id == ?",
+            (post_id, tag_id),
+        )
+    for tag in tags - current:
+        try:
+            tag_id = db.execute("INSERT INTO tag (name) VALUES (?)", (tag,)).lastrowid
+        except sqlite3.IntegrityError:
+            tag_id = db.execute(
+                "SELECT id FROM tag WHERE name == ?", (tag,)
+            ).fetchone()[0]
+        db.execute(
+            "INSERT INTO post_tag (post_id, tag_id) VALUES (?, ?)", (post_id, tag_id)
+        )
+
+
+def tag_sets(post_id, tags, edits):
+    """Tags of the post after creation and after each edit"""
+    for edit in range(edits + 1):
+        # Half of the tags are shared with the previous version
+        yield {
+            f"tag{(post_id * 7 + edit * tags // 2 + ii) % 5000}" for ii in range(tags)
+        }
+
+
+class CountingConnection:
+    """Count the calls to execute and executemany, i.e. statements prepared"""
+
+    def __init__(self, db):
+        self.db = db
+        self.calls = 0
+
+    def execute(self, *args):
+        self.calls += 1
+        return self.db.execute(*args)
+
+    def executemany(self, *args):
+        self.calls += 1
+        return self.db.executemany(*args)
+
+
+def run(path, function, args):
+    db = connect(path, {"journal_mode": "WAL"}, isolation_level=None)
+    counting = CountingConnection(db)
+    start = time.perf_counter()
+    for post_id in range(1, args.posts + 1):
+        for tags in tag_sets(post_id, args.tags, args.edits):
+            db.execute("BEGIN IMMEDIATE")
+            function(counting, post_id, tags)
+            db.execute("COMMIT")
+    seconds = time.perf_counter() - start
+    rows = db.execute("SELECT COUNT(*) FROM post_tag").fetchone()[0]
+    db.close()
+    writes = args.posts * (args.edits + 1)
+    return writes / seconds, counting.calls / writes, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--edits", type=int, default=4)
+    args = parser.parse_args()
+    schema = files("flaskr").joinpath("schema.sql").read_text()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, function in [("per tag", per_tag), ("set-based", _set_post_tags)]:
+            path = os.path.join(directory, f"{name}.sqlite")
+            db = sqlite3.connect(path)
+            db.executescript(schema)
+            db.close()
+            per_second, statements, rows = run(path, function, args)
+            results[name] = rows
+            print(
+                f"{name:10} {per_second:8.0f} writes/s"
+                f" {statements:6.1f} statements per write"
+            )
+    assert len(set(results.values())) == 1, results
+
+
+if __name__ == "__main__":
+    main()
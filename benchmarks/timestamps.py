@@ -0,0 +1,74 @@
+"""
+Compare text and integer timestamps: decoding a listing, and range counts
+
+Decoding runs in Python for both formats. Range counts compare the stored
+values inside SQLite, as the rate limit and listing queries do.
+
+Usage (with flaskr installed, e.g. pip install -e .):
+    python benchmarks/timestamps.py [--rows N] [--repeat N]
+"""
+import argparse
+import sqlite3
+import timeit
+from datetime import datetime, timedelta, timezone
+
+# Registers the converters and the datetime adapter
+import flaskr.db  # noqa: F401
+
+
+def build(rows):
+    db = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    db.execute("CREATE TABLE text_post (id INTEGER PRIMARY KEY, created TIMESTAMP)")
+    db.execute(
+        "CREATE TABLE micros_post (id INTEGER PRIMARY KEY, created UTCMICROS INTEGER)"
+    )
+    start = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    created = [start + timedelta(seconds=ii * 1234.5) for ii in range(rows)]
+    db.executemany(
+        "INSERT INTO text_post (created) VALUES (?)",
+        # As stored by CURRENT_TIMESTAMP
+        ((timestamp.strftime("%Y-%m-%d %H:%M:%S"),) for timestamp in created),
+    )
+    db.executemany("INSERT INTO micros_post (created) VALUES (?)", zip(created))
+    db.execute("CREATE INDEX text_post__created ON text_post (created)")
+    db.execute("CREATE INDEX micros_post__created ON micros_post (created)")
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    db = build(args.rows)
+    low, high = datetime(2001, 1, 1), datetime(2002, 1, 1)
+    bounds = {
+        "text_post": [str(bound) for bound in (low, high)],
+        "micros_post": [low, high],
+    }
+    for table in ("text_post", "micros_post"):
+        query = f"SELECT id, created FROM {table} ORDER BY created DESC"
+        assert isinstance(db.execute(query).fetchone()[1], datetime)
+        seconds = min(
+            timeit.repeat(
+                lambda: db.execute(query).fetchall(), number=1, repeat=args.repeat
+            )
+        )
+        print(
+            f"{table:12} decode {seconds * 1e3:8.1f} ms for {args.rows} rows,"
+            f" {seconds / args.rows * 1e9:6.0f} ns/row"
+        )
+        query = f"SELECT COUNT(*) FROM {table} WHERE created BETWEEN ? AND ?"
+        count = db.execute(query, bounds[table]).fetchone()[0]
+        seconds = min(
+            timeit.repeat(
+                lambda: db.execute(query, bounds[table]).fetchone(),
+                number=100,
+                repeat=args.repeat,
+            )
+        )
+        print(f"{table:12} range  {seconds * 10:8.3f} ms per count of {count} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,6 @@
 import os
 
-from flask import Flask, current_app
-from markupsafe import Markup
-from bleach import Cleaner
-from bleach.linkifier import LinkifyFilter
-from bleach.sanitizer import ALLOWED_TAGS
-from markdown import markdown
-
-
-def render_sanitize_markdown(markdown_markup):
-    cleaner = Cleaner(tags=ALLOWED_TAGS + ["p"], filters=[LinkifyFilter])
-    html = cleaner.clean(markdown(markdown_markup))
-    return Markup(html)
-
-
-def summarize(markdown, single_post):
-    max_length = current_app.config["SUMMARY_LENGTH"]
-    if len(markdown) > max_length and not single_post:
-        return markdown[:max_length] + "[...]"
-    return markdown
+from flask import Flask
 
 
 def create_app(test_config=None):
@@ -30,11 +12,48 @@ def create_app(test_config=None):
     )
     app.config.from_mapping(
         DATABASE=os.path.join(app.instance_path, "flaskr.sqlite"),
+        # Post images, see flaskr.blog.images
+        IMAGE_DIRECTORY=os.path.join(app.instance_path, "images"),
+        # Downscaled copies for srcset, if Pillow is installed, see
+        # flaskr.blog.variants
+        IMAGE_VARIANT_WIDTHS=[320, 640, 1280],
+        IMAGE_VARIANT_QUALITY=80,
+        IMAGE_VARIANT_WORKERS=2,
+        # Larger uploads are rejected, Pillow refuses to decode them anyway
+        IMAGE_MAX_PIXELS=80_000_000,
         MAX_CONTENT_LENGTH=2 * 1024 * 1024,
         REGISTRATION_RATE_LIMIT_SECONDS=1800,
         POSTING_RATE_LIMIT_SECONDS=300,
         COMMENTING_RATE_LIMIT_SECONDS=120,
         SUMMARY_LENGTH=300,
+        # Rendering of posts, see flaskr.blog.render. None allows bleach's
+        # default tags and <p>
+        MARKDOWN_EXTENSIONS=[],
+        ALLOWED_HTML_TAGS=None,
+        RENDER_CACHE_SIZE=1024,
+        # Connections are pooled per process, see flaskr.db.ConnectionPool
+        DATABASE_POOL_SIZE=8,
+        DATABASE_POOL_TIMEOUT=10,
+        # Connections streaming images still in the database, see
+        # flaskr.db.get_blob_pool
+        DATABASE_BLOB_POOL_SIZE=2,
+        # Negative cache size is in KiB
+        DATABASE_CACHE_SIZE=-16 * 1024,
+        DATABASE_MMAP_SIZE=64 * 1024 * 1024,
+        DATABASE_BUSY_TIMEOUT=5000,
+        # All modifications are serialized through one writer per process
+        WRITE_QUEUE_SIZE=64,
+        WRITE_QUEUE_TIMEOUT=10,
+        WRITE_TIMEOUT=30,
+        # Writes arriving within WRITE_BATCH_DELAY seconds are committed together
+        WRITE_BATCH_SIZE=100,
+        WRITE_BATCH_DELAY=0.002,
+        # Record the SQL statements of each request, see flaskr.tracing. Costs
+        # a little on every statement
+        SQL_TRACE=False,
+        SLOW_QUERY_SECONDS=0.1,
+        # Addresses allowed to scrape /metrics, e.g. "10.0.0.5,10.0.0.6"
+        METRICS_ALLOWED_IPS="",
     )
 
     if test_config is not None:
@@ -49,8 +68,6 @@ def create_app(test_config=None):
     )
 
     app.jinja_env.globals["debug"] = app.debug
-    app.jinja_env.filters["render_sanitize_markdown"] = render_sanitize_markdown
-    app.jinja_env.filters["summarize"] = summarize
     if not app.testing and not app.config["SECRET_KEY"]:
         raise KeyError("SECRET_KEY")
 
@@ -64,15 +81,58 @@ def create_app(test_config=None):
     from .db import init_app
 
     init_app(app)
+    from .backup import backup_command, restore_command
+
+    app.cli.add_command(backup_command)
+    app.cli.add_command(restore_command)
     from .auth import bp as auth_bp
 
     app.register_blueprint(auth_bp)
     from .blog import bp as blog_bp
 
     app.register_blueprint(blog_bp)
+    from .blog.counters import check_counters_command
+    from .blog.images import (
+        create_image_store,
+        gc_images_command,
+        measure_images_command,
+        move_images_command,
+        post_image_srcset,
+        post_image_url,
+    )
+    from .blog.importer import import_posts_command
+    from .blog.render import (
+        create_renderer,
+        post_html,
+        render_sanitize_markdown,
+    )
+    from .blog.rerender import rerender_posts_command
+    from .blog.search import highlight_snippet, rebuild_search_index_command
+    from .blog.variants import create_variant_generator
+
+    app.cli.add_command(check_counters_command)
+    app.cli.add_command(gc_images_command)
+    app.cli.add_command(measure_images_command)
+    app.cli.add_command(move_images_command)
+    app.cli.add_command(import_posts_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(rerender_posts_command)
+    app.jinja_env.filters["highlight_snippet"] = highlight_snippet
+    app.extensions["flaskr_renderer"] = create_renderer(app.config)
+    app.extensions["flaskr_images"] = create_image_store(app.config)
+    app.extensions["flaskr_image_variants"] = create_variant_generator(
+        app.config, app.extensions["flaskr_images"], app.logger
+    )
+    app.jinja_env.globals["post_image_url"] = post_image_url
+    app.jinja_env.globals["post_image_srcset"] = post_image_srcset
+    app.jinja_env.filters["render_sanitize_markdown"] = render_sanitize_markdown
+    app.jinja_env.filters["post_html"] = post_html
     from .recaptcha import bp as recaptcha_bp
 
     app.register_blueprint(recaptcha_bp)
+    from .metrics import bp as metrics_bp
+
+    app.register_blueprint(metrics_bp)
     app.add_url_rule("/", endpoint="index")
 
     return app
@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from flaskr.db import get_db, parse_timestamp_utc
+from flaskr.db import get_db, write
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -7,18 +7,22 @@ class WrongPasswordException(Exception):
     pass
 
 
-def register_user(username, password, registration_ip, registration_time):
-    db = get_db()
+def _insert_user(db, username, password_hash, registration_ip, registration_time):
     db.execute(
         "INSERT INTO user (username, password, registration_ip, registration_time) VALUES (?, ?, ?, ?)",
-        (
-            username,
-            generate_password_hash(password),
-            registration_ip,
-            registration_time,
-        ),
+        (username, password_hash, registration_ip, registration_time),
+    )
+
+
+def register_user(username, password, registration_ip, registration_time):
+    # Hash outside the writer so slow hashing does not hold up other writes
+    write(
+        _insert_user,
+        username,
+        generate_password_hash(password),
+        registration_ip,
+        registration_time,
     )
-    db.commit()
 
 
 def check_login_credentials(username, password):
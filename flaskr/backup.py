@@ -0,0 +1,185 @@
+"""
+Online backup and restore with the SQLite backup API
+
+The backup copies a few pages at a time with a pause after each step. The
+source connection keeps a read transaction open meanwhile: in WAL mode this
+pins a consistent snapshot without blocking the writer, and stops SQLite
+from restarting the copy every time the application commits.
+
+Backups are checked with PRAGMA integrity_check before being compressed, and
+the compressed file is verified by decompressing it and comparing hashes.
+
+Post images are files in IMAGE_DIRECTORY, not in the database, and need to
+be copied separately. Files there are never modified, only added and
+deleted (see flaskr.blog.images), so copying them after the database
+backup gives a consistent pair.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+class BackupError(Exception):
+    pass
+
+
+def check_integrity(db):
+    try:
+        problems = [row[0] for row in db.execute("PRAGMA integrity_check")]
+    except sqlite3.DatabaseError as e:
+        raise BackupError(f"Not a valid database: {e}")
+    if problems != ["ok"]:
+        raise BackupError("Integrity check failed: " + "; ".join(problems[:10]))
+
+
+def copy_database(source, destination, pages, sleep):
+    """
+    Copy source into destination in steps of `pages` pages
+
+    Return (seconds, longest step in seconds, pages copied).
+    """
+    longest_step = 0
+    total_pages = 0
+    step_start = time.monotonic()
+
+    def progress(status, remaining, total):
+        nonlocal longest_step, total_pages, step_start
+        longest_step = max(longest_step, time.monotonic() - step_start)
+        total_pages = total
+        time.sleep(sleep)
+        step_start = time.monotonic()
+
+    start = time.monotonic()
+    source.backup(destination, pages=pages, progress=progress)
+    return time.monotonic() - start, longest_step, total_pages
+
+
+def hash_file(path, opener=open):
+    sha256 = hashlib.sha256()
+    with opener(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def backup_database(database, destination, pages=256, sleep=0.01, echo=print):
+    """Write a verified backup of database to destination, gzipped if .gz"""
+    source = sqlite3.connect(database, isolation_level=None)
+    directory = os.path.dirname(os.path.abspath(destination))
+    fd, copy_path = tempfile.mkstemp(suffix=".sqlite", dir=directory)
+    os.close(fd)
+    try:
+        journal_mode = source.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode == "wal":
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        copy = sqlite3.connect(copy_path)
+        try:
+            seconds, longest_step, total_pages = copy_database(
+                source, copy, pages, sleep
+            )
+            page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            if source.in_transaction:
+                source.execute("COMMIT")
+            copy.execute("PRAGMA journal_mode = DELETE")
+            check_integrity(copy)
+        finally:
+            copy.close()
+        size = total_pages * page_size
+        echo(
+            f"Copied {size / 2**20:.1f} MiB in {seconds:.2f} s"
+            f" ({size / 2**20 / max(seconds, 1e-9):.1f} MiB/s)"
+        )
+        if journal_mode == "wal":
+            echo(
+                f"Longest step {longest_step * 1e3:.1f} ms; writers were not"
+                " blocked (WAL snapshot)"
+            )
+        else:
+            echo(
+                f"Source locked against writes for {longest_step * 1e3:.1f} ms at most"
+            )
+        if destination.endswith(".gz"):
+            digest = hash_file(copy_path)
+            with open(copy_path, "rb") as fd_in, gzip.open(destination, "wb") as fd_out:
+                shutil.copyfileobj(fd_in, fd_out, 1024 * 1024)
+            if hash_file(destination, opener=gzip.open) != digest:
+                raise BackupError(f"{destination} does not match the backup")
+            os.unlink(copy_path)
+        else:
+            os.replace(copy_path, destination)
+        echo(f"Verified backup in {destination}")
+    except BaseException:
+        if os.path.exists(copy_path):
+            os.unlink(copy_path)
+        raise
+    finally:
+        source.close()
+
+
+def restore_database(backup, database, pages=256, echo=print):
+    """Replace the contents of database with a backup, gzipped if .gz"""
+    directory = os.path.dirname(os.path.abspath(database))
+    fd, copy_path = tempfile.mkstemp(suffix=".sqlite", dir=directory)
+    os.close(fd)
+    try:
+        opener = gzip.open if backup.endswith(".gz") else open
+        with opener(backup, "rb") as fd_in, open(copy_path, "wb") as fd_out:
+            shutil.copyfileobj(fd_in, fd_out, 1024 * 1024)
+        copy = sqlite3.connect(copy_path)
+        try:
+            check_integrity(copy)
+            target = sqlite3.connect(database)
+            try:
+                # Copying into a live database holds its write lock throughout
+                seconds, _, _ = copy_database(copy, target, pages, sleep=0)
+                version = target.execute("PRAGMA user_version").fetchone()[0]
+            finally:
+                target.close()
+        finally:
+            copy.close()
+        echo(f"Restored {backup}; write lock held for {seconds:.2f} s")
+        return version
+    finally:
+        os.unlink(copy_path)
+
+
+@click.command("backup")
+@click.argument("destination")
+@click.option("--pages", default=256, show_default=True, help="Pages per step")
+@click.option("--sleep", default=0.01, show_default=True, help="Seconds between steps")
+@with_appcontext
+def backup_command(destination, pages, sleep):
+    """Back up the database while the application runs (.gz to compress)"""
+    try:
+        backup_database(
+            current_app.config["DATABASE"], destination, pages, sleep, echo=click.echo
+        )
+    except BackupError as e:
+        raise click.ClickException(str(e))
+
+
+@click.command("restore")
+@click.argument("backup", type=click.Path(exists=True, dir_okay=False))
+@click.confirmation_option(prompt="This replaces all data in the database. Continue?")
+@with_appcontext
+def restore_command(backup):
+    """Replace the database with a backup"""
+    from .migrations import get_migrations
+
+    try:
+        version = restore_database(
+            backup, current_app.config["DATABASE"], echo=click.echo
+        )
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    if version < get_migrations()[-1].version:
+        click.echo("The backup has an older schema, run flask migrate")
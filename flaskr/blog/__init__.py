@@ -19,23 +19,35 @@ from .blogdb import (
     create_post,
     update_post,
     get_posts,
+    get_posts_page,
     count_posts,
     page_size,
     get_post_image,
     get_posts_with_tag,
     get_tag_counts,
     get_last_post_time_for_user,
+    delete_post,
+    set_like,
 )
+from .images import InvalidImageError, image_response, open_uploaded_image
+from .loader import load_post_details
+from .search import search_posts
 from ..recaptcha import validate_recaptcha_response, generate_recaptcha_html
 
 # Import to register the views as a side-effect
-from . import rss
+from . import rss, tag_dictionary
 
 
 class BadPageError(KeyError):
     pass
 
 
+def load_details(posts):
+    """Return the tags, liked flags and comment counts of posts, by id"""
+    user_id = None if g.user is None else g.user["id"]
+    return load_post_details([post["id"] for post in posts], user_id)
+
+
 def show_posts(posts, post_count, title):
     page = int(request.args.get("page", 1))
     npages = max(1, (post_count - 1) // page_size + 1)
@@ -45,26 +57,61 @@ def show_posts(posts, post_count, title):
     return render_template(
         "blog/posts.html",
         posts=posts,
+        details=load_details(posts),
         title=title,
         page=page,
         npages=npages,
+        searchquery=request.args.get("searchquery"),
         result_number_string=result_number_string,
     )
 
 
 @bp.route("/")
 def index():
-    searchquery = request.args.get("searchquery")
-    page = int(request.args.get("page", 1))
-    count, posts = get_posts(page=page, searchquery=searchquery)
+    """
+    Latest posts, optionally matching a search
+
+    Searches are ranked and paged by number. Otherwise, pages are addressed
+    by the opaque after/before cursors of the previous page. Numbered pages
+    (?page=N) are still supported but cost more the deeper they are.
+    """
+    searchquery = request.args.get("searchquery") or None
     if not searchquery:
         title = "Latest posts"
     else:
         title = f'Search for "{searchquery}"'
+    if searchquery:
+        page = int(request.args.get("page", 1))
+        count, posts = search_posts(searchquery, page=page)
+        try:
+            return show_posts(posts, count, title)
+        except BadPageError:
+            return redirect(url_for(".index", searchquery=searchquery))
+    if "page" in request.args:
+        page = int(request.args["page"])
+        count, posts = get_posts(page=page)
+        try:
+            return show_posts(posts, count, title)
+        except BadPageError:
+            return redirect(url_for(".index"))
     try:
-        return show_posts(posts, count, title)
-    except BadPageError:
+        posts, previous, next = get_posts_page(
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+        )
+    except ValueError:
         return redirect(url_for(".index"))
+    return render_template(
+        "blog/posts.html",
+        posts=posts,
+        details=load_details(posts),
+        title=title,
+        page=None,
+        searchquery=searchquery,
+        previous=previous,
+        next=next,
+        result_number_string="" if posts else "No posts were found",
+    )
 
 
 @bp.route("/create", methods=("GET", "POST"))
@@ -74,10 +121,18 @@ def create():
         title = request.form["title"]
         body = request.form["body"]
         recaptcha_response = request.form["g-recaptcha-response"]
+        # Only the start of the file is read until all checks passed
+        try:
+            image = open_uploaded_image(request.files["file"])
+            image_error = None
+        except InvalidImageError as e:
+            image, image_error = None, str(e)
         if not title:
             error = "Missing title"
         elif not body:
             error = "Missing body"
+        elif image_error is not None:
+            error = image_error
         elif not recaptcha_response or not validate_recaptcha_response(
             recaptcha_response
         ):
@@ -89,11 +144,8 @@ def create():
         tags = request.form["tags"].split(",")
         if tags == [""]:
             tags = []
-        imagebytes = (
-            request.files["file"].read() or None
-        )  # TODO: only read if captcha valid?
         if error is None:
-            post_id = create_post(g.user["id"], title, body, tags, imagebytes)
+            post_id = create_post(g.user["id"], title, body, tags, image)
             return redirect(url_for("blog.post", post_id=post_id))
         else:
             flash(error)
@@ -129,14 +181,17 @@ def update(post_id):
         tags = request.form["tags"].split(",")
         if tags == [""]:
             tags = []
-        imagebytes = request.files["file"].read() or None
+        try:
+            image = open_uploaded_image(request.files["file"])
+        except InvalidImageError as e:
+            image, error = None, str(e)
         delete_image = {"on": True, "off": False}[
             request.form.get("delete_image", "off")
         ]
-        if delete_image and imagebytes is not None:
+        if delete_image and image is not None:
             abort(400)
         if error is None:
-            update_post(post_id, title, body, tags, imagebytes, delete_image)
+            update_post(post_id, title, body, tags, image, delete_image)
             return redirect(url_for("blog.post", post_id=post_id))
         else:
             flash(error)
@@ -147,9 +202,7 @@ def update(post_id):
 @login_required
 def delete(post_id):
     get_post(post_id)
-    db = get_db()
-    db.execute("DELETE FROM post WHERE id == ?", (post_id,))
-    db.commit()
+    delete_post(post_id)
     return redirect(url_for("index"))
 
 
@@ -162,26 +215,21 @@ def like(post_id):
     new_status = new_status == 1
     if db.execute("SELECT id FROM post WHERE id = ?", (post_id,)).fetchone() is None:
         abort(404)
-    if new_status:
-        db.execute(
-            "INSERT INTO like (post_id, user_id) VALUES (?, ?)", (post_id, g.user["id"])
-        )
-    else:
-        db.execute(
-            "DELETE FROM like WHERE post_id == ? AND user_id == ?",
-            (post_id, g.user["id"]),
-        )
-    db.commit()
+    set_like(post_id, g.user["id"], new_status)
     return redirect(request.headers.get("Referer", "/"))
 
 
 @bp.route("/<int:post_id>/image.jpg")
 def post_image(post_id):
     try:
-        imagebytes = get_post_image(post_id)
+        image = get_post_image(post_id)
     except KeyError:
         abort(404)
-    return imagebytes
+    try:
+        return image_response(image)
+    except FileNotFoundError:
+        current_app.logger.error("Missing image file %s", image["image_hash"])
+        abort(404)
 
 
 def build_how_many_people_like_string(likes, liked):
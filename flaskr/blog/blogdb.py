@@ -1,211 +1,340 @@
+import base64
+import binascii
+import json
 import sqlite3
 from flask import g, abort
 
-from ..db import get_db, parse_timestamp_utc
+from ..db import from_utc_micros, get_db, to_utc_micros, write
+from .images import IMAGE_COLUMNS, store_image
+from .loader import load_post_details
+from .render import get_rendered_fields
+from .tag_dictionary import get_tag_dictionary
 
 
 page_size = 5
+# Columns of post holding the rendered body, see flaskr.blog.render
+RENDERED_COLUMNS = ("body_html", "summary_html", "render_version")
 
 
 def get_post(id, check_author=True):
-    db = get_db()
-    post = db.execute(
-        "SELECT p.id, title, body, created, author_id, username, has_image"
-        " FROM posts_view p WHERE p.id = ?",
-        (id,),
-    ).fetchone()
-    if post is None:
-        abort(404, f"Post id {id} does not exist")
-    if check_author and (
-        "user" not in g or g.user is None or post["author_id"] != g.user["id"]
-    ):
-        abort(403)
     if "user" not in g or g.user is None:
-        liked = False
+        user_id = None
     else:
         user_id = g.user["id"]
-        liked = (
-            db.execute(
-                "SELECT post_id FROM like WHERE post_id = ? AND user_id = ?",
-                (id, user_id),
-            ).fetchone()
-            is not None
+    post = (
+        get_db()
+        .execute(
+            "SELECT id, title, body, created, author_id, username, has_image,"
+            " image_hash, image_width, likes,"
+            " body_html, render_version"
+            " FROM posts_view WHERE id = ?",
+            (id,),
         )
-    post = dict(post)
-    post["liked"] = liked
-    post["likes"] = db.execute(
-        "SELECT COUNT(user_id) FROM like where post_id == ?", (id,)
-    ).fetchone()[0]
-    post["tags"] = get_post_tags(id)
-    return post
+        .fetchone()
+    )
+    if post is None:
+        abort(404, f"Post id {id} does not exist")
+    if check_author and post["author_id"] != user_id:
+        abort(403)
+    return post._extend(**load_post_details([id], user_id)[id])
 
 
-def get_possibly_new_tag_id(tag):
+def _get_possibly_new_tag_id(db, tag):
     assert tag
-    db = get_db()
     try:
         return db.execute("INSERT INTO tag (name) VALUES (?)", (tag,)).lastrowid
     except sqlite3.IntegrityError:
         return db.execute("SELECT id FROM tag WHERE name == ?", (tag,)).fetchone()["id"]
 
 
-def add_tags_to_post(post_id, tags):
-    db = get_db()
-    for tag in tags:
-        tag_id = get_possibly_new_tag_id(tag)
-        db.execute(
-            "INSERT INTO post_tag (post_id, tag_id) VALUES (?,?)", (post_id, tag_id)
-        )
+def get_possibly_new_tag_id(tag):
+    tag_id = get_tag_dictionary().get_id(tag)
+    if tag_id is not None:
+        return tag_id
+    return write(_get_possibly_new_tag_id, tag)
 
 
-def create_post(author_id, title, body, tags, imagebytes, created=None):
-    db = get_db()
-    fields = {
-        "author_id": author_id,
-        "title": title,
-        "body": body,
-        "imagebytes": imagebytes,
-        "created": created,
-    }
-    cols = ["author_id", "title", "body", "imagebytes"]
-    if created is not None:
+def _set_post_tags(db, post_id, tags):
+    """
+    Make tags the only tags of the post, in the same few statements for any
+    number of them
+
+    Tags are matched by name in SQL rather than by ids known beforehand:
+    a job earlier in the same write batch may have deleted an unused tag.
+    Empty names fail the CHECK on tag.name and are ignored.
+    """
+    fields = {"post_id": post_id, "tags": json.dumps(sorted(tags))}
+    # Removals first, so that a tag is not deleted for being unused and then
+    # inserted again
+    db.execute(
+        "DELETE FROM post_tag WHERE post_id == :post_id AND tag_id NOT IN"
+        " (SELECT id FROM tag WHERE name IN (SELECT value FROM json_each(:tags)))",
+        fields,
+    )
+    db.executemany(
+        "INSERT OR IGNORE INTO tag (name) VALUES (?)", [(tag,) for tag in tags]
+    )
+    db.execute(
+        "INSERT OR IGNORE INTO post_tag (post_id, tag_id)"
+        " SELECT :post_id, id FROM tag"
+        " WHERE name IN (SELECT value FROM json_each(:tags))",
+        fields,
+    )
+
+
+def _create_post(db, fields, tags):
+    cols = ["author_id", "title", "body"] + list(IMAGE_COLUMNS + RENDERED_COLUMNS)
+    if fields["created"] is not None:
         cols.append("created")
     post_id = db.execute(
         "INSERT INTO post (" + ",".join(cols) + ")"
         " VALUES (" + ",".join(":" + col for col in cols) + ")",
         fields,
     ).lastrowid
-    add_tags_to_post(post_id, tags)
-    db.commit()
+    _set_post_tags(db, post_id, tags)
     return post_id
 
 
-def update_post(post_id, title, body, tags, imagebytes, delete_image):
-    tags = set(tags)
-    db = get_db()
-    if (imagebytes is None) == delete_image:
+def create_post(author_id, title, body, tags, imagebytes, created=None):
+    fields = {
+        "author_id": author_id,
+        "title": title,
+        "body": body,
+        "created": created,
+    }
+    # Rendered and stored here rather than in the job, to keep it off the
+    # writer thread
+    fields.update(get_rendered_fields(body))
+    fields.update(store_image(imagebytes))
+    return write(_create_post, fields, set(tags))
+
+
+def _update_post(db, post_id, title, body, tags, image, rendered):
+    rendered = [rendered[col] for col in RENDERED_COLUMNS]
+    if image is not None:
         # Update image, whether to set a new one or to delete
         db.execute(
-            "UPDATE post SET title = ?, body = ?, imagebytes = ?" " WHERE id == ?",
-            (title, body, imagebytes, post_id),
+            "UPDATE post SET title = ?, body = ?, body_html = ?, summary_html = ?,"
+            " render_version = ?, image_hash = ?, image_size = ?, image_type = ?,"
+            " image_width = ?, image_height = ?, imagebytes = NULL WHERE id == ?",
+            (title, body, *rendered, *[image[col] for col in IMAGE_COLUMNS], post_id),
         )
-    elif not delete_image:
+    else:
         # Leave image as-is
         db.execute(
-            "UPDATE post SET title = ?, body = ? WHERE id == ?", (title, body, post_id)
+            "UPDATE post SET title = ?, body = ?, body_html = ?, summary_html = ?,"
+            " render_version = ? WHERE id == ?",
+            (title, body, *rendered, post_id),
         )
-    else:
+    _set_post_tags(db, post_id, tags)
+
+
+def update_post(post_id, title, body, tags, imagebytes, delete_image):
+    if imagebytes is not None and delete_image:
         # Passing an image while requesting deletion is invalid
         abort(400)
-    current_tags = set(get_post_tags(post_id))
-    to_be_removed_tags = current_tags - tags
-    for tag in to_be_removed_tags:
-        remove_post_tag(post_id, tag)
-    to_be_added_tags = tags - current_tags
-    add_tags_to_post(post_id, to_be_added_tags)
-    db.commit()
+    rendered = get_rendered_fields(body)
+    # None to leave the image as-is
+    image = None
+    if imagebytes is not None or delete_image:
+        image = store_image(imagebytes)
+    write(_update_post, post_id, title, body, set(tags), image, rendered)
 
 
-def remove_post_tag(post_id, tag):
-    db = get_db()
-    tag_id = db.execute("SELECT id FROM tag WHERE name == ?", (tag,)).fetchone()["id"]
+def _remove_post_tag(db, post_id, tag_id):
     db.execute(
         "DELETE FROM post_tag WHERE post_id == ? AND tag_id == ?", (post_id, tag_id)
     )
 
 
-def get_posts(page=1, searchquery=None):
+def remove_post_tag(post_id, tag):
+    tag_id = get_tag_dictionary().get_id(tag)
+    if tag_id is not None:
+        write(_remove_post_tag, post_id, tag_id)
+
+
+def _delete_post(db, post_id):
+    db.execute("DELETE FROM post WHERE id == ?", (post_id,))
+
+
+def delete_post(post_id):
+    write(_delete_post, post_id)
+
+
+def _set_like(db, post_id, user_id, like):
+    if like:
+        db.execute(
+            "INSERT OR IGNORE INTO like (post_id, user_id) VALUES (?, ?)",
+            (post_id, user_id),
+        )
+    else:
+        db.execute(
+            "DELETE FROM like WHERE post_id == ? AND user_id == ?", (post_id, user_id)
+        )
+
+
+def set_like(post_id, user_id, like):
+    write(_set_like, post_id, user_id, like)
+
+
+def get_posts(page=1):
     """
-    Return given page of posts. Optionally search title and body.
+    Return given page of posts.
 
-    user_id is used to determine which posts the user liked
+    Returns (count, posts). The count of all posts is read from post_stats.
     """
-    if searchquery is not None:
-        searchquery = "%" + searchquery + "%"
-        where = " WHERE post.title LIKE :searchquery" " OR post.body LIKE :searchquery"
+    posts = (
+        get_db()
+        .execute(
+            "SELECT post.id, title, created, author_id, username, has_image,"
+            " image_hash, image_width, likes, summary_html, render_version"
+            " FROM posts_view post ORDER BY created DESC, id DESC"
+            " LIMIT :page_size OFFSET :offset",
+            {"page_size": page_size, "offset": page_size * (page - 1)},
+        )
+        .fetchall()
+    )
+    return count_posts(), posts
+
+
+def encode_cursor(post):
+    """Return an opaque token for the position of post in the listing"""
+    position = f"{to_utc_micros(post['created'])}.{post['id']}"
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (created, id) from a token of encode_cursor, ValueError if invalid"""
+    try:
+        position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created, id = map(int, position.decode().split("."))
+        # Forged tokens may hold numbers SQLite or datetime cannot
+        if not -(2**63) <= id < 2**63:
+            raise OverflowError(id)
+        return from_utc_micros(created), id
+    except (binascii.Error, UnicodeDecodeError, OverflowError) as e:
+        raise ValueError(cursor) from e
+
+
+def get_posts_page(after=None, before=None):
+    """
+    Return (posts, previous, next) for the page of posts after or before a
+    cursor, newest first.
+
+    Pages seek on (created, id) through the post__created index, so any page
+    costs the same as the first. previous and next are cursors for the
+    neighbouring pages, None if there is none.
+    """
+    condition = ""
+    fields = {"page_size": page_size + 1}
+    if before is not None:
+        fields["created"], fields["id"] = decode_cursor(before)
+        condition = " WHERE (created, id) > (:created, :id)"
+        order = "created ASC, id ASC"
+    elif after is not None:
+        fields["created"], fields["id"] = decode_cursor(after)
+        condition = " WHERE (created, id) < (:created, :id)"
+        order = "created DESC, id DESC"
     else:
-        where = ""
-    fields = {
-        "page_size": page_size,
-        "offset": page_size * (page - 1),
-        "searchquery": searchquery,
-    }
-    posts = [
-        dict(row)
-        for row in get_db()
+        order = "created DESC, id DESC"
+    posts = (
+        get_db()
         .execute(
-            "SELECT post.id, title, body, created, author_id, username, has_image,"
-            " COUNT(*) OVER() as resultcount"
+            "SELECT post.id, title, created, author_id, username, has_image,"
+            " image_hash, image_width, likes, summary_html, render_version"
             " FROM posts_view post"
-            + where
-            + " ORDER BY created DESC LIMIT :page_size OFFSET :offset",
+            + condition
+            + " ORDER BY "
+            + order
+            + " LIMIT :page_size",
             fields,
         )
         .fetchall()
-    ]
-    if posts:
-        count = posts[0]["resultcount"]
+    )
+    # The extra post tells whether there are more in this direction
+    more = len(posts) > page_size
+    posts = posts[:page_size]
+    if before is not None:
+        posts.reverse()
+        newer, older = more, True
     else:
-        count = 0
-    for post in posts:
-        del post["resultcount"]
-        post["has_image"] = bool(post["has_image"])
-    return count, posts
-
-
-def count_posts():
-    return get_db().execute("SELECT COUNT(id) FROM post").fetchone()[0]
+        newer, older = after is not None, more
+    if not posts:
+        return posts, None, None
+    previous = encode_cursor(posts[0]) if newer else None
+    next = encode_cursor(posts[-1]) if older else None
+    return posts, previous, next
+
+
+def count_posts(author_id=None):
+    """Return the number of posts, of an author if given"""
+    if author_id is None:
+        return get_db().execute("SELECT posts FROM post_stats").fetchone()[0]
+    row = (
+        get_db()
+        .execute("SELECT posts FROM author_stats WHERE author_id == ?", (author_id,))
+        .fetchone()
+    )
+    return 0 if row is None else row[0]
 
 
 def get_post_image(post_id):
+    """
+    Return id, image_hash, image_size, image_type and image_width of the
+    image of a post
+
+    Images not moved out of the database yet have only database_size, the
+    length of post.imagebytes. Their bytes are not read here.
+    """
     row = (
         get_db()
-        .execute("SELECT imagebytes FROM post WHERE id == ?", (post_id,))
+        .execute(
+            "SELECT id, image_hash, image_size, image_type, image_width,"
+            " length(imagebytes) AS database_size"
+            " FROM post WHERE id == ?",
+            (post_id,),
+        )
         .fetchone()
     )
-    if row is None or row[0] is None:
+    if row is None or (row["image_hash"] is None and row["database_size"] is None):
         raise KeyError
-    return row[0]
+    return row
 
 
-def get_post_tags(post_id):
+def _get_post_tags(db, post_id):
     return [
         row[0]
-        for row in get_db()
-        .execute(
+        for row in db.execute(
             "SELECT tag.name FROM tag JOIN post_tag"
             " ON tag.id == post_tag.tag_id"
             " WHERE post_tag.post_id == ?",
             (post_id,),
-        )
-        .fetchall()
+        ).fetchall()
     ]
 
 
+def get_post_tags(post_id):
+    return _get_post_tags(get_db(), post_id)
+
+
 def get_posts_with_tag(tag, page):
-    posts = [
-        dict(row)
-        for row in get_db()
-        .execute(
-            "SELECT post.id, title, body, created, author_id, username, has_image,"
-            " COUNT(*) OVER() as resultcount"
-            " FROM posts_view post"
-            " JOIN post_tag ON post_tag.post_id == post.id"
-            " JOIN tag ON post_tag.tag_id == tag.id"
-            " WHERE tag.name == :tag"
-            " ORDER BY created DESC LIMIT :page_size OFFSET :offset",
-            {"tag": tag, "page_size": page_size, "offset": page_size * (page - 1)},
-        )
-        .fetchall()
-    ]
-    if posts:
-        count = posts[0]["resultcount"]
-    else:
-        count = 0
-    for post in posts:
-        post["has_image"] = bool(post["has_image"])
-        del post["resultcount"]
-    return count, posts
+    db = get_db()
+    posts = db.execute(
+        "SELECT post.id, title, created, author_id, username, has_image,"
+        " image_hash, image_width, likes, summary_html, render_version"
+        " FROM posts_view post"
+        " JOIN post_tag ON post_tag.post_id == post.id"
+        " JOIN tag ON post_tag.tag_id == tag.id"
+        " WHERE tag.name == :tag"
+        " ORDER BY created DESC LIMIT :page_size OFFSET :offset",
+        {"tag": tag, "page_size": page_size, "offset": page_size * (page - 1)},
+    ).fetchall()
+    row = db.execute(
+        "SELECT posts FROM tag_stats JOIN tag ON tag_stats.tag_id == tag.id"
+        " WHERE tag.name == ?",
+        (tag,),
+    ).fetchone()
+    return 0 if row is None else row[0], posts
 
 
 def get_tag_counts():
@@ -213,24 +342,29 @@ def get_tag_counts():
     return (
         get_db()
         .execute(
-            "SELECT tag.name, count(*) AS count"
-            " FROM tag JOIN post_tag ON tag.id == post_tag.tag_id"
-            " GROUP BY tag.name"
-            " ORDER BY count DESC"
+            "SELECT tag.name, posts AS count"
+            " FROM tag_stats JOIN tag ON tag.id == tag_stats.tag_id"
+            " WHERE posts > 0"
+            " ORDER BY posts DESC"
         )
         .fetchall()
     )
 
 
 def get_last_action_time_for_user(user_id, table):
-    ret = (
+    # Selecting the column itself (not max()) keeps its type for the converter
+    row = (
         get_db()
-        .execute(f"SELECT max(created) FROM {table} WHERE author_id == ?", (user_id,))
-        .fetchone()[0]
+        .execute(
+            f"SELECT created FROM {table} WHERE author_id == ?"
+            " ORDER BY created DESC LIMIT 1",
+            (user_id,),
+        )
+        .fetchone()
     )
-    if ret is None:
-        return ret
-    return parse_timestamp_utc(ret.encode())
+    if row is None:
+        return None
+    return row[0]
 
 
 def get_last_post_time_for_user(user_id):
@@ -241,13 +375,13 @@ def get_last_comment_time_for_user(user_id):
     return get_last_action_time_for_user(user_id, "comment")
 
 
+def _create_comment(db, post_id, user_id, body, created):
+    return db.execute(
+        "INSERT INTO comment (post_id, author_id, body, created)"
+        " VALUES (?, ?, ?, ?)",
+        (post_id, user_id, body, created),
+    ).lastrowid
+
+
 def create_comment(post_id, user_id, body, created):
-    return (
-        get_db()
-        .execute(
-            "INSERT INTO comment (post_id, author_id, body, created)"
-            " VALUES (?, ?, ?, ?)",
-            (post_id, user_id, body, created),
-        )
-        .lastrowid
-    )
+    return write(_create_comment, post_id, user_id, body, created)
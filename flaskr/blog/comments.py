@@ -9,7 +9,7 @@ from flask import (
     current_app,
 )
 from datetime import datetime, timezone, timedelta
-from ..db import get_db
+from ..db import get_db, write
 from ..auth import login_required
 from .blogdb import get_post, create_comment, get_last_comment_time_for_user
 from .blueprint import bp
@@ -54,7 +54,6 @@ def new_comment(post_id):
             comment_id = create_comment(
                 post_id, g.user["id"], body, created=datetime.now()
             )
-            db.commit()
             return redirect(
                 url_for("blog.post", post_id=post_id, _anchor=f"comment{comment_id}")
             )
@@ -82,6 +81,14 @@ def get_comment(post_id, comment_id):
     return ret
 
 
+def _delete_comment(db, comment_id):
+    db.execute("DELETE FROM comment WHERE id == ?", (comment_id,))
+
+
+def _update_comment(db, comment_id, body):
+    db.execute("UPDATE comment SET body = ? WHERE id = ?", (body, comment_id))
+
+
 @bp.route("/<int:post_id>/comments/<int:comment_id>")
 def comment(post_id, comment_id):
     post = get_post(post_id, check_author=False)
@@ -95,9 +102,7 @@ def delete_comment(post_id, comment_id):
     comment = get_comment(post_id, comment_id)
     if comment["author_id"] != g.user["id"]:
         abort(403)
-    db = get_db()
-    db.execute("DELETE FROM comment WHERE id == ?", (comment_id,))
-    db.commit()
+    write(_delete_comment, comment_id)
     return redirect(url_for("blog.post", post_id=post_id))
 
 
@@ -110,9 +115,7 @@ def update_comment(post_id, comment_id):
         if comment["author_id"] != g.user["id"]:
             abort(403)
         body = request.form["body"]
-        db = get_db()
-        db.execute("UPDATE comment SET body = ? WHERE id = ?", (body, comment_id))
-        db.commit()
+        write(_update_comment, comment_id, body)
         return redirect(url_for("blog.post", post_id=post_id))
     return render_template("blog/comments/new.html", post=post, comment=comment)
 
@@ -0,0 +1,105 @@
+"""
+Counters kept up to date by triggers
+
+post_stats holds the total number of posts, author_stats the number per
+author, tag_stats the number per tag and post.likes the likes of each post.
+The triggers in schema.sql update them in the same transaction as the
+change to post, post_tag or like, so they can be read instead of counting
+rows. check_counters compares them with
+actual counts, and repair_counters recounts everything.
+"""
+import click
+from flask.cli import with_appcontext
+
+from ..db import get_db
+
+# (name, stored counts, actual counts, statements recounting them)
+_counters = [
+    (
+        "post_stats",
+        "SELECT id, posts FROM post_stats",
+        "SELECT 1, COUNT(*) FROM post",
+        [
+            "DELETE FROM post_stats",
+            "INSERT INTO post_stats (id, posts) SELECT 1, COUNT(*) FROM post",
+        ],
+    ),
+    (
+        "author_stats",
+        "SELECT author_id, posts FROM author_stats WHERE posts != 0",
+        "SELECT author_id, COUNT(*) FROM post GROUP BY author_id",
+        [
+            "DELETE FROM author_stats",
+            "INSERT INTO author_stats (author_id, posts)"
+            " SELECT author_id, COUNT(*) FROM post GROUP BY author_id",
+        ],
+    ),
+    (
+        "tag_stats",
+        "SELECT tag_id, posts FROM tag_stats WHERE posts != 0",
+        "SELECT tag_id, COUNT(*) FROM post_tag"
+        " WHERE post_id IN (SELECT id FROM post) GROUP BY tag_id",
+        [
+            "DELETE FROM post_tag WHERE post_id NOT IN (SELECT id FROM post)",
+            "DELETE FROM tag_stats",
+            "INSERT INTO tag_stats (tag_id, posts)"
+            " SELECT tag_id, COUNT(*) FROM post_tag GROUP BY tag_id",
+        ],
+    ),
+    (
+        "post.likes",
+        "SELECT id, likes FROM post WHERE likes != 0",
+        "SELECT post_id, COUNT(*) FROM like"
+        " WHERE post_id IN (SELECT id FROM post) GROUP BY post_id",
+        [
+            "UPDATE post SET likes ="
+            " (SELECT COUNT(*) FROM like WHERE post_id = post.id)"
+            " WHERE likes != 0 OR id IN (SELECT post_id FROM like)",
+        ],
+    ),
+]
+
+
+def check_counters(db):
+    """Return (name, key, stored, actual) for each wrong counter"""
+    errors = []
+    for name, stored_query, actual_query, _ in _counters:
+        stored = dict(db.execute(stored_query).fetchall())
+        actual = dict(db.execute(actual_query).fetchall())
+        for key in sorted(stored.keys() | actual.keys()):
+            if stored.get(key, 0) != actual.get(key, 0):
+                errors.append((name, key, stored.get(key, 0), actual.get(key, 0)))
+    return errors
+
+
+def repair_counters(db):
+    """Recount all counters in one transaction, dropping tags of deleted posts"""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for _, _, _, statements in _counters:
+            for statement in statements:
+                db.execute(statement)
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+@click.command("check-counters")
+@click.option("--repair", is_flag=True, help="Recount the wrong counters")
+@with_appcontext
+def check_counters_command(repair):
+    """Compare the counters with actual counts"""
+    db = get_db()
+    errors = check_counters(db)
+    for table, key, stored, actual in errors:
+        click.echo(f"{table} {key}: {stored} instead of {actual}")
+    if not errors:
+        click.echo("All counters are correct")
+    elif repair:
+        # Not through the writer: recounting a big database can outlast
+        # WRITE_TIMEOUT
+        repair_counters(db)
+        click.echo("Repaired the counters")
+    else:
+        raise click.ClickException(f"{len(errors)} wrong counters, use --repair")
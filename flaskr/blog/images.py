@@ -0,0 +1,678 @@
+"""
+Post images stored as files named after the SHA-256 of their content
+
+Posts keep only image_hash, image_size and image_type; the bytes live in
+IMAGE_DIRECTORY/<first 2 hex digits>/<other 62>, so identical uploads are
+stored once and post_image can hand the file to the server with send_file.
+Files are written and synced before the post referencing them is committed.
+
+Uploads are checked from their first chunk by open_uploaded_image, and
+copied to the store a chunk at a time once the form was accepted, so an
+upload takes a chunk of memory, not its size (Werkzeug spools the larger
+ones to a temporary file while parsing the form).
+
+Files are never deleted when a post stops referencing them: another post
+may be about to. flask gc-images deletes the unreferenced files that are
+older than a grace period instead, and the temporary files left by
+interrupted writes. Storing a file and deleting one take the store's lock,
+a file lock shared with the other processes, so that gc-images cannot
+delete a file that was just stored again for a new post.
+
+Images uploaded before the store existed are still in post.imagebytes
+until flask move-images moves them out, and are sent from there meanwhile:
+the large ones with incremental BLOB I/O, so that serving them takes a
+chunk of memory rather than the whole image. Both kinds answer Range
+requests.
+
+The hash doubles as a strong ETag, and the start of it versions image URLs
+(?v=...): a versioned URL always has the same content, so it is cached
+for a year as immutable. Other image URLs are revalidated on each use.
+
+Downscaled variants of the images are stored next to them, see
+flaskr.blog.variants, and sent for URLs with their width (?w=...).
+"""
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+from flask import current_app, request, send_file, url_for
+from flask.cli import with_appcontext
+from werkzeug.wsgi import wrap_file
+
+from ..db import get_blob_pool, get_db, write
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .variants import (
+    VARIANT_TYPE,
+    get_variant_generator,
+    image_dimensions,
+    variants_available,
+)
+
+# Bytes read at a time from uploads and images in the database
+CHUNK_SIZE = 64 * 1024
+# Images in the database up to this size are read at once rather than
+# streamed
+BUFFERED_IMAGE_SIZE = 1024 * 1024
+
+# Columns of post describing a stored image, in the order ImageStore.put
+# returns them
+IMAGE_COLUMNS = (
+    "image_hash",
+    "image_size",
+    "image_type",
+    "image_width",
+    "image_height",
+)
+
+# Characters of the hash in the v argument of image URLs
+URL_VERSION_LENGTH = 16
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# (MIME type, magic bytes at offset 0, more magic bytes at offset 8)
+_signatures = [
+    ("image/png", b"\x89PNG\r\n\x1a\n", b""),
+    ("image/jpeg", b"\xff\xd8\xff", b""),
+    ("image/gif", b"GIF87a", b""),
+    ("image/gif", b"GIF89a", b""),
+    ("image/webp", b"RIFF", b"WEBP"),
+]
+
+
+# JPEG markers starting a frame, with its dimensions
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class InvalidImageError(ValueError):
+    """An upload that is not an image Flaskr accepts, with a message for the user"""
+
+
+def detect_image_type(data):
+    """Return the MIME type of image data from its first bytes"""
+    for mimetype, magic, magic_at_8 in _signatures:
+        if data.startswith(magic) and data[8:].startswith(magic_at_8):
+            return mimetype
+    return "application/octet-stream"
+
+
+def _jpeg_dimensions(data):
+    position = 2
+    while position + 9 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack_from(">HH", data, position + 5)
+            return width, height
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+        elif 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            # Standalone markers
+            position += 2
+        else:
+            position += 2 + struct.unpack_from(">H", data, position + 2)[0]
+    return None, None
+
+
+def _webp_dimensions(data):
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack_from("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        return width, int.from_bytes(data[27:30], "little") + 1
+    return None, None
+
+
+def sniff_image(data):
+    """
+    Return (MIME type, width, height) of an image from its first bytes
+
+    The dimensions are None when not in data, e.g. after large metadata at
+    the start of a JPEG image. They are as stored, not as displayed.
+    """
+    mimetype = detect_image_type(data)
+    width = height = None
+    if mimetype == "image/png" and data[12:16] == b"IHDR" and len(data) >= 24:
+        width, height = struct.unpack_from(">II", data, 16)
+    elif mimetype == "image/gif" and len(data) >= 10:
+        width, height = struct.unpack_from("<HH", data, 6)
+    elif mimetype == "image/jpeg":
+        width, height = _jpeg_dimensions(data)
+    elif mimetype == "image/webp":
+        width, height = _webp_dimensions(data)
+    return mimetype, width, height
+
+
+class ImageStore:
+    """
+    Content-addressed files in a directory
+
+    Variants of a file are named after it, followed by .w and their width.
+    Temporary files start with .tmp.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the store, between threads and, where fcntl is
+        available, between processes
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, ".lock"), "ab") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def path(self, image_hash):
+        return os.path.join(self.directory, image_hash[:2], image_hash[2:])
+
+    def variant_path(self, image_hash, width):
+        return f"{self.path(image_hash)}.w{width}"
+
+    def _write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, data):
+        """Store bytes, see put_file"""
+        return self.put_file(io.BytesIO(data))
+
+    def put_file(self, file):
+        """
+        Store the content of a binary file unless already there, copied a
+        chunk at a time. Return (hash, size, MIME type, width, height)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # In the top directory, the hash is not known yet
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        try:
+            with open(fd, "w+b") as f:
+                sha256 = hashlib.sha256()
+                head = chunk = file.read(CHUNK_SIZE)
+                while chunk:
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    chunk = file.read(CHUNK_SIZE)
+                size = f.tell()
+                f.seek(0)
+                dimensions = image_dimensions(f)
+                image_hash = sha256.hexdigest()
+                path = self.path(image_hash)
+                exists = os.path.exists(path)
+                if not exists:
+                    f.flush()
+                    os.fsync(f.fileno())
+            # gc-images checks the modification time and deletes under the
+            # lock, so the file is either refreshed or written again
+            with self._locked():
+                if os.path.exists(path):
+                    # Not collected by gc-images for another grace period
+                    os.utime(path)
+                else:
+                    if exists:
+                        # Deleted by gc-images meanwhile
+                        with open(tmp_path, "rb") as f:
+                            os.fsync(f.fileno())
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return (image_hash, size, detect_image_type(head), *dimensions)
+
+    def put_variant(self, image_hash, width, data):
+        self._write(self.variant_path(image_hash, width), data)
+
+    def hashes(self):
+        """
+        Yield (hash, modification time) of all stored files, the latest of
+        the file and its variants
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            mtimes = {}
+            for entry in os.scandir(directory):
+                # Temporary files have nothing before the dot
+                name = entry.name.partition(".")[0]
+                if name:
+                    mtime = entry.stat().st_mtime
+                    mtimes[name] = max(mtimes.get(name, mtime), mtime)
+            for name, mtime in mtimes.items():
+                yield prefix + name, mtime
+
+    def delete(self, image_hash, older_than):
+        """
+        Delete the file and its variants if last stored before the time
+        older_than
+        """
+        path = self.path(image_hash)
+        with self._locked():
+            try:
+                if os.stat(path).st_mtime >= older_than:
+                    return False
+                os.unlink(path)
+            except FileNotFoundError:
+                # Only variants made while the file was being deleted
+                pass
+        directory, name = os.path.split(path)
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return True
+        for entry in entries:
+            if entry.name.startswith(name + "."):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def delete_temporary(self, older_than):
+        """
+        Delete the temporary files last written before the time older_than,
+        left by interrupted writes. Return how many
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        directories = [self.directory] + [
+            entry.path
+            for entry in os.scandir(self.directory)
+            if len(entry.name) == 2 and entry.is_dir()
+        ]
+        deleted = 0
+        for directory in directories:
+            for entry in os.scandir(directory):
+                if entry.name.startswith(".tmp") and entry.is_file():
+                    try:
+                        if entry.stat().st_mtime < older_than:
+                            os.unlink(entry.path)
+                            deleted += 1
+                    except FileNotFoundError:
+                        pass
+        return deleted
+
+
+def create_image_store(config):
+    return ImageStore(config["IMAGE_DIRECTORY"])
+
+
+def get_image_store():
+    return current_app.extensions["flaskr_images"]
+
+
+def open_uploaded_image(upload, max_pixels=None):
+    """
+    Return the binary file of the image of a form, None if no file was chosen
+
+    Only the first chunk is read, to raise InvalidImageError early if the
+    file is not an image that can be served or has more than max_pixels
+    pixels (IMAGE_MAX_PIXELS by default).
+    """
+    if max_pixels is None:
+        # May come as a string from FLASKR_IMAGE_MAX_PIXELS
+        max_pixels = int(current_app.config["IMAGE_MAX_PIXELS"])
+    file = upload.stream
+    head = file.read(CHUNK_SIZE)
+    if not head:
+        return None
+    file.seek(0)
+    mimetype, width, height = sniff_image(head)
+    if mimetype == "application/octet-stream":
+        raise InvalidImageError("The file is not a PNG, JPEG, GIF or WebP image")
+    if width is not None and width * height > max_pixels:
+        raise InvalidImageError(
+            f"The image is too large, {width}x{height} pixels,"
+            f" at most {max_pixels / 1e6:g} megapixels are accepted"
+        )
+    return file
+
+
+def store_image(imagebytes):
+    """
+    Return the image columns of post for imagebytes, and start making the
+    variants of the image
+
+    imagebytes may be None, bytes or a binary file, as returned by
+    open_uploaded_image, which is copied a chunk at a time.
+    """
+    if imagebytes is None:
+        return dict.fromkeys(IMAGE_COLUMNS)
+    store = get_image_store()
+    if isinstance(imagebytes, bytes):
+        image = store.put(imagebytes)
+    else:
+        image = store.put_file(imagebytes)
+    image = dict(zip(IMAGE_COLUMNS, image))
+    if get_variant_generator().widths_for(image["image_width"]):
+        get_variant_generator().submit(image["image_hash"])
+    return image
+
+
+def post_image_url(post, width=None):
+    """Template global returning the URL of the image of post"""
+    image_hash = post.get("image_hash")
+    version = image_hash[:URL_VERSION_LENGTH] if image_hash else None
+    return url_for("blog.post_image", post_id=post["id"], v=version, w=width)
+
+
+def post_image_srcset(post):
+    """
+    Template global returning the srcset of the image of post, with its
+    variants, or "" if it has none
+    """
+    widths = get_variant_generator().widths_for(post.get("image_width"))
+    if not post.get("image_hash") or not widths:
+        return ""
+    candidates = [f"{post_image_url(post, width)} {width}w" for width in widths]
+    candidates.append(f"{post_image_url(post)} {post['image_width']}w")
+    return ", ".join(candidates)
+
+
+def _is_versioned_url(image_hash):
+    return image_hash is not None and request.args.get("v") == (
+        image_hash[:URL_VERSION_LENGTH]
+    )
+
+
+class _ImageBlob:
+    """
+    Read-only file over post.imagebytes, with SQLite incremental BLOB I/O
+
+    The blob keeps its connection busy while the response body is read, so
+    it gets one from get_blob_pool rather than the request's, and gives it
+    back when closed.
+    """
+
+    def __init__(self, post_id):
+        self._pool = get_blob_pool()
+        self._db = self._pool.acquire()
+        try:
+            self._blob = self._db.blobopen("post", "imagebytes", post_id, readonly=True)
+        except BaseException:
+            self._pool.release(self._db)
+            raise
+
+    def read(self, length=-1):
+        return self._blob.read(length)
+
+    def seek(self, offset, origin=os.SEEK_SET):
+        return self._blob.seek(offset, origin)
+
+    def tell(self):
+        return self._blob.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if self._db is not None:
+            self._blob.close()
+            self._pool.release(self._db)
+            self._db = None
+
+
+def _database_image_response(post_id):
+    """
+    Send an image not moved to the store yet
+
+    Images up to BUFFERED_IMAGE_SIZE are read at once on the request's
+    connection. Larger ones are streamed by an _ImageBlob, with a chunk in
+    memory. Python before 3.11 has no blobopen, they are then read at once
+    too.
+    """
+    db = get_db()
+    (size,) = db.execute(
+        "SELECT length(imagebytes) FROM post WHERE id == ?", (post_id,)
+    ).fetchone()
+    if size <= BUFFERED_IMAGE_SIZE or not hasattr(db, "blobopen"):
+        (data,) = db.execute(
+            "SELECT imagebytes FROM post WHERE id == ?", (post_id,)
+        ).fetchone()
+        file = io.BytesIO(data)
+    else:
+        file = _ImageBlob(post_id)
+    try:
+        mimetype = detect_image_type(file.read(16))
+        file.seek(0)
+        response = current_app.response_class(
+            wrap_file(request.environ, file, CHUNK_SIZE),
+            mimetype=mimetype,
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        # imagebytes is only ever cleared, by move-images, so the post and
+        # the size identify the content without reading it
+        response.set_etag(f"post{post_id}-{size}")
+        response.cache_control.no_cache = True
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=size
+        )
+    except BaseException:
+        file.close()
+        raise
+
+
+def _variant_path(image, width):
+    """
+    Path of the variant of image for width, None to send the image itself
+
+    A missing variant is queued for making, the image is sent meanwhile.
+    """
+    generator = get_variant_generator()
+    if width not in generator.widths_for(image["image_width"]):
+        return None
+    path = get_image_store().variant_path(image["image_hash"], width)
+    if not os.path.exists(path):
+        generator.submit(image["image_hash"])
+        return None
+    return path
+
+
+def image_response(image):
+    """
+    Response to a request for an image, as returned by get_post_image
+
+    Answers 304 when If-None-Match has the ETag, and HEAD requests without
+    opening the file.
+    """
+    image_hash = image["image_hash"]
+    if image_hash is None:
+        return _database_image_response(image["id"])
+    width = request.args.get("w", type=int)
+    path = _variant_path(image, width)
+    is_variant = path is not None
+    if is_variant:
+        mimetype, etag = VARIANT_TYPE, f"{image_hash}.w{width}"
+    else:
+        path = get_image_store().path(image_hash)
+        mimetype, etag = image["image_type"], image_hash
+    if request.method == "HEAD":
+        stat = os.stat(path)
+        response = current_app.response_class(mimetype=mimetype)
+        response.content_length = stat.st_size
+        response.last_modified = stat.st_mtime
+        response.set_etag(etag)
+    else:
+        response = send_file(path, mimetype=mimetype, etag=etag, conditional=False)
+    # Not when sending the image for a variant still being made
+    if _is_versioned_url(image_hash) and (is_variant or width is None):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=response.content_length
+    )
+
+
+def _save_moved_images(db, rows):
+    # Unless the image was replaced or deleted since
+    db.executemany(
+        "UPDATE post SET image_hash = ?, image_size = ?, image_type = ?,"
+        " image_width = ?, image_height = ?, imagebytes = NULL"
+        " WHERE id == ? AND image_hash IS NULL AND imagebytes IS NOT NULL",
+        rows,
+    )
+
+
+def move_images(batch_size=100, echo=print):
+    """Move the images stored in post.imagebytes to files, return how many"""
+    store = get_image_store()
+    db = get_db()
+    moved = 0
+    last_id = -1
+    while True:
+        posts = db.execute(
+            "SELECT id, imagebytes FROM post"
+            " WHERE id > ? AND imagebytes IS NOT NULL ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not posts:
+            break
+        rows = [store.put(imagebytes) + (post_id,) for post_id, imagebytes in posts]
+        write(_save_moved_images, rows)
+        moved += len(rows)
+        last_id = posts[-1][0]
+        echo(f"Moved {moved} images, up to post {last_id}")
+    return moved
+
+
+def delete_unused_images(grace_seconds=86400):
+    """
+    Delete the files no post references, if older than grace_seconds, and
+    the temporary files as old. Return how many files were unused
+    """
+    store = get_image_store()
+    cutoff = time.time() - grace_seconds
+    store.delete_temporary(cutoff)
+    # Listed before reading the references: a file stored meanwhile is
+    # too recent to be deleted anyway
+    candidates = [image_hash for image_hash, mtime in store.hashes() if mtime < cutoff]
+    used = {
+        row[0]
+        for row in get_db().execute(
+            "SELECT DISTINCT image_hash FROM post WHERE image_hash IS NOT NULL"
+        )
+    }
+    # Stored again since listed if the modification time changed
+    return sum(
+        store.delete(image_hash, cutoff)
+        for image_hash in candidates
+        if image_hash not in used
+    )
+
+
+def _save_dimensions(db, rows):
+    db.executemany(
+        "UPDATE post SET image_width = ?, image_height = ? WHERE id == ?", rows
+    )
+
+
+def measure_images(batch_size=100, echo=print):
+    """
+    Record the dimensions of the stored images missing them, so that they
+    get variants. Return how many posts were updated
+    """
+    store = get_image_store()
+    db = get_db()
+    measured = 0
+    last_id = -1
+    while True:
+        posts = db.execute(
+            "SELECT id, image_hash FROM post"
+            " WHERE id > ? AND image_hash IS NOT NULL AND image_width IS NULL"
+            " ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not posts:
+            break
+        dimensions = {}
+        for _, image_hash in posts:
+            if image_hash not in dimensions:
+                try:
+                    with open(store.path(image_hash), "rb") as fd:
+                        dimensions[image_hash] = image_dimensions(fd)
+                except FileNotFoundError:
+                    dimensions[image_hash] = (None, None)
+        rows = [
+            dimensions[image_hash] + (post_id,)
+            for post_id, image_hash in posts
+            if dimensions[image_hash][0] is not None
+        ]
+        write(_save_dimensions, rows)
+        measured += len(rows)
+        last_id = posts[-1][0]
+        echo(f"Measured {measured} images, up to post {last_id}")
+    return measured
+
+
+@click.command("move-images")
+@click.option("--batch-size", default=100, show_default=True, help="Images per batch")
+@with_appcontext
+def move_images_command(batch_size):
+    """Move images from the post table to IMAGE_DIRECTORY"""
+    moved = move_images(batch_size, echo=click.echo)
+    click.echo(f"Moved {moved} images. VACUUM the database to reclaim the space")
+
+
+@click.command("measure-images")
+@click.option("--batch-size", default=100, show_default=True, help="Images per batch")
+@with_appcontext
+def measure_images_command(batch_size):
+    """Record the dimensions of stored images, for their variants"""
+    if not variants_available():
+        raise click.ClickException("Pillow with WebP support is not installed")
+    measure_images(batch_size, echo=click.echo)
+
+
+@click.command("gc-images")
+@click.option(
+    "--grace-seconds",
+    default=86400,
+    show_default=True,
+    help="Keep unused files younger than this",
+)
+@with_appcontext
+def gc_images_command(grace_seconds):
+    """Delete image files that no post references"""
+    click.echo(f"Deleted {delete_unused_images(grace_seconds)} unused images")
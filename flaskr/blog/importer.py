@@ -0,0 +1,225 @@
+"""
+Bulk import of posts from JSONL or CSV
+
+Each record has the fields author (a username), title, body, and optionally
+tags (a list in JSONL, comma separated in CSV), created (ISO 8601, UTC if
+naive) and image (a path relative to the source file).
+
+Records are inserted in batches, one transaction per batch, with ids
+allocated up front so that posts and their tags go in with executemany.
+The number of records committed for a source is saved in the same
+transaction, so a failed import resumes after the last committed batch.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import click
+from flask.cli import with_appcontext
+
+from ..db import get_db, get_writer, to_utc_micros
+from .images import get_image_store
+from .render import get_render_version, render_body
+
+
+def read_records(path, format=None):
+    """Yield the records in path as dicts, with tags as a list"""
+    if format is None:
+        format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    with open(path, newline="" if format == "csv" else None, encoding="utf8") as fd:
+        if format == "csv":
+            for record in csv.DictReader(fd):
+                tags = record.get("tags") or ""
+                record["tags"] = [tag.strip() for tag in tags.split(",")]
+                yield record
+        else:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_created(created):
+    if not created:
+        return to_utc_micros(datetime.now(timezone.utc))
+    if created.endswith("Z"):
+        created = created[:-1] + "+00:00"
+    return to_utc_micros(datetime.fromisoformat(created))
+
+
+def _next_id(db, table):
+    """Return the next id AUTOINCREMENT would assign in table"""
+    row = db.execute(
+        "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),"
+        f" COALESCE((SELECT MAX(id) FROM {table}), 0)) + 1",
+        (table,),
+    ).fetchone()
+    return row[0]
+
+
+def _import_batch(db, source, records_done, posts, known_tag_ids):
+    """
+    Insert posts, given as (author_id, title, body, created, image_hash,
+    image_size, image_type, image_width, image_height, body_html,
+    summary_html, render_version, tags)
+
+    known_tag_ids maps tag names to ids. Return the ids of the new tags.
+    """
+    # Not updated in place: the writer may roll back and run the job again
+    tag_ids = dict(known_tag_ids)
+    new_tags = {tag for post in posts for tag in post[-1] if tag not in tag_ids}
+    if new_tags:
+        next_tag_id = _next_id(db, "tag")
+        new_tags = sorted(new_tags)
+        db.executemany(
+            "INSERT OR IGNORE INTO tag (id, name) VALUES (?, ?)",
+            enumerate(new_tags, next_tag_id),
+        )
+        # Another process may have created some of the tags meanwhile
+        for start in range(0, len(new_tags), 500):
+            chunk = new_tags[start : start + 500]
+            tag_ids.update(
+                db.execute(
+                    "SELECT name, id FROM tag WHERE name IN"
+                    f" ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            )
+    next_post_id = _next_id(db, "post")
+    db.executemany(
+        "INSERT INTO post (id, author_id, title, body, created,"
+        " image_hash, image_size, image_type, image_width, image_height,"
+        " body_html, summary_html, render_version)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((post_id,) + post[:-1] for post_id, post in enumerate(posts, next_post_id)),
+    )
+    db.executemany(
+        "INSERT INTO post_tag (post_id, tag_id) VALUES (?, ?)",
+        (
+            (post_id, tag_ids[tag])
+            for post_id, post in enumerate(posts, next_post_id)
+            for tag in post[-1]
+        ),
+    )
+    db.execute(
+        "INSERT INTO import_progress (source, records) VALUES (?, ?)"
+        " ON CONFLICT (source) DO UPDATE SET records = excluded.records",
+        (source, records_done),
+    )
+    return {tag: tag_ids[tag] for tag in new_tags}
+
+
+def read_batches(path, format, skip, batch_size, author_ids, store):
+    """
+    Yield (number of the last record, posts) for the records after skip
+
+    Images are written to store as they are read, and bodies rendered, so
+    that listings need not render the imported posts.
+    """
+    image_directory = os.path.dirname(path)
+    render_version = get_render_version()
+    posts = []
+    for number, record in enumerate(read_records(path, format), 1):
+        if number <= skip:
+            continue
+        try:
+            author_id = author_ids[record["author"]]
+        except KeyError:
+            raise click.ClickException(
+                f"Record {number}: unknown author {record['author']!r}"
+            )
+        image = (None,) * 5
+        if record.get("image"):
+            with open(os.path.join(image_directory, record["image"]), "rb") as fd:
+                image = store.put_file(fd)
+        tags = tuple(dict.fromkeys(tag for tag in record.get("tags") or () if tag))
+        posts.append(
+            (
+                author_id,
+                record["title"],
+                record["body"],
+                parse_created(record.get("created")),
+                *image,
+                *render_body(record["body"]),
+                render_version,
+                tags,
+            )
+        )
+        if len(posts) == batch_size:
+            yield number, posts
+            posts = []
+    if posts:
+        yield number, posts
+
+
+def import_posts(path, format=None, batch_size=5000, restart=False, echo=print):
+    """
+    Import the posts in path, return the number of records imported
+
+    The next batch is parsed while the writer inserts the previous one.
+    """
+    db = get_db()
+    source = os.path.abspath(path)
+    if restart:
+        skip = 0
+    else:
+        row = db.execute(
+            "SELECT records FROM import_progress WHERE source = ?", (source,)
+        ).fetchone()
+        skip = row[0] if row is not None else 0
+        if skip:
+            echo(f"Resuming after {skip} records")
+    author_ids = dict(db.execute("SELECT username, id FROM user").fetchall())
+    tag_ids = dict(db.execute("SELECT name, id FROM tag").fetchall())
+    writer = get_writer()
+    imported = 0
+    start = time.monotonic()
+
+    def wait_for(pending):
+        nonlocal imported
+        future, number, count = pending
+        tag_ids.update(future.result())
+        imported += count
+        rate = imported / (time.monotonic() - start)
+        echo(f"Imported {number} records ({rate:.0f} posts/s)")
+
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            for number, posts in read_batches(
+                source, format, skip, batch_size, author_ids, get_image_store()
+            ):
+                if pending is not None:
+                    previous, pending = pending, None
+                    wait_for(previous)
+                future = executor.submit(
+                    writer.submit, _import_batch, source, number, posts, tag_ids
+                )
+                pending = future, number, len(posts)
+        finally:
+            # Also on errors, so that the progress reported is what was committed
+            if pending is not None:
+                wait_for(pending)
+    elapsed = time.monotonic() - start
+    echo(
+        f"Imported {imported} posts in {elapsed:.1f} s"
+        f" ({imported / max(elapsed, 1e-9):.0f} posts/s)"
+    )
+    return imported
+
+
+@click.command("import-posts")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format", type=click.Choice(["jsonl", "csv"]), help="Default: by extension"
+)
+@click.option(
+    "--batch-size", default=5000, show_default=True, help="Posts per transaction"
+)
+@click.option("--restart", is_flag=True, help="Ignore the progress of a previous run")
+@with_appcontext
+def import_posts_command(path, format, batch_size, restart):
+    """Import posts from a JSONL or CSV file"""
+    import_posts(path, format, batch_size, restart, echo=click.echo)
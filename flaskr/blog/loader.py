@@ -0,0 +1,75 @@
+"""
+Batched loading of what pages show next to each post
+
+Given the ids of the posts on a page, load_post_details fetches their tags,
+whether the current user liked them and their number of comments, with one
+query per relation however many posts there are. The ids are passed as one
+JSON array, so each query has the same SQL text, and query plan, for every
+page size. Like counts need no query: they are stored in post.likes.
+"""
+import json
+from collections import defaultdict
+
+from ..db import get_db
+
+
+def load_tags(db, post_ids):
+    """Return {post id: [tag names, sorted]}"""
+    tags = defaultdict(list)
+    for post_id, name in db.execute(
+        "SELECT post_tag.post_id, tag.name FROM post_tag"
+        " JOIN tag ON tag.id == post_tag.tag_id"
+        " WHERE post_tag.post_id IN (SELECT value FROM json_each(?))"
+        " ORDER BY tag.name",
+        (json.dumps(post_ids),),
+    ):
+        tags[post_id].append(name)
+    return tags
+
+
+def load_liked(db, post_ids, user_id):
+    """Return the set of ids of the posts liked by user_id"""
+    if user_id is None:
+        return set()
+    return {
+        row[0]
+        for row in db.execute(
+            "SELECT post_id FROM like"
+            " WHERE post_id IN (SELECT value FROM json_each(?)) AND user_id == ?",
+            (json.dumps(post_ids), user_id),
+        )
+    }
+
+
+def load_comment_counts(db, post_ids):
+    """Return {post id: number of comments}, without the posts with none"""
+    return dict(
+        db.execute(
+            "SELECT post_id, COUNT(*) FROM comment"
+            " WHERE post_id IN (SELECT value FROM json_each(?))"
+            " GROUP BY post_id",
+            (json.dumps(post_ids),),
+        ).fetchall()
+    )
+
+
+def load_post_details(post_ids, user_id=None):
+    """
+    Return {post id: {"tags": list, "liked": bool, "comments": int}} for each
+    of post_ids, liked by user_id if given
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return {}
+    db = get_db()
+    tags = load_tags(db, post_ids)
+    liked = load_liked(db, post_ids, user_id)
+    comments = load_comment_counts(db, post_ids)
+    return {
+        post_id: {
+            "tags": tags.get(post_id, []),
+            "liked": post_id in liked,
+            "comments": comments.get(post_id, 0),
+        }
+        for post_id in post_ids
+    }
@@ -0,0 +1,286 @@
+"""
+Post bodies rendered to sanitized HTML when they are written
+
+create_post and update_post store the HTML of the body and of its summary
+in post.body_html and post.summary_html, stamped with the renderer version
+in post.render_version. The version covers the code (RENDERER_VERSION) and
+the settings that change the output, so changing either makes the stored
+HTML stale. Stale or missing HTML is rendered again when a page shows the
+post, and saved once the view has returned.
+
+Summaries are cut from the rendered HTML, at the end of a block or of a
+word, so they never break Markdown syntax or leave elements open. Listings
+select only summary_html, not the body.
+
+Rendering goes through the app's Renderer, which reuses its Markdown parser
+and bleach Cleaner and remembers recent results.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from html import escape
+from html.parser import HTMLParser
+
+from bleach import Cleaner
+from bleach.linkifier import LinkifyFilter
+from bleach.sanitizer import ALLOWED_TAGS
+from flask import after_this_request, current_app, g, has_request_context
+from markdown import Markdown
+from markupsafe import Markup
+
+from .. import metrics
+from ..db import get_db, write
+
+# Increase when a change to the rendering code changes its output
+RENDERER_VERSION = 2
+
+# Appended to summaries of longer posts
+MORE = "[...]"
+VOID_TAGS = {"br", "hr", "img", "input", "wbr"}
+
+render_cache_counter = metrics.counter(
+    "flaskr_render_cache_total", "Lookups in the rendered Markdown cache", "result"
+)
+
+
+class Renderer:
+    """
+    Markdown to sanitized HTML, with the parser and cleaner built only once
+
+    Markdown and Cleaner instances keep state between calls and are not
+    thread-safe, so each thread gets its own. Results are kept in an LRU
+    cache of cache_size entries, keyed by the SHA-256 of the Markdown, with
+    counts of hits, misses and evictions.
+    """
+
+    def __init__(self, extensions=(), tags=None, cache_size=1024):
+        self.extensions = list(extensions)
+        self.tags = list(ALLOWED_TAGS) + ["p"] if tags is None else list(tags)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def settings(self):
+        """Arguments to create a Renderer with the same output, e.g. elsewhere"""
+        return {"extensions": self.extensions, "tags": self.tags}
+
+    @property
+    def settings_hash(self):
+        text = repr(sorted(self.extensions)) + repr(sorted(self.tags))
+        return hashlib.sha256(text.encode()).hexdigest()[:8]
+
+    def _tools(self):
+        local = self._local
+        if not hasattr(local, "markdown"):
+            local.markdown = Markdown(extensions=self.extensions)
+            local.cleaner = Cleaner(tags=self.tags, filters=[LinkifyFilter])
+        return local.markdown, local.cleaner
+
+    def render(self, markdown):
+        """Return the sanitized HTML of markdown, as a str"""
+        key = hashlib.sha256(markdown.encode()).digest()
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                render_cache_counter.inc("hit")
+                return html
+        parser, cleaner = self._tools()
+        html = cleaner.clean(parser.reset().convert(markdown))
+        with self._lock:
+            self.misses += 1
+            render_cache_counter.inc("miss")
+            self._cache[key] = html
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+                render_cache_counter.inc("eviction")
+        return html
+
+    def stats(self):
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def create_renderer(config):
+    # Values may come as strings from FLASKR_* environment variables
+    return Renderer(
+        extensions=config["MARKDOWN_EXTENSIONS"],
+        tags=config["ALLOWED_HTML_TAGS"],
+        cache_size=int(config["RENDER_CACHE_SIZE"]),
+    )
+
+
+def get_renderer():
+    return current_app.extensions["flaskr_renderer"]
+
+
+def render_sanitize_markdown(markdown_markup):
+    """Template filter rendering Markdown to sanitized HTML"""
+    return Markup(get_renderer().render(markdown_markup))
+
+
+class _Summarizer(HTMLParser):
+    """Copy sanitized HTML up to a length of text, see summarize_html"""
+
+    def __init__(self, max_length):
+        super().__init__(convert_charrefs=True)
+        self.max_length = max_length
+        self.length = 0
+        self.output = []
+        self.open_tags = []
+        # Output and text length at the end of the last top-level element
+        self.block_end = (0, 0)
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if not self.done and self.length >= self.max_length:
+            # No room left for the text of this element
+            self._truncate("")
+        if not self.done:
+            self.output.append(self.get_starttag_text())
+            if tag not in VOID_TAGS:
+                self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.done:
+            self.output.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self.done or tag not in self.open_tags:
+            return
+        while self.open_tags:
+            self.output.append(f"</{self.open_tags.pop()}>")
+            if self.output[-1] == f"</{tag}>":
+                break
+        if not self.open_tags:
+            self.block_end = (len(self.output), self.length)
+
+    def handle_data(self, data):
+        if self.done:
+            return
+        remaining = self.max_length - self.length
+        if len(data) <= remaining:
+            self.output.append(escape(data, quote=False))
+            self.length += len(data)
+            return
+        cut = data[:remaining]
+        if not data[remaining].isspace() and re.search(r"\s", cut):
+            # Do not cut through a word, unless it is the only one
+            cut = re.split(r"\s+(?=\S*$)", cut)[0]
+        self._truncate(cut)
+
+    def _truncate(self, cut):
+        self.done = True
+        output_end, length = self.block_end
+        if length >= self.max_length // 2:
+            # Enough in the complete blocks so far, drop the rest
+            del self.output[output_end:]
+            self.open_tags.clear()
+            self.output.append(f"<p>{MORE}</p>")
+            return
+        self.output.append(escape(cut.rstrip(), quote=False) + MORE)
+
+    def summary(self):
+        self.close()
+        return "".join(self.output + [f"</{tag}>" for tag in reversed(self.open_tags)])
+
+
+def summarize_html(html, max_length):
+    """
+    Return the start of html with at most max_length characters of text
+
+    Whole top-level blocks are kept if they hold at least half of that,
+    otherwise the text is cut after a word. The elements left open are
+    closed, so the summary is valid HTML on its own.
+    """
+    summarizer = _Summarizer(max_length)
+    summarizer.feed(html)
+    return summarizer.summary()
+
+
+def get_render_version():
+    return (
+        f"{RENDERER_VERSION}.{get_renderer().settings_hash}"
+        f".{current_app.config['SUMMARY_LENGTH']}"
+    )
+
+
+def render_body(body, renderer=None, summary_length=None):
+    """Return (body_html, summary_html) for a post body in Markdown"""
+    if renderer is None:
+        renderer = get_renderer()
+    if summary_length is None:
+        summary_length = current_app.config["SUMMARY_LENGTH"]
+    body_html = renderer.render(body)
+    return body_html, summarize_html(body_html, summary_length)
+
+
+def get_rendered_fields(body):
+    """Return the body_html, summary_html and render_version columns for body"""
+    body_html, summary_html = render_body(body)
+    return {
+        "body_html": body_html,
+        "summary_html": summary_html,
+        "render_version": get_render_version(),
+    }
+
+
+def _get_body(post_id):
+    return (
+        get_db()
+        .execute("SELECT body FROM post WHERE id == ?", (post_id,))
+        .fetchone()[0]
+    )
+
+
+def _save_rendered(db, rows):
+    # Unless the post was edited since: its new HTML is already stored
+    db.executemany(
+        "UPDATE post SET body_html = ?, summary_html = ?, render_version = ?"
+        " WHERE id == ? AND body == ?",
+        rows,
+    )
+
+
+def _save_stale_posts(response):
+    rows = g.pop("rendered_posts", [])
+    try:
+        write(_save_rendered, rows)
+    except sqlite3.Error as e:
+        # The page is fine, the next view will render the posts again
+        current_app.logger.warning("Could not save rendered posts: %s", e)
+    return response
+
+
+def post_html(post, single_post=False):
+    """
+    Template filter returning the HTML of post, in full or summarized
+
+    Uses the stored HTML when it is up to date, otherwise renders the body
+    and saves the result after the request.
+    """
+    version = get_render_version()
+    if post.get("render_version") == version:
+        return Markup(post["body_html"] if single_post else post["summary_html"])
+    # Listings do not select the body
+    body = post["body"] if "body" in post else _get_body(post["id"])
+    body_html, summary_html = render_body(body)
+    if has_request_context():
+        if "rendered_posts" not in g:
+            g.rendered_posts = []
+            after_this_request(_save_stale_posts)
+        g.rendered_posts.append((body_html, summary_html, version, post["id"], body))
+    return Markup(body_html if single_post else summary_html)
@@ -0,0 +1,122 @@
+"""
+Rendering the stored HTML of all stale posts at once
+
+After a change of the renderer or its settings, every post has stale HTML
+until it is shown again. flask rerender-posts renders them ahead of time:
+ids and bodies are read in chunks by increasing id, rendered in a pool of
+processes with the app's renderer settings, and saved one transaction per
+chunk. Only posts whose render_version is not the current one are read,
+so an interrupted run resumes where it stopped when run again.
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from ..db import get_db, to_utc_micros, write
+from .render import (
+    Renderer,
+    _save_rendered,
+    get_render_version,
+    get_renderer,
+    render_body,
+)
+
+# Renderer of a worker process, created by _init_worker
+_renderer = None
+_summary_length = None
+
+
+def _init_worker(settings, summary_length):
+    global _renderer, _summary_length
+    # No cache: each body is rendered once
+    _renderer = Renderer(cache_size=0, **settings)
+    _summary_length = summary_length
+
+
+def _render_chunk(posts):
+    """Return (body_html, summary_html, id, body) for (id, body) pairs"""
+    return [
+        render_body(body, _renderer, _summary_length) + (post_id, body)
+        for post_id, body in posts
+    ]
+
+
+def read_stale_chunks(db, version, since, chunk_size):
+    """Yield lists of (id, body) of the posts with stale HTML, by id"""
+    last_id = -1
+    while True:
+        chunk = db.execute(
+            "SELECT id, body FROM post"
+            " WHERE id > ? AND created >= ? AND render_version IS NOT ?"
+            " ORDER BY id LIMIT ?",
+            (last_id, since, version, chunk_size),
+        ).fetchall()
+        if not chunk:
+            return
+        last_id = chunk[-1][0]
+        yield [tuple(post) for post in chunk]
+
+
+def rerender_posts(since=None, chunk_size=500, workers=None, echo=print):
+    """Render and save the HTML of the stale posts, return how many"""
+    version = get_render_version()
+    settings = get_renderer().settings
+    summary_length = current_app.config["SUMMARY_LENGTH"]
+    since = to_utc_micros(since) if since is not None else 0
+    workers = workers or os.cpu_count() or 1
+    chunks = read_stale_chunks(get_db(), version, since, chunk_size)
+    rendered = 0
+    start = time.monotonic()
+
+    def save(future):
+        nonlocal rendered
+        rows = [
+            (body_html, summary_html, version, post_id, body)
+            for body_html, summary_html, post_id, body in future.result()
+        ]
+        write(_save_rendered, rows)
+        rendered += len(rows)
+        rate = rendered / (time.monotonic() - start)
+        echo(f"Rendered {rendered} posts, up to id {rows[-1][3]} ({rate:.0f} posts/s)")
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(settings, summary_length),
+    ) as executor:
+        # Enough chunks in flight to keep the workers busy, not the archive
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_render_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                save(pending.popleft())
+        while pending:
+            save(pending.popleft())
+    elapsed = time.monotonic() - start
+    echo(
+        f"Rendered {rendered} posts in {elapsed:.1f} s"
+        f" ({rendered / max(elapsed, 1e-9):.0f} posts/s)"
+    )
+    return rendered
+
+
+@click.command("rerender-posts")
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    help="Only posts created from this date (UTC)",
+)
+@click.option("--chunk-size", default=500, show_default=True, help="Posts per chunk")
+@click.option("--workers", type=int, help="Worker processes  [default: number of CPUs]")
+@with_appcontext
+def rerender_posts_command(since, chunk_size, workers):
+    """Render the HTML of the posts rendered with other settings or never"""
+    if since is not None:
+        since = since.replace(tzinfo=timezone.utc)
+    rerender_posts(since, chunk_size, workers, echo=click.echo)
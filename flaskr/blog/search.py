@@ -0,0 +1,100 @@
+"""
+Full-text search of posts with the FTS5 index post_fts
+
+Queries are words, matched in full, or as prefixes when ending with *, and
+"quoted phrases". All of them must match. Results are ranked with bm25,
+where a match in the title weighs more than one in the body.
+"""
+import re
+
+import click
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+
+from ..db import get_db
+from .blogdb import page_size
+
+# Weights of the title and body columns for bm25
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+# Control characters around the matches in snippets, replaced by <mark> after
+# escaping the rest of the snippet
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+SNIPPET_TOKENS = 24
+
+_terms = re.compile(r'"([^"]*)"?|(\S+)')
+
+
+def build_match_query(searchquery):
+    """
+    Return the FTS5 query for a search from the search box
+
+    Everything is quoted, so FTS5 operators and syntax errors from the input
+    are impossible.
+    """
+    terms = []
+    for phrase, word in _terms.findall(searchquery):
+        if phrase:
+            terms.append(f'"{phrase}"')
+        elif word:
+            prefix = word.endswith("*")
+            word = word.rstrip("*").replace('"', "")
+            if word:
+                terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search_posts(searchquery, page=1):
+    """Return (count, posts) for the given page of results, best first"""
+    query = build_match_query(searchquery)
+    if not query:
+        return 0, []
+    db = get_db()
+    posts = db.execute(
+        "SELECT post.id, post.title, created, author_id, username,"
+        " has_image, image_hash, image_width, likes,"
+        " snippet(post_fts, -1, :start, :end, '…', :tokens) AS snippet"
+        " FROM post_fts JOIN posts_view post ON post.id == post_fts.rowid"
+        " WHERE post_fts MATCH :query"
+        " ORDER BY bm25(post_fts, :title_weight, :body_weight)"
+        " LIMIT :page_size OFFSET :offset",
+        {
+            "query": query,
+            "start": MATCH_START,
+            "end": MATCH_END,
+            "tokens": SNIPPET_TOKENS,
+            "title_weight": TITLE_WEIGHT,
+            "body_weight": BODY_WEIGHT,
+            "page_size": page_size,
+            "offset": page_size * (page - 1),
+        },
+    ).fetchall()
+    count = db.execute(
+        "SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH ?", (query,)
+    ).fetchone()[0]
+    return count, posts
+
+
+def highlight_snippet(snippet):
+    """Escape a snippet and mark its matches"""
+    return Markup(
+        str(escape(snippet))
+        .replace(MATCH_START, "<mark>")
+        .replace(MATCH_END, "</mark>")
+    )
+
+
+def rebuild_search_index(db):
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('optimize')")
+    db.commit()
+
+
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the full-text index of posts from scratch"""
+    # Not through the writer: rebuilding a big index can outlast WRITE_TIMEOUT
+    rebuild_search_index(get_db())
+    click.echo("Rebuilt the search index")
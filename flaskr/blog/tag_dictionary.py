@@ -0,0 +1,109 @@
+"""
+Per-process dictionary of tag names and ids, for lookups and autocompletion
+
+Tag names never change once inserted, and tag ids are never reused
+(AUTOINCREMENT), so the set of tags only changes when a row is inserted or
+deleted. The dictionary keeps its own connection and checks PRAGMA
+data_version, which changes whenever another connection (this process's
+writer, or another process) commits. Only then does it compare the tag
+count and the last tag id with the ones it was loaded with, and reload all
+tags if they differ. A lookup therefore costs one PRAGMA, without reading
+any table, as long as nothing was written.
+"""
+import sqlite3
+import threading
+from bisect import bisect_left
+from urllib.request import pathname2url
+
+from flask import current_app, jsonify, request
+
+from .blueprint import bp
+
+SUGGESTIONS = 10
+
+
+class TagDictionary:
+    """Names to ids of all tags, and the names sorted for prefix search"""
+
+    def __init__(self, database):
+        self.database = database
+        self.reloads = 0
+        self._db = None
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._signature = None
+        self._ids = {}
+        self._names = []
+
+    def _connect(self):
+        # Not a traced connection: this is not SQL of the current request
+        return sqlite3.connect(
+            "file:" + pathname2url(self.database) + "?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+
+    def _refresh(self):
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+            db = self._db
+            data_version = db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            # Tags and their signature from the same snapshot
+            db.execute("BEGIN")
+            try:
+                signature = db.execute("SELECT COUNT(*), MAX(id) FROM tag").fetchone()
+                if signature != self._signature:
+                    rows = db.execute("SELECT name, id FROM tag").fetchall()
+                    self._ids = dict(rows)
+                    self._names = sorted(self._ids)
+                    self._signature = signature
+                    self.reloads += 1
+            finally:
+                db.execute("COMMIT")
+            self._data_version = data_version
+
+    def get_id(self, name):
+        """Return the id of the tag name, or None if there is no such tag"""
+        self._refresh()
+        return self._ids.get(name)
+
+    def get_ids(self, names):
+        """Return a dict of the ids of the existing tags among names"""
+        self._refresh()
+        ids = self._ids
+        return {name: ids[name] for name in names if name in ids}
+
+    def suggest(self, prefix, limit=SUGGESTIONS):
+        """Return up to limit tag names starting with prefix, sorted"""
+        self._refresh()
+        names = self._names
+        start = bisect_left(names, prefix)
+        suggestions = []
+        for name in names[start : start + limit]:
+            if not name.startswith(prefix):
+                break
+            suggestions.append(name)
+        return suggestions
+
+
+def get_tag_dictionary():
+    """Return the tag dictionary of the app's database, creating it if needed"""
+    dictionaries = current_app.extensions.setdefault("flaskr_tags", {})
+    database = current_app.config["DATABASE"]
+    dictionary = dictionaries.get(database)
+    if dictionary is None:
+        dictionary = dictionaries.setdefault(database, TagDictionary(database))
+    return dictionary
+
+
+@bp.route("/tags/suggest")
+def suggest_tags():
+    """Names of the tags starting with the prefix argument, as a JSON list"""
+    prefix = request.args.get("prefix", "").strip()
+    if not prefix:
+        return jsonify([])
+    return jsonify(get_tag_dictionary().suggest(prefix))
@@ -0,0 +1,170 @@
+"""
+Downscaled copies of post images, so that listings fetch thumbnails
+
+The variants of an image are WebP files VARIANT_WIDTHS pixels wide, for
+each of the widths narrower than the image, stored next to it by the
+ImageStore. They are made in a pool of threads of the app's
+VariantGenerator: when an image is uploaded, and otherwise when a page
+first asks for a variant that is missing, the original being sent
+meanwhile. Pillow releases the GIL while decoding, resizing and encoding,
+so the threads do not hold up the requests.
+
+post.image_width and image_height are the dimensions of the image as
+displayed, after its EXIF orientation. They are only known for still
+images Pillow can read: animated ones would lose all frames but one and
+get no variants. Pillow is optional, without it there are no variants and
+pages use the originals.
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+VARIANT_TYPE = "image/webp"
+
+# Values of the EXIF Orientation tag for images turned a quarter
+_ORIENTATION = 0x0112
+_TRANSPOSED = {5, 6, 7, 8}
+
+
+def variants_available():
+    """Whether Pillow is installed, with WebP support"""
+    return Image is not None and features.check("webp")
+
+
+def image_dimensions(file):
+    """
+    Return (width, height) of a still image in a binary file, (None, None)
+    if unknown
+    """
+    if Image is None:
+        return None, None
+    try:
+        # Only the header is read
+        with Image.open(file) as image:
+            if getattr(image, "is_animated", False):
+                return None, None
+            width, height = image.size
+            if image.getexif().get(_ORIENTATION) in _TRANSPOSED:
+                width, height = height, width
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None, None
+    return width, height
+
+
+def make_variants(file, widths, quality=80):
+    """
+    Return {width: WebP bytes} for the widths narrower than the image in a
+    binary file
+    """
+    with Image.open(file) as image:
+        # Largest first, each resized from the previous one
+        widths = sorted((w for w in widths if w < max(image.size)), reverse=True)
+        if not widths:
+            return {}
+        # JPEG images are decoded at a reduced scale when large enough
+        image.draft("RGB", (widths[0], widths[0]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            transparent = "transparency" in image.info or "A" in image.mode
+            image = image.convert("RGBA" if transparent else "RGB")
+        variants = {}
+        for width in widths:
+            if width >= image.width:
+                continue
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            output = io.BytesIO()
+            image.save(output, "WEBP", quality=quality)
+            variants[width] = output.getvalue()
+    return variants
+
+
+class VariantGenerator:
+    """
+    Makes the missing variants of stored images in a pool of threads
+
+    The pool is started on first use. An image is queued once at a time,
+    however many requests ask for it meanwhile.
+    """
+
+    def __init__(self, store, widths, quality=80, workers=2, logger=None):
+        self.store = store
+        self.widths = sorted(widths) if variants_available() else []
+        self.quality = quality
+        self.workers = workers
+        self.logger = logger
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def widths_for(self, image_width):
+        """Widths of the variants of an image image_width pixels wide"""
+        if image_width is None:
+            return []
+        return [width for width in self.widths if width < image_width]
+
+    def submit(self, image_hash):
+        """Queue making the variants of an image, return a Future of their widths"""
+        with self._lock:
+            future = self._pending.get(image_hash)
+            if future is not None:
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="flaskr-image-variants"
+                )
+            future = self._executor.submit(self._generate, image_hash)
+            self._pending[image_hash] = future
+        # Outside the lock: run at once if already done
+        future.add_done_callback(lambda _: self._done(image_hash))
+        return future
+
+    def _done(self, image_hash):
+        with self._lock:
+            self._pending.pop(image_hash, None)
+
+    def _generate(self, image_hash):
+        missing = [
+            width
+            for width in self.widths
+            if not os.path.exists(self.store.variant_path(image_hash, width))
+        ]
+        if not missing:
+            return []
+        try:
+            with open(self.store.path(image_hash), "rb") as fd:
+                variants = make_variants(fd, missing, self.quality)
+            for width, data in variants.items():
+                self.store.put_variant(image_hash, width, data)
+        except Exception:
+            if self.logger is not None:
+                self.logger.exception("Could not make variants of %s", image_hash)
+            return []
+        return sorted(variants)
+
+
+def create_variant_generator(config, store, logger=None):
+    # Values may come as strings from FLASKR_* environment variables
+    widths = config["IMAGE_VARIANT_WIDTHS"]
+    if isinstance(widths, str):
+        # As given in FLASKR_IMAGE_VARIANT_WIDTHS, e.g. "320,640,1280"
+        widths = [width for width in widths.split(",") if width.strip()]
+    return VariantGenerator(
+        store,
+        [int(width) for width in widths],
+        quality=int(config["IMAGE_VARIANT_QUALITY"]),
+        workers=int(config["IMAGE_VARIANT_WORKERS"]),
+        logger=logger,
+    )
+
+
+def get_variant_generator():
+    return current_app.extensions["flaskr_image_variants"]
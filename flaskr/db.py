@@ -1,10 +1,27 @@
+import atexit
+import queue
 import sqlite3
-from datetime import datetime, timezone
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from urllib.request import pathname2url
 
 import click
-from flask import current_app, g
+from flask import current_app, g, request
 from flask.cli import with_appcontext
 
+from . import metrics
+from .tracing import (
+    TracedConnection,
+    TracedCursor,
+    finish_trace,
+    not_a_caller,
+    start_trace,
+)
+
 
 def parse_timestamp_utc(b):
     s = b.decode()
@@ -14,26 +31,505 @@ def parse_timestamp_utc(b):
     return ret
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_utc_micros(timestamp):
+    """Convert datetime to integer microseconds since the epoch. Naive is UTC"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_utc_micros(b):
+    return EPOCH + MICROSECOND * int(b)
+
+
+# Databases before migration 1 store timestamps as text
 sqlite3.register_converter("TIMESTAMP", parse_timestamp_utc)
+sqlite3.register_converter("UTCMICROS", from_utc_micros)
+sqlite3.register_adapter(datetime, to_utc_micros)
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """No pooled connection became available within DATABASE_POOL_TIMEOUT"""
+
+
+class WriteQueueFullError(sqlite3.OperationalError):
+    """The writer did not accept a job within WRITE_QUEUE_TIMEOUT"""
+
+
+class WriteTimeoutError(sqlite3.OperationalError):
+    """A job was not committed within WRITE_TIMEOUT"""
+
+
+class Record(tuple):
+    """
+    Row of a query result, readable by index, by column name and as attribute
+
+    Unlike sqlite3.Row it is a plain tuple, so it can be returned to views
+    and templates as-is instead of being copied into a dict. Compares equal
+    to a dict with the same columns and values.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if key.__class__ is str:
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return self._fields
+
+    def __contains__(self, key):
+        # Like a dict, so that templates can check for optional columns
+        return key in self._index
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def _extend(self, **fields):
+        """Return a copy with more columns"""
+        cls = record_class(self._fields + tuple(fields))
+        return cls(self + tuple(fields.values()))
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return self._asdict() == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return f"Record({self._asdict()!r})"
+
+
+_record_classes = {}
+
+
+def record_class(fields):
+    """Return the Record subclass for these column names"""
+    cls = _record_classes.get(fields)
+    if cls is None:
+        namespace = {
+            "__slots__": (),
+            "_fields": fields,
+            "_index": {field: index for index, field in enumerate(fields)},
+        }
+        for index, field in enumerate(fields):
+            if field.isidentifier() and not field.startswith("_"):
+                namespace[field] = property(itemgetter(index))
+        cls = _record_classes[fields] = type("Record", (Record,), namespace)
+        new = tuple.__new__
+        cls._row_factory = staticmethod(lambda cursor, row: new(cls, row))
+    return cls
+
+
+class Cursor(TracedCursor):
+    """Cursor returning rows as Records"""
+
+    @not_a_caller
+    def execute(self, sql, parameters=()):
+        super().execute(sql, parameters)
+        description = self.description
+        if description is not None:
+            fields = tuple(column[0] for column in description)
+            self.row_factory = record_class(fields)._row_factory
+        return self
+
+
+class Connection(TracedConnection):
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+
+def connect(database, pragmas, readonly=False, isolation_level=""):
+    if readonly:
+        database = "file:" + pathname2url(database) + "?mode=ro"
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+        uri=readonly,
+        isolation_level=isolation_level,
+        factory=Connection,
+    )
+    # For cursors that are not a Cursor, e.g. in executescript
+    db.row_factory = sqlite3.Row
+    for pragma, value in pragmas.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
+    return db
+
+
+class ConnectionPool:
+    """
+    Per-process pool of warm, pre-tuned connections to a single database
+
+    Connections are handed out most-recently-used first so that the one with
+    the hottest page cache is reused. At most `size` connections exist at any
+    time; borrowers wait up to `timeout` seconds for one to be returned.
+    """
+
+    def __init__(self, database, size, timeout, pragmas, readonly=False):
+        self.database = database
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.readonly = readonly
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        return connect(self.database, self.pragmas, self.readonly)
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError(f"No connection to {self.database} available")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            # Broken connection, let the pool open a fresh one next time
+            db.close()
+        else:
+            self._idle.put(db)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+batch_size_histogram = metrics.histogram(
+    "flaskr_write_batch_size",
+    "Number of writes committed together in one transaction",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128],
+)
+
+
+class Writer:
+    """
+    Dedicated thread owning the only connection that modifies the database
+
+    Jobs are functions taking that connection as first argument. They run one
+    at a time so writers never contend for the SQLite lock and readers never
+    wait on them. At most `queue_size` jobs may be waiting; submitters block up
+    to `timeout` seconds for room in the queue and up to `result_timeout`
+    seconds for the job to be committed.
+
+    Jobs are group-committed: after picking up a job the writer waits up to
+    `batch_delay` seconds for more, up to `batch_size` in total, and commits
+    them all in a single transaction. Each job runs in its own savepoint so a
+    failing job is rolled back and gets its exception without affecting the
+    others.
+    """
+
+    def __init__(
+        self,
+        database,
+        pragmas,
+        queue_size,
+        timeout,
+        result_timeout=None,
+        batch_size=1,
+        batch_delay=0,
+    ):
+        self.database = database
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self.result_timeout = result_timeout
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name=f"flaskr writer {database}", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, job, *args, **kwargs):
+        """Run job(db, *args, **kwargs) on the writer and return its result"""
+        future = Future()
+        try:
+            self._jobs.put((future, job, args, kwargs), timeout=self.timeout)
+        except queue.Full:
+            raise WriteQueueFullError(f"Too many pending writes to {self.database}")
+        try:
+            return future.result(timeout=self.result_timeout)
+        except FutureTimeoutError:
+            # Skip the job if the writer has not started it yet
+            future.cancel()
+            raise WriteTimeoutError(f"Write to {self.database} timed out")
+
+    def _next_batch(self):
+        """Wait for a job and collect the ones arriving shortly after it"""
+        batch = [self._jobs.get()]
+        deadline = time.monotonic() + self.batch_delay
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(
+                    self._jobs.get(timeout=max(0, deadline - time.monotonic()))
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        db = None
+        running = True
+        while running:
+            batch = self._next_batch()
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            # Drop jobs whose submitters gave up waiting
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                if db is None:
+                    # Autocommit mode, transactions and savepoints are explicit
+                    db = connect(self.database, self.pragmas, isolation_level=None)
+                self._run_batch(db, batch)
+            except BaseException as e:
+                # E.g. the database is locked by another process. Fail this
+                # batch but keep the writer alive for the next one
+                for future, *_ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                db = self._recover(db)
+            batch_size_histogram.observe(len(batch))
+        if db is not None:
+            db.close()
+
+    def _recover(self, db):
+        """Roll back what a failed batch left behind, or drop a broken connection"""
+        if db is None:
+            return None
+        try:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+        except sqlite3.Error:
+            db.close()
+            return None
+        return db
+
+    def _run_batch(self, db, batch):
+        succeeded = []
+        db.execute("BEGIN IMMEDIATE")
+        for index, item in enumerate(batch):
+            future, job, args, kwargs = item
+            db.execute("SAVEPOINT job")
+            try:
+                result = job(db, *args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                if not db.in_transaction:
+                    # SQLite rolled back the whole transaction on this error,
+                    # redo the jobs that had succeeded along with the rest
+                    retry = [item for item, _ in succeeded] + batch[index + 1 :]
+                    if retry:
+                        self._run_batch(db, retry)
+                    return
+                db.execute("ROLLBACK TO job")
+                db.execute("RELEASE job")
+            else:
+                db.execute("RELEASE job")
+                succeeded.append((item, result))
+        try:
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            if len(batch) == 1:
+                raise
+            # Commit jobs one by one so that each gets its own result
+            for item, _ in succeeded:
+                try:
+                    self._run_batch(db, [item])
+                except BaseException as e:
+                    item[0].set_exception(e)
+                    if db.in_transaction:
+                        db.execute("ROLLBACK")
+            return
+        for (future, *_), result in succeeded:
+            future.set_result(result)
+
+    def close(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+
+_pools = {}
+_writers = {}
+_lock = threading.Lock()
+
+
+def get_pragmas(config):
+    # Values may come as strings from FLASKR_* environment variables
+    return {
+        "synchronous": "NORMAL",
+        "cache_size": int(config["DATABASE_CACHE_SIZE"]),
+        "mmap_size": int(config["DATABASE_MMAP_SIZE"]),
+        "busy_timeout": int(config["DATABASE_BUSY_TIMEOUT"]),
+    }
+
+
+def get_pool(config=None, readonly=False):
+    """Return the connection pool for the DATABASE in config, creating it if needed"""
+    if config is None:
+        config = current_app.config
+    database = config["DATABASE"]
+    with _lock:
+        pool = _pools.get((database, readonly))
+        if pool is None:
+            if readonly:
+                pragmas = {"query_only": 1, **get_pragmas(config)}
+            else:
+                pragmas = {"journal_mode": "WAL", **get_pragmas(config)}
+            pool = _pools[database, readonly] = ConnectionPool(
+                database,
+                size=int(config["DATABASE_POOL_SIZE"]),
+                timeout=float(config["DATABASE_POOL_TIMEOUT"]),
+                pragmas=pragmas,
+                readonly=readonly,
+            )
+    return pool
+
+
+def get_blob_pool(config=None):
+    """
+    Return the read-only pool of DATABASE_BLOB_POOL_SIZE connections for
+    streaming blobs, creating it if needed
+
+    A blob keeps its connection busy until the response is sent, so these
+    are kept apart from the connections of the requests.
+    """
+    if config is None:
+        config = current_app.config
+    database = config["DATABASE"]
+    with _lock:
+        pool = _pools.get((database, "blobs"))
+        if pool is None:
+            pool = _pools[database, "blobs"] = ConnectionPool(
+                database,
+                size=int(config["DATABASE_BLOB_POOL_SIZE"]),
+                timeout=float(config["DATABASE_POOL_TIMEOUT"]),
+                pragmas={"query_only": 1, **get_pragmas(config)},
+                readonly=True,
+            )
+    return pool
+
+
+def get_writer(config=None):
+    """Return the writer for the DATABASE in config, starting it if needed"""
+    if config is None:
+        config = current_app.config
+    database = config["DATABASE"]
+    with _lock:
+        writer = _writers.get(database)
+        if writer is None:
+            writer = _writers[database] = Writer(
+                database,
+                pragmas={"journal_mode": "WAL", **get_pragmas(config)},
+                queue_size=int(config["WRITE_QUEUE_SIZE"]),
+                timeout=float(config["WRITE_QUEUE_TIMEOUT"]),
+                result_timeout=float(config["WRITE_TIMEOUT"]),
+                batch_size=int(config["WRITE_BATCH_SIZE"]),
+                batch_delay=float(config["WRITE_BATCH_DELAY"]),
+            )
+    return writer
+
+
+def write(job, *args, **kwargs):
+    """Run job(db, *args, **kwargs) on the writer connection and wait until committed"""
+    return get_writer().submit(job, *args, **kwargs)
+
+
+def close_database(database):
+    """Stop the writer and close the pooled connections to database"""
+    with _lock:
+        pools = [_pools.pop(key) for key in list(_pools) if key[0] == database]
+        writer = _writers.pop(database, None)
+    if writer is not None:
+        writer.close()
+    for pool in pools:
+        pool.close()
+
+
+@atexit.register
+def close_all_databases():
+    for database in {database for database, _ in _pools} | set(_writers):
+        close_database(database)
 
 
 def get_db():
+    """
+    Return the connection for the current request
+
+    Requests with safe methods (GET, HEAD) get a read-only connection, anything
+    else a read-write one. Modifications should go through write() anyway.
+    """
+    if g.get("read_only"):
+        if "read_db" not in g:
+            g.read_db = get_pool(readonly=True).acquire()
+        return g.read_db
     if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
     return g.db
 
 
+def use_read_only_db():
+    if request.method in ("GET", "HEAD"):
+        g.read_only = True
+
+
+def close_read_db(e=None):
+    g.pop("read_only", None)
+    db = g.pop("read_db", None)
+    if db is not None:
+        get_pool(readonly=True).release(db)
+
+
 def close_db(e=None):
+    close_read_db()
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
 
 def init_db():
+    """Drop everything in the database and create the latest schema"""
     db = get_db()
+    objects = db.execute(
+        "SELECT type, name FROM sqlite_master"
+        " WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    for type_, name in objects:
+        db.execute(f"DROP {type_} IF EXISTS {name}")
     with current_app.open_resource("schema.sql") as fd:
         db.executescript(fd.read().decode("utf8"))
 
@@ -46,6 +542,30 @@ def init_db_command():
     click.echo("Initialized the database")
 
 
+@click.command("migrate")
+@click.option("--dry-run", is_flag=True, help="Only list the pending migrations")
+@with_appcontext
+def migrate_command(dry_run):
+    """Upgrade the database schema in place, without losing data"""
+    from .migrations import get_pending_migrations, migrate
+
+    db = get_db()
+    pending = get_pending_migrations(db)
+    if not pending:
+        click.echo("Database is up to date")
+        return
+    for migration in pending:
+        click.echo(f"Pending: {migration.version} {migration.name}")
+    if not dry_run:
+        migrate(db, echo=click.echo)
+        click.echo("Database is up to date")
+
+
 def init_app(app):
+    app.before_request(use_read_only_db)
+    app.before_request(start_trace)
+    app.teardown_request(finish_trace)
+    app.teardown_request(close_read_db)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
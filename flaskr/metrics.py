@@ -0,0 +1,100 @@
+import threading
+from bisect import bisect_left
+
+from flask import Blueprint, Response, abort, current_app, request
+
+bp = Blueprint("metrics", __name__)
+
+
+class Histogram:
+    """Cumulative histogram of observed values, in Prometheus style"""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Running totals for each value of one label, in Prometheus style"""
+
+    def __init__(self, name, description, label):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value, amount=1):
+        with self._lock:
+            self.totals[value] = self.totals.get(value, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            totals = sorted(self.totals.items())
+        for value, total in totals:
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {total}')
+        return "\n".join(lines)
+
+
+_metrics = {}
+_lock = threading.Lock()
+
+
+def histogram(name, description, buckets):
+    """Return the histogram with this name, creating it if needed"""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Histogram(name, description, buckets)
+        return _metrics[name]
+
+
+def counter(name, description, label):
+    """Return the counter with this name, creating it if needed"""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Counter(name, description, label)
+        return _metrics[name]
+
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in _metrics.values()) + "\n"
+
+
+@bp.route("/metrics")
+def metrics():
+    """Serve metrics to the monitoring hosts listed in METRICS_ALLOWED_IPS"""
+    allowed_ips = current_app.config["METRICS_ALLOWED_IPS"]
+    if isinstance(allowed_ips, str):
+        # As given in FLASKR_METRICS_ALLOWED_IPS
+        allowed_ips = allowed_ips.split(",")
+    if request.remote_addr not in allowed_ips:
+        abort(404)
+    return Response(render_metrics(), mimetype="text/plain")
@@ -0,0 +1,135 @@
+"""
+Versioned schema migrations
+
+Each module named mNNNN_description.py in this package upgrades the schema
+from version NNNN - 1 to NNNN, where the version of a database is kept in
+PRAGMA user_version. A module defines upgrade(db) and runs, by default, in
+a single transaction together with the version bump.
+
+Modules that would hold the write lock for too long on a big database set
+TRANSACTIONAL = False and use the helpers below, which commit in small
+chunks and can resume after an interruption. Their steps must be safe to
+repeat, since the version is only bumped once all of them completed.
+
+schema.sql always contains the latest schema, so every migration must be
+mirrored there.
+"""
+import importlib
+import pkgutil
+import re
+import time
+from collections import namedtuple
+
+Migration = namedtuple("Migration", ["version", "name", "module"])
+
+
+def get_migrations():
+    """Return all migrations sorted by version"""
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        match = re.fullmatch(r"m(\d{4})_(\w+)", module_info.name)
+        if match is None:
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        migrations.append(Migration(int(match[1]), match[2], module))
+    migrations.sort()
+    versions = [migration.version for migration in migrations]
+    assert versions == list(range(1, len(migrations) + 1)), versions
+    return migrations
+
+
+def get_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def get_pending_migrations(db):
+    version = get_version(db)
+    return [migration for migration in get_migrations() if migration.version > version]
+
+
+def migrate(db, echo=print):
+    """Apply pending migrations in order, return the new version"""
+    for migration in get_pending_migrations(db):
+        echo(f"Applying {migration.version} {migration.name}")
+        start = time.monotonic()
+        if getattr(migration.module, "TRANSACTIONAL", True):
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                migration.module.upgrade(db)
+                db.execute(f"PRAGMA user_version = {migration.version}")
+            except BaseException:
+                db.rollback()
+                raise
+            db.commit()
+        else:
+            migration.module.upgrade(db)
+            db.execute(f"PRAGMA user_version = {migration.version}")
+            db.commit()
+        echo(f"Applied {migration.version} in {time.monotonic() - start:.1f} s")
+    return get_version(db)
+
+
+def has_column(db, table, column):
+    return any(row[1] == column for row in db.execute(f"PRAGMA table_info({table})"))
+
+
+def add_column(db, table, column, declaration):
+    """Add a column unless it exists. Only cheap declarations: no rewrite happens"""
+    if not has_column(db, table, column):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        db.commit()
+
+
+def create_index(db, name, table, columns):
+    """
+    Create an index unless it exists
+
+    SQLite builds an index in one statement, so this holds the write lock for
+    the duration of the build. Readers are not blocked in WAL mode.
+    """
+    db.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    db.commit()
+
+
+def backfill(db, key, table, assignments, pending, chunk_size=1000, pause=0.05):
+    """
+    Run UPDATE table SET assignments WHERE pending, in chunks of rows
+
+    Each chunk is its own short transaction, followed by a pause so that the
+    application's writer gets the lock in between. Progress is saved under
+    `key` in the migration_progress table, so an interrupted backfill resumes
+    after the last completed chunk. Returns the number of updated rows.
+    """
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS migration_progress"
+        " (key TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL)"
+    )
+    row = db.execute(
+        "SELECT last_rowid FROM migration_progress WHERE key = ?", (key,)
+    ).fetchone()
+    last_rowid = row[0] if row is not None else -1
+    updated = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        chunk = db.execute(
+            f"SELECT rowid FROM {table} WHERE rowid > ? AND ({pending})"
+            " ORDER BY rowid LIMIT ?",
+            (last_rowid, chunk_size),
+        ).fetchall()
+        if not chunk:
+            db.execute("DELETE FROM migration_progress WHERE key = ?", (key,))
+            db.commit()
+            return updated
+        first_rowid, last_rowid = chunk[0][0], chunk[-1][0]
+        updated += db.execute(
+            f"UPDATE {table} SET {assignments}"
+            f" WHERE rowid BETWEEN ? AND ? AND ({pending})",
+            (first_rowid, last_rowid),
+        ).rowcount
+        db.execute(
+            "INSERT INTO migration_progress (key, last_rowid) VALUES (?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET last_rowid = excluded.last_rowid",
+            (key, last_rowid),
+        )
+        db.commit()
+        time.sleep(pause)
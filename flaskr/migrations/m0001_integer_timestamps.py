@@ -0,0 +1,64 @@
+"""
+Store timestamps as integer UTC microseconds instead of text
+
+SQLite cannot change the type of a column, so each table is copied into a
+new one with the new declaration, then its indexes are recreated. Views are
+dropped and recreated around the rebuild.
+"""
+from ..db import parse_timestamp_utc, to_utc_micros
+
+TEXT_TIMESTAMP_DECLARATION = "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+MICROS_TIMESTAMP_DECLARATION = (
+    "UTCMICROS INTEGER NOT NULL\n"
+    "        DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER))"
+)
+TIMESTAMP_COLUMNS = {
+    "user": "registration_time",
+    "post": "created",
+    "comment": "created",
+}
+
+
+def text_to_utc_micros(text):
+    if text is None or isinstance(text, int):
+        return text
+    return to_utc_micros(parse_timestamp_utc(text.encode()))
+
+
+def upgrade(db):
+    db.create_function("text_to_utc_micros", 1, text_to_utc_micros, deterministic=True)
+    schema = db.execute(
+        "SELECT type, name, tbl_name, sql FROM sqlite_master"
+    ).fetchall()
+    to_convert = [
+        (row["name"], row["sql"])
+        for row in schema
+        if row["type"] == "table"
+        and row["name"] in TIMESTAMP_COLUMNS
+        and TEXT_TIMESTAMP_DECLARATION in row["sql"]
+    ]
+    views = [row for row in schema if row["type"] == "view"]
+    for view in views:
+        db.execute(f"DROP VIEW {view['name']}")
+    for table, sql in to_convert:
+        sql = sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE {table}__new", 1)
+        sql = sql.replace(TEXT_TIMESTAMP_DECLARATION, MICROS_TIMESTAMP_DECLARATION)
+        db.execute(sql)
+        columns = [row["name"] for row in db.execute(f"PRAGMA table_info({table})")]
+        values = [
+            f"text_to_utc_micros({column})"
+            if column == TIMESTAMP_COLUMNS[table]
+            else column
+            for column in columns
+        ]
+        db.execute(
+            f"INSERT INTO {table}__new ({', '.join(columns)})"
+            f" SELECT {', '.join(values)} FROM {table}"
+        )
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+        for row in schema:
+            if row["type"] == "index" and row["tbl_name"] == table and row["sql"]:
+                db.execute(row["sql"])
+    for view in views:
+        db.execute(view["sql"])
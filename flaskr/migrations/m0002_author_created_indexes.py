@@ -0,0 +1,12 @@
+"""Index the latest post and comment of each author, for the rate limits"""
+
+
+def upgrade(db):
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS post__author_id__created"
+        " ON post (author_id, created)"
+    )
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS comment__author_id__created"
+        " ON comment (author_id, created)"
+    )
@@ -0,0 +1,10 @@
+"""Remember how far each import-posts source got, so it can resume"""
+
+
+def upgrade(db):
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS import_progress ("
+        " source TEXT PRIMARY KEY,"
+        " records INTEGER NOT NULL"
+        ")"
+    )
@@ -0,0 +1,36 @@
+"""
+Full-text index over post title and body, kept in sync by triggers
+
+The index is external-content: it stores only the search terms and reads
+the text from post when building snippets.
+"""
+
+
+def upgrade(db):
+    db.execute(
+        "CREATE VIRTUAL TABLE post_fts USING fts5 ("
+        " title, body, content='post', content_rowid='id',"
+        " tokenize='unicode61 remove_diacritics 2'"
+        ")"
+    )
+    db.execute(
+        "CREATE TRIGGER post_fts__insert AFTER INSERT ON post BEGIN"
+        " INSERT INTO post_fts (rowid, title, body)"
+        " VALUES (new.id, new.title, new.body);"
+        " END"
+    )
+    db.execute(
+        "CREATE TRIGGER post_fts__delete AFTER DELETE ON post BEGIN"
+        " INSERT INTO post_fts (post_fts, rowid, title, body)"
+        " VALUES ('delete', old.id, old.title, old.body);"
+        " END"
+    )
+    db.execute(
+        "CREATE TRIGGER post_fts__update AFTER UPDATE OF title, body ON post BEGIN"
+        " INSERT INTO post_fts (post_fts, rowid, title, body)"
+        " VALUES ('delete', old.id, old.title, old.body);"
+        " INSERT INTO post_fts (rowid, title, body)"
+        " VALUES (new.id, new.title, new.body);"
+        " END"
+    )
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
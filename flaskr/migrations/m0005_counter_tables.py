@@ -0,0 +1,62 @@
+"""
+Counters of posts in total, per author and per tag, kept by triggers
+
+Tags of deleted posts used to be left behind in post_tag, and counted. They
+are removed here, and the delete trigger removes them from now on.
+"""
+
+statements = [
+    "CREATE TABLE post_stats ("
+    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+    " posts INTEGER NOT NULL"
+    ")",
+    "CREATE TABLE author_stats ("
+    " author_id INTEGER PRIMARY KEY,"
+    " posts INTEGER NOT NULL,"
+    " FOREIGN KEY (author_id) REFERENCES user (id)"
+    ")",
+    "CREATE TABLE tag_stats ("
+    " tag_id INTEGER PRIMARY KEY,"
+    " posts INTEGER NOT NULL,"
+    " FOREIGN KEY (tag_id) REFERENCES tag (id)"
+    ")",
+    "CREATE INDEX tag_stats__posts ON tag_stats (posts)",
+    "DELETE FROM post_tag WHERE post_id NOT IN (SELECT id FROM post)",
+    "INSERT INTO post_stats (id, posts) SELECT 1, COUNT(*) FROM post",
+    "INSERT INTO author_stats (author_id, posts)"
+    " SELECT author_id, COUNT(*) FROM post GROUP BY author_id",
+    "INSERT INTO tag_stats (tag_id, posts)"
+    " SELECT tag_id, COUNT(*) FROM post_tag GROUP BY tag_id",
+    "CREATE TRIGGER post_stats__insert AFTER INSERT ON post BEGIN"
+    " UPDATE post_stats SET posts = posts + 1;"
+    " INSERT INTO author_stats (author_id, posts) VALUES (new.author_id, 1)"
+    " ON CONFLICT (author_id) DO UPDATE SET posts = posts + 1;"
+    " END",
+    "CREATE TRIGGER post_stats__delete AFTER DELETE ON post BEGIN"
+    " UPDATE post_stats SET posts = posts - 1;"
+    " UPDATE author_stats SET posts = posts - 1 WHERE author_id = old.author_id;"
+    " DELETE FROM post_tag WHERE post_id = old.id;"
+    " END",
+    "CREATE TRIGGER post_stats__update AFTER UPDATE OF author_id ON post BEGIN"
+    " UPDATE author_stats SET posts = posts - 1 WHERE author_id = old.author_id;"
+    " INSERT INTO author_stats (author_id, posts) VALUES (new.author_id, 1)"
+    " ON CONFLICT (author_id) DO UPDATE SET posts = posts + 1;"
+    " END",
+    "CREATE TRIGGER tag_stats__insert AFTER INSERT ON post_tag BEGIN"
+    " INSERT INTO tag_stats (tag_id, posts) VALUES (new.tag_id, 1)"
+    " ON CONFLICT (tag_id) DO UPDATE SET posts = posts + 1;"
+    " END",
+    "CREATE TRIGGER tag_stats__delete AFTER DELETE ON post_tag BEGIN"
+    " UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;"
+    " END",
+    "CREATE TRIGGER tag_stats__update AFTER UPDATE OF tag_id ON post_tag BEGIN"
+    " UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;"
+    " INSERT INTO tag_stats (tag_id, posts) VALUES (new.tag_id, 1)"
+    " ON CONFLICT (tag_id) DO UPDATE SET posts = posts + 1;"
+    " END",
+]
+
+
+def upgrade(db):
+    for statement in statements:
+        db.execute(statement)
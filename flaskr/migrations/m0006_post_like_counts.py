@@ -0,0 +1,27 @@
+"""Number of likes stored in post, kept by triggers on like"""
+
+
+def upgrade(db):
+    db.execute("ALTER TABLE post ADD COLUMN likes INTEGER NOT NULL DEFAULT 0")
+    db.execute(
+        "UPDATE post SET likes = (SELECT COUNT(*) FROM like WHERE post_id = post.id)"
+        " WHERE id IN (SELECT post_id FROM like)"
+    )
+    db.execute(
+        "CREATE TRIGGER like__insert AFTER INSERT ON like BEGIN"
+        " UPDATE post SET likes = likes + 1 WHERE id = new.post_id;"
+        " END"
+    )
+    db.execute(
+        "CREATE TRIGGER like__delete AFTER DELETE ON like BEGIN"
+        " UPDATE post SET likes = likes - 1 WHERE id = old.post_id;"
+        " END"
+    )
+    db.execute("DROP VIEW posts_view")
+    db.execute(
+        "CREATE VIEW posts_view AS"
+        " SELECT post.id AS id, title, body, created, author_id, username,"
+        " imagebytes NOTNULL AS has_image, likes"
+        " FROM post"
+        " JOIN user author ON post.author_id == author.id"
+    )
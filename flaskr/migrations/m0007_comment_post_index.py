@@ -0,0 +1,8 @@
+"""Index comments by post, for the comments of a post and counting them"""
+from . import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(db):
+    create_index(db, "comment__post_id__created", "comment", "post_id, created")
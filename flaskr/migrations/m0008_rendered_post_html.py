@@ -0,0 +1,16 @@
+"""Columns for the rendered HTML of posts, which are rendered when first shown"""
+
+
+def upgrade(db):
+    db.execute("ALTER TABLE post ADD COLUMN body_html TEXT")
+    db.execute("ALTER TABLE post ADD COLUMN summary_html TEXT")
+    db.execute("ALTER TABLE post ADD COLUMN render_version TEXT")
+    db.execute("DROP VIEW posts_view")
+    db.execute(
+        "CREATE VIEW posts_view AS"
+        " SELECT post.id AS id, title, body, created, author_id, username,"
+        " imagebytes NOTNULL AS has_image, likes, body_html, summary_html,"
+        " render_version"
+        " FROM post"
+        " JOIN user author ON post.author_id == author.id"
+    )
@@ -0,0 +1,33 @@
+"""
+Tags are deleted along with their last post_tag row, by the triggers on it
+
+Tags left without posts so far are deleted here.
+"""
+
+# Deletes old.tag_id from tag and tag_stats if no post has it any more
+_collect = (
+    " DELETE FROM tag WHERE id = old.tag_id"
+    " AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);"
+    " DELETE FROM tag_stats WHERE tag_id = old.tag_id"
+    " AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);"
+)
+
+statements = [
+    "DROP TRIGGER tag_stats__delete",
+    "DROP TRIGGER tag_stats__update",
+    "CREATE TRIGGER tag_stats__delete AFTER DELETE ON post_tag BEGIN"
+    " UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;"
+    + _collect
+    + " END",
+    "CREATE TRIGGER tag_stats__update AFTER UPDATE OF tag_id ON post_tag BEGIN"
+    " UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;"
+    " INSERT INTO tag_stats (tag_id, posts) VALUES (new.tag_id, 1)"
+    " ON CONFLICT (tag_id) DO UPDATE SET posts = posts + 1;" + _collect + " END",
+    "DELETE FROM tag WHERE id NOT IN (SELECT tag_id FROM post_tag)",
+    "DELETE FROM tag_stats WHERE tag_id NOT IN (SELECT tag_id FROM post_tag)",
+]
+
+
+def upgrade(db):
+    for statement in statements:
+        db.execute(statement)
@@ -0,0 +1,21 @@
+"""
+Columns referencing images stored as files, see flaskr.blog.images
+
+post.imagebytes stays: existing images are moved out by flask move-images,
+not here, so that the migration does not hold the write lock meanwhile.
+"""
+
+
+def upgrade(db):
+    db.execute("ALTER TABLE post ADD COLUMN image_hash TEXT")
+    db.execute("ALTER TABLE post ADD COLUMN image_size INTEGER")
+    db.execute("ALTER TABLE post ADD COLUMN image_type TEXT")
+    db.execute("DROP VIEW posts_view")
+    db.execute(
+        "CREATE VIEW posts_view AS"
+        " SELECT post.id AS id, title, body, created, author_id, username,"
+        " (image_hash NOTNULL OR imagebytes NOTNULL) AS has_image, likes,"
+        " body_html, summary_html, render_version"
+        " FROM post"
+        " JOIN user author ON post.author_id == author.id"
+    )
@@ -0,0 +1,13 @@
+"""posts_view.image_hash, to version the image URLs of listed posts"""
+
+
+def upgrade(db):
+    db.execute("DROP VIEW posts_view")
+    db.execute(
+        "CREATE VIEW posts_view AS"
+        " SELECT post.id AS id, title, body, created, author_id, username,"
+        " (image_hash NOTNULL OR imagebytes NOTNULL) AS has_image, image_hash,"
+        " likes, body_html, summary_html, render_version"
+        " FROM post"
+        " JOIN user author ON post.author_id == author.id"
+    )
@@ -0,0 +1,19 @@
+"""
+Pixel dimensions of post images, for the srcset of their variants
+
+NULL for the images stored so far: flask measure-images fills them in.
+"""
+
+
+def upgrade(db):
+    db.execute("ALTER TABLE post ADD COLUMN image_width INTEGER")
+    db.execute("ALTER TABLE post ADD COLUMN image_height INTEGER")
+    db.execute("DROP VIEW posts_view")
+    db.execute(
+        "CREATE VIEW posts_view AS"
+        " SELECT post.id AS id, title, body, created, author_id, username,"
+        " (image_hash NOTNULL OR imagebytes NOTNULL) AS has_image, image_hash,"
+        " image_width, likes, body_html, summary_html, render_version"
+        " FROM post"
+        " JOIN user author ON post.author_id == author.id"
+    )
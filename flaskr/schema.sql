@@ -1,12 +1,17 @@
-DROP TABLE IF EXISTS user;
-DROP TABLE IF EXISTS post;
+-- Latest schema, used by init-db on an empty database.
+-- Any change here needs a migration in flaskr/migrations for existing
+-- databases, and the user_version at the end set to its number.
+
+-- Timestamps are stored as integer microseconds since the Unix epoch, UTC
+-- (see flaskr.db.to_utc_micros)
 
 CREATE TABLE user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
     password TEXT NOT NULL,
     registration_ip TEXT NOT NULL,
-    registration_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    registration_time UTCMICROS INTEGER NOT NULL
+        DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER))
 );
 
 CREATE INDEX user__ip__time ON user (registration_ip, registration_time);
@@ -14,20 +19,42 @@ CREATE INDEX user__ip__time ON user (registration_ip, registration_time);
 CREATE TABLE post (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     author_id INTEGER NOT NULL,
-    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created UTCMICROS INTEGER NOT NULL
+        DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)),
     title TEXT NOT NULL,
     body TEXT NOT NULL,
+    -- Only images stored before migration 10 not yet moved by flask move-images
     imagebytes BLOB,
+    -- SHA-256 in hex, size and MIME type of the image, see flaskr.blog.images
+    image_hash TEXT,
+    image_size INTEGER,
+    image_type TEXT,
+    -- Pixels of still images Pillow could read, see flaskr.blog.variants
+    image_width INTEGER,
+    image_height INTEGER,
+    -- Number of rows in like for this post, kept by the like__ triggers
+    likes INTEGER NOT NULL DEFAULT 0,
+    -- Sanitized HTML of the body and its summary, see flaskr.blog.render
+    body_html TEXT,
+    summary_html TEXT,
+    render_version TEXT,
     FOREIGN KEY (author_id) REFERENCES user (id)
 );
 
 -- For posts index (sorted by date)
 CREATE INDEX post__created ON post (created);
 
+-- For the posting rate limit (latest post of an author)
+CREATE INDEX post__author_id__created ON post (author_id, created);
+
 -- For posts index, just need author name and checking if the post has an image
+-- (image_hash versions its URL, see flaskr.blog.images, and image_width
+-- lists its variants)
 CREATE VIEW posts_view AS
     SELECT post.id AS id, title, body, created, author_id, username,
-    imagebytes NOTNULL AS has_image
+    (image_hash NOTNULL OR imagebytes NOTNULL) AS has_image, image_hash,
+    image_width,
+    likes, body_html, summary_html, render_version
     FROM post
     JOIN user author ON post.author_id == author.id;
 
@@ -39,11 +66,20 @@ CREATE TABLE like (
     PRIMARY KEY (post_id, user_id)
 );
 
+CREATE TRIGGER like__insert AFTER INSERT ON like BEGIN
+    UPDATE post SET likes = likes + 1 WHERE id = new.post_id;
+END;
+
+CREATE TRIGGER like__delete AFTER DELETE ON like BEGIN
+    UPDATE post SET likes = likes - 1 WHERE id = old.post_id;
+END;
+
 CREATE TABLE comment (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     post_id INTEGER NOT NULL,
     author_id INTEGER NOT NULL,
-    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    created UTCMICROS INTEGER NOT NULL
+        DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)),
     body TEXT NOT NULL,
     FOREIGN KEY (post_id) REFERENCES post (id)
     FOREIGN KEY (author_id) REFERENCES user (id)
@@ -52,6 +88,12 @@ CREATE TABLE comment (
 -- For post comments view (sorted by date)
 CREATE INDEX comment__created ON comment (created);
 
+-- For the comments of a post, and counting them in listings
+CREATE INDEX comment__post_id__created ON comment (post_id, created);
+
+-- For the commenting rate limit (latest comment of an author)
+CREATE INDEX comment__author_id__created ON comment (author_id, created);
+
 CREATE TABLE tag (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT UNIQUE NOT NULL
@@ -70,3 +112,101 @@ CREATE TABLE post_tag (
 
 CREATE INDEX post_tag__tag_id ON post_tag (tag_id);
 
+-- Records of each import-posts source committed so far, to resume
+CREATE TABLE import_progress (
+    source TEXT PRIMARY KEY,
+    records INTEGER NOT NULL
+);
+
+-- Full-text search over posts, see flaskr.blog.search
+CREATE VIRTUAL TABLE post_fts USING fts5 (
+    title, body, content='post', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER post_fts__insert AFTER INSERT ON post BEGIN
+    INSERT INTO post_fts (rowid, title, body)
+    VALUES (new.id, new.title, new.body);
+END;
+
+CREATE TRIGGER post_fts__delete AFTER DELETE ON post BEGIN
+    INSERT INTO post_fts (post_fts, rowid, title, body)
+    VALUES ('delete', old.id, old.title, old.body);
+END;
+
+CREATE TRIGGER post_fts__update AFTER UPDATE OF title, body ON post BEGIN
+    INSERT INTO post_fts (post_fts, rowid, title, body)
+    VALUES ('delete', old.id, old.title, old.body);
+    INSERT INTO post_fts (rowid, title, body)
+    VALUES (new.id, new.title, new.body);
+END;
+
+-- Counters maintained by the triggers below, so that listings do not count
+-- rows on every request (see flaskr.blog.counters)
+CREATE TABLE post_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    posts INTEGER NOT NULL
+);
+
+INSERT INTO post_stats (id, posts) VALUES (1, 0);
+
+CREATE TABLE author_stats (
+    author_id INTEGER PRIMARY KEY,
+    posts INTEGER NOT NULL,
+    FOREIGN KEY (author_id) REFERENCES user (id)
+);
+
+CREATE TABLE tag_stats (
+    tag_id INTEGER PRIMARY KEY,
+    posts INTEGER NOT NULL,
+    FOREIGN KEY (tag_id) REFERENCES tag (id)
+);
+
+-- For the tags page (sorted by number of posts)
+CREATE INDEX tag_stats__posts ON tag_stats (posts);
+
+CREATE TRIGGER post_stats__insert AFTER INSERT ON post BEGIN
+    UPDATE post_stats SET posts = posts + 1;
+    INSERT INTO author_stats (author_id, posts) VALUES (new.author_id, 1)
+    ON CONFLICT (author_id) DO UPDATE SET posts = posts + 1;
+END;
+
+-- Also removes the tags of the post, which would otherwise still be counted
+CREATE TRIGGER post_stats__delete AFTER DELETE ON post BEGIN
+    UPDATE post_stats SET posts = posts - 1;
+    UPDATE author_stats SET posts = posts - 1 WHERE author_id = old.author_id;
+    DELETE FROM post_tag WHERE post_id = old.id;
+END;
+
+CREATE TRIGGER post_stats__update AFTER UPDATE OF author_id ON post BEGIN
+    UPDATE author_stats SET posts = posts - 1 WHERE author_id = old.author_id;
+    INSERT INTO author_stats (author_id, posts) VALUES (new.author_id, 1)
+    ON CONFLICT (author_id) DO UPDATE SET posts = posts + 1;
+END;
+
+CREATE TRIGGER tag_stats__insert AFTER INSERT ON post_tag BEGIN
+    INSERT INTO tag_stats (tag_id, posts) VALUES (new.tag_id, 1)
+    ON CONFLICT (tag_id) DO UPDATE SET posts = posts + 1;
+END;
+
+CREATE TRIGGER tag_stats__delete AFTER DELETE ON post_tag BEGIN
+    UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;
+    -- Tags no post has any more are deleted
+    DELETE FROM tag WHERE id = old.tag_id
+    AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);
+    DELETE FROM tag_stats WHERE tag_id = old.tag_id
+    AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);
+END;
+
+CREATE TRIGGER tag_stats__update AFTER UPDATE OF tag_id ON post_tag BEGIN
+    UPDATE tag_stats SET posts = posts - 1 WHERE tag_id = old.tag_id;
+    INSERT INTO tag_stats (tag_id, posts) VALUES (new.tag_id, 1)
+    ON CONFLICT (tag_id) DO UPDATE SET posts = posts + 1;
+    -- Tags no post has any more are deleted
+    DELETE FROM tag WHERE id = old.tag_id
+    AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);
+    DELETE FROM tag_stats WHERE tag_id = old.tag_id
+    AND NOT EXISTS (SELECT 1 FROM post_tag WHERE tag_id = old.tag_id);
+END;
+
+PRAGMA user_version = 12;
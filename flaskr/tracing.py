@@ -0,0 +1,260 @@
+"""
+Per-request SQL tracing
+
+Pooled connections are TracedConnections. While a request is being handled,
+every statement they run is recorded in g.sql_trace with its time (including
+fetching the rows), number of rows returned and calling function. At the end
+of the request, statements slower than SLOW_QUERY_SECONDS are logged with
+their query plan, and the totals are added to the per-endpoint metrics.
+
+Query plans are captured once per SQL text, for the last PLAN_CACHE_SIZE
+texts, and plans scanning a whole table are logged when first seen.
+
+Tracing costs a little on every statement, so it is off unless SQL_TRACE is
+set.
+"""
+import re
+import sqlite3
+import sys
+import time
+
+from flask import current_app, g, has_app_context, request
+
+from . import metrics
+
+statements_counter = metrics.counter(
+    "flaskr_sql_statements_total", "SQL statements run", "endpoint"
+)
+seconds_counter = metrics.counter(
+    "flaskr_sql_seconds_total", "Time spent running SQL statements", "endpoint"
+)
+rows_counter = metrics.counter(
+    "flaskr_sql_rows_total", "Rows returned by SQL statements", "endpoint"
+)
+full_scans_counter = metrics.counter(
+    "flaskr_sql_full_scans_total",
+    "SQL statements scanning a whole table",
+    "endpoint",
+)
+slow_counter = metrics.counter(
+    "flaskr_sql_slow_statements_total",
+    "SQL statements slower than SLOW_QUERY_SECONDS",
+    "endpoint",
+)
+requests_counter = metrics.counter(
+    "flaskr_sql_requests_total", "Traced requests", "endpoint"
+)
+
+
+class Statement:
+    """One traced execution of a SQL statement"""
+
+    __slots__ = ("sql", "seconds", "rows", "caller", "plan")
+
+    def __init__(self, sql, caller, plan):
+        self.sql = sql
+        self.seconds = 0
+        self.rows = 0
+        self.caller = caller
+        self.plan = plan
+
+    @property
+    def full_scans(self):
+        return get_full_scans(self.plan)
+
+    def __repr__(self):
+        return (
+            f"<Statement {self.sql!r} from {self.caller}:"
+            f" {self.seconds * 1e3:.1f} ms, {self.rows} rows>"
+        )
+
+
+# Query plan for each SQL text, as (id, parent, notused, detail) tuples,
+# the oldest dropped past PLAN_CACHE_SIZE
+PLAN_CACHE_SIZE = 1000
+_plans = {}
+
+TRUE_STRINGS = {"1", "true", "yes", "on"}
+
+EXPLAINABLE = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.I)
+FULL_SCAN = re.compile(r"SCAN (\w+)$")
+
+
+def get_full_scans(plan):
+    """Return the tables that plan reads in full"""
+    return [
+        match[1] for match in map(FULL_SCAN.match, (row[3] for row in plan)) if match
+    ]
+
+
+def get_plan(db, sql, parameters):
+    plan = _plans.get(sql)
+    if plan is not None:
+        return plan
+    plan = ()
+    if EXPLAINABLE.match(sql):
+        try:
+            # Plain cursor, so that EXPLAIN itself is not traced
+            cursor = sqlite3.Cursor(db)
+            plan = tuple(
+                tuple(row)
+                for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+            )
+        except sqlite3.Error:
+            pass
+    if len(_plans) >= PLAN_CACHE_SIZE:
+        # SQL texts with values spelled out would otherwise grow it forever
+        del _plans[next(iter(_plans))]
+    _plans[sql] = plan
+    full_scans = get_full_scans(plan)
+    if full_scans:
+        current_app.logger.warning(
+            "Full scan of %s in %s", ", ".join(full_scans), " ".join(sql.split())
+        )
+    return plan
+
+
+# Code of the methods wrapping execute, which are skipped to find the caller
+_wrappers = set()
+
+
+def not_a_caller(method):
+    _wrappers.add(method.__code__)
+    return method
+
+
+def get_caller():
+    """Return module.function of the closest caller outside the wrappers"""
+    frame = sys._getframe(2)
+    while frame.f_code in _wrappers:
+        frame = frame.f_back
+    return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+
+
+def get_trace():
+    if has_app_context():
+        return g.get("sql_trace")
+    return None
+
+
+class TracedCursor(sqlite3.Cursor):
+    _statement = None
+
+    @not_a_caller
+    def execute(self, sql, parameters=()):
+        trace = get_trace()
+        if trace is None:
+            self._statement = None
+            return super().execute(sql, parameters)
+        self._statement = statement = Statement(
+            sql, get_caller(), get_plan(self.connection, sql, parameters)
+        )
+        trace.append(statement)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            statement.seconds += time.perf_counter() - start
+
+    @not_a_caller
+    def executemany(self, sql, seq_of_parameters):
+        trace = get_trace()
+        self._statement = None
+        if trace is None:
+            return super().executemany(sql, seq_of_parameters)
+        statement = Statement(sql, get_caller(), ())
+        trace.append(statement)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            statement.seconds += time.perf_counter() - start
+
+    def _fetch(self, fetch, *args):
+        statement = self._statement
+        if statement is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            statement.seconds += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._fetch(super().fetchone)
+        if row is not None and self._statement is not None:
+            self._statement.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._fetch(super().fetchmany, size or self.arraysize)
+        if self._statement is not None:
+            self._statement.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(super().fetchall)
+        if self._statement is not None:
+            self._statement.rows += len(rows)
+        return rows
+
+    def __next__(self):
+        row = self._fetch(super().__next__)
+        if self._statement is not None:
+            self._statement.rows += 1
+        return row
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose statements are recorded in the request's trace"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    @not_a_caller
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    @not_a_caller
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def is_enabled(value):
+    """Whether a flag setting is on, also when it comes as a FLASKR_* string"""
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_STRINGS
+    return bool(value)
+
+
+def start_trace():
+    if is_enabled(current_app.config["SQL_TRACE"]):
+        g.sql_trace = []
+
+
+def finish_trace(e=None):
+    trace = g.pop("sql_trace", None)
+    if trace is None:
+        return
+    endpoint = request.endpoint or "none"
+    threshold = float(current_app.config["SLOW_QUERY_SECONDS"])
+    requests_counter.inc(endpoint)
+    statements_counter.inc(endpoint, len(trace))
+    seconds_counter.inc(endpoint, sum(statement.seconds for statement in trace))
+    rows_counter.inc(endpoint, sum(statement.rows for statement in trace))
+    full_scans_counter.inc(
+        endpoint, sum(1 for statement in trace if statement.full_scans)
+    )
+    for statement in trace:
+        if statement.seconds < threshold:
+            continue
+        slow_counter.inc(endpoint)
+        current_app.logger.warning(
+            "Slow query in %s (%.1f ms, %d rows) from %s: %s\n%s",
+            endpoint,
+            statement.seconds * 1e3,
+            statement.rows,
+            statement.caller,
+            " ".join(statement.sql.split()),
+            "\n".join(row[3] for row in statement.plan) or "(no query plan)",
+        )
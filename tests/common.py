@@ -1,9 +1,16 @@
+import hashlib
 from io import BytesIO
-from flaskr.blog.blogdb import create_post
+from flaskr.blog.blogdb import create_post, get_post_image
+from flaskr.blog.images import get_image_store
+from flaskr.blog.render import get_rendered_fields
 from flaskr.db import get_db
 from datetime import datetime, timezone
 
 
+# Uploads are rejected unless they start like an image
+IMAGE_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
 def generate_no_file_selected():
     return (BytesIO(b""), "")
 
@@ -35,14 +42,33 @@ def generate_posts(nposts):
             "created": datetime(2000 + ii, 2, 3, 11, 58, 23, tzinfo=timezone.utc),
         }
         postid = create_post(**post)
+        post.update(get_rendered_fields(post["body"]))
         post.update(
             {
                 "id": postid,
                 "has_image": has_image,
+                "image_hash": post["imagebytes"]
+                and hashlib.sha256(post["imagebytes"]).hexdigest(),
+                # Not actual images
+                "image_width": None,
                 "liked": False,
                 "likes": 0,
+                "comments": 0,
                 "username": {1: "test", 2: "other"}[post["author_id"]],
             }
         )
         posts.insert(0, post)
     return sorted(posts, key=lambda post: post["created"], reverse=True)
+
+
+def read_post_image(post_id):
+    """Return the bytes of the image of a post, wherever they are stored"""
+    image = get_post_image(post_id)
+    if image["image_hash"] is None:
+        return (
+            get_db()
+            .execute("SELECT imagebytes FROM post WHERE id == ?", (post_id,))
+            .fetchone()[0]
+        )
+    with open(get_image_store().path(image["image_hash"]), "rb") as fd:
+        return fd.read()
@@ -1,10 +1,11 @@
 import os
+import shutil
 import tempfile
 from selenium import webdriver
 import pytest
 from flask import url_for
 from flaskr import create_app
-from flaskr.db import get_db, init_db
+from flaskr.db import get_db, init_db, close_database
 from flaskr.recaptcha import recaptcha_always_passes_context
 
 
@@ -15,12 +16,16 @@ with open(os.path.join(os.path.dirname(__file__), "data.sql"), "rb") as fd:
 @pytest.fixture
 def app():
     db_fd, db_path = tempfile.mkstemp()
+    image_directory = tempfile.mkdtemp()
 
     app = create_app(
         {
             "SECRET_KEY": "123",
             "TESTING": True,
             "DATABASE": db_path,
+            "IMAGE_DIRECTORY": image_directory,
+            # Several tests count the statements of a request
+            "SQL_TRACE": True,
         }
     )
 
@@ -29,8 +34,10 @@ def app():
         get_db().executescript(_data_sql)
         yield app
 
+    close_database(db_path)
     os.close(db_fd)
     os.unlink(db_path)
+    shutil.rmtree(image_directory)
 
 
 @pytest.fixture
@@ -6,26 +6,26 @@
 
 INSERT INTO user (username, password, registration_ip, registration_time)
 VALUES
-    ('test', 'pbkdf2:sha256:50000$TCI4GzcX$0de171a4f4dac32e3364c7ddc7c14f3e2fa61f2d17574483f7ffbb431b4acb2f', '10.0.0.1', '2021-01-01 00:00:00'),
-    ('other', 'pbkdf2:sha256:260000$zo4Su1dUaG23vfVr$fc34ea59029c6b1b7e19a48b86aceb862460529ab8c2fde586735261a1028640', '10.0.0.1', '2021-01-01 00:00:00'),
-    ('u3', 'pbkdf2:sha256:260000$zo4Su1dUaG23vfVr$fc34ea59029c6b1b7e19a48b86aceb862460529ab8c2fde586735261a1028640', '10.0.0.1', '2021-01-01 00:00:00');
+    ('test', 'pbkdf2:sha256:50000$TCI4GzcX$0de171a4f4dac32e3364c7ddc7c14f3e2fa61f2d17574483f7ffbb431b4acb2f', '10.0.0.1', strftime('%s', '2021-01-01 00:00:00') * 1000000),
+    ('other', 'pbkdf2:sha256:260000$zo4Su1dUaG23vfVr$fc34ea59029c6b1b7e19a48b86aceb862460529ab8c2fde586735261a1028640', '10.0.0.1', strftime('%s', '2021-01-01 00:00:00') * 1000000),
+    ('u3', 'pbkdf2:sha256:260000$zo4Su1dUaG23vfVr$fc34ea59029c6b1b7e19a48b86aceb862460529ab8c2fde586735261a1028640', '10.0.0.1', strftime('%s', '2021-01-01 00:00:00') * 1000000);
 
 INSERT INTO post (title, body, author_id, created, imagebytes)
 VALUES
-  ('test title', 'test' || x'0a' || 'body', 1, '2018-01-01 00:00:00', X'aabbccddeeff'),
-  ('test2', 'test2' || x'0a' || 'body2', 2, '2019-01-01 00:00:00', NULL),
-  ('test3', 'test3 word', 1, '2018-01-01 00:00:00', NULL),
-  ('test4', 'test4 word', 2, '2017-01-01 00:00:00', NULL),
-  ('test5', 'test5 word', 2, '2016-01-01 00:00:00', NULL),
-  ('test6', 'test6 <script> <a href="http://shady.com">a</a> http://linkify.com <b>good</b> *job*', 2, '2015-01-01 00:00:00', NULL),
-  ('test7', 'test7', 2, '2014-01-01 00:00:00', NULL);
+  ('test title', 'test' || x'0a' || 'body', 1, strftime('%s', '2018-01-01 00:00:00') * 1000000, X'aabbccddeeff'),
+  ('test2', 'test2' || x'0a' || 'body2', 2, strftime('%s', '2019-01-01 00:00:00') * 1000000, NULL),
+  ('test3', 'test3 word', 1, strftime('%s', '2018-01-01 00:00:00') * 1000000, NULL),
+  ('test4', 'test4 word', 2, strftime('%s', '2017-01-01 00:00:00') * 1000000, NULL),
+  ('test5', 'test5 word', 2, strftime('%s', '2016-01-01 00:00:00') * 1000000, NULL),
+  ('test6', 'test6 <script> <a href="http://shady.com">a</a> http://linkify.com <b>good</b> *job*', 2, strftime('%s', '2015-01-01 00:00:00') * 1000000, NULL),
+  ('test7', 'test7', 2, strftime('%s', '2014-01-01 00:00:00') * 1000000, NULL);
 
 INSERT INTO comment (body, post_id, author_id, created)
 VALUES
-  ('comment11', 1, 1, '1911-01-01 00:00:00'),
-  ('comment12', 1, 2, '1912-01-01 00:00:00'),
-  ('comment21', 2, 1, '1921-01-01 00:00:00'),
-  ('comment22', 2, 2, '1922-01-01 00:00:00');
+  ('comment11', 1, 1, strftime('%s', '1911-01-01 00:00:00') * 1000000),
+  ('comment12', 1, 2, strftime('%s', '1912-01-01 00:00:00') * 1000000),
+  ('comment21', 2, 1, strftime('%s', '1921-01-01 00:00:00') * 1000000),
+  ('comment22', 2, 2, strftime('%s', '1922-01-01 00:00:00') * 1000000);
 
 
 INSERT INTO tag (name) VALUES ('tag1'), ('tag2');
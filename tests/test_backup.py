@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+from flaskr.backup import BackupError, backup_database, restore_database
+from flaskr.blog.blogdb import create_post
+from flaskr.db import get_db
+
+
+def count_posts():
+    return get_db().execute("SELECT COUNT(*) FROM post").fetchone()[0]
+
+
+@pytest.mark.parametrize("name", ["backup.sqlite", "backup.sqlite.gz"])
+def test_backup_and_restore(app, tmp_path, name):
+    destination = str(tmp_path / name)
+    messages = []
+    backup_database(app.config["DATABASE"], destination, echo=messages.append)
+    assert messages[-1] == f"Verified backup in {destination}"
+    posts = count_posts()
+    create_post(1, "after backup", "", [], None)
+    assert count_posts() == posts + 1
+    restore_database(destination, app.config["DATABASE"], echo=messages.append)
+    assert count_posts() == posts
+    assert list(tmp_path.iterdir()) == [tmp_path / name]
+
+
+def test_backup_does_not_block_writes(app, tmp_path):
+    for ii in range(100):
+        create_post(1, "padding", "x" * 4000, [], None)
+    stop = threading.Event()
+    writes = []
+
+    def keep_writing():
+        with app.app_context():
+            while not stop.is_set():
+                writes.append(create_post(1, "during backup", "", [], None))
+
+    writer = threading.Thread(target=keep_writing)
+    writer.start()
+    try:
+        backup_database(
+            app.config["DATABASE"],
+            str(tmp_path / "backup.sqlite"),
+            pages=1,
+            sleep=0.001,
+            echo=lambda message: None,
+        )
+    finally:
+        stop.set()
+        writer.join()
+    assert writes
+
+
+def test_restore_rejects_invalid_backup(app, tmp_path):
+    backup = tmp_path / "backup.sqlite"
+    backup.write_bytes(b"not a database" * 100)
+    with pytest.raises(BackupError):
+        restore_database(str(backup), app.config["DATABASE"], echo=print)
+
+
+def test_backup_commands(app, runner, tmp_path):
+    destination = str(tmp_path / "backup.sqlite.gz")
+    result = runner.invoke(args=["backup", destination])
+    assert "MiB/s" in result.output
+    assert "Verified" in result.output
+    result = runner.invoke(args=["restore", destination], input="n\n")
+    assert "Restored" not in result.output
+    result = runner.invoke(args=["restore", "--yes", destination])
+    assert "Restored" in result.output
@@ -0,0 +1,87 @@
+from flaskr.blog.blogdb import (
+    count_posts,
+    create_post,
+    delete_post,
+    get_posts_with_tag,
+    get_tag_counts,
+    remove_post_tag,
+    update_post,
+)
+from flaskr.blog.counters import check_counters, repair_counters
+from flaskr.db import get_db
+
+
+def test_counters_follow_changes(app):
+    assert count_posts() == 7
+    assert count_posts(author_id=1) == 2
+    assert count_posts(author_id=3) == 0
+    post_id = create_post(3, "new", "body", ["tag1", "tag3"], None)
+    assert count_posts() == 8
+    assert count_posts(author_id=3) == 1
+    assert dict(get_tag_counts()) == {"tag1": 3, "tag2": 2, "tag3": 1}
+    update_post(post_id, "new", "body", ["tag2"], None, False)
+    assert dict(get_tag_counts()) == {"tag1": 2, "tag2": 3}
+    remove_post_tag(4, "tag2")
+    assert get_posts_with_tag("tag2", page=1)[0] == 2
+    delete_post(4)
+    assert count_posts() == 7
+    assert count_posts(author_id=2) == 4
+    assert dict(get_tag_counts()) == {"tag1": 1, "tag2": 2}
+    assert check_counters(get_db()) == []
+
+
+def test_deleting_a_post_deletes_its_tags(app):
+    delete_post(4)
+    db = get_db()
+    assert (
+        db.execute("SELECT COUNT(*) FROM post_tag WHERE post_id = 4").fetchone()[0] == 0
+    )
+
+
+def test_tags_page_reads_counters(client, app):
+    with app.app_context():
+        get_db().execute("UPDATE tag_stats SET posts = 42 WHERE tag_id = 1")
+        get_db().commit()
+    assert ">tag1 (42)</a>" in client.get("/tags/").data.decode()
+
+
+def test_check_and_repair(app):
+    db = get_db()
+    db.execute("UPDATE post_stats SET posts = 100")
+    db.execute("UPDATE tag_stats SET posts = 0 WHERE tag_id = 2")
+    db.execute("DELETE FROM author_stats WHERE author_id = 1")
+    db.commit()
+    assert check_counters(db) == [
+        ("post_stats", 1, 100, 7),
+        ("author_stats", 1, 0, 2),
+        ("tag_stats", 2, 0, 2),
+    ]
+    repair_counters(db)
+    assert check_counters(db) == []
+    assert count_posts() == 7
+
+
+def test_check_counters_command(runner, app):
+    result = runner.invoke(args=["check-counters"])
+    assert result.exit_code == 0
+    assert "All counters are correct" in result.output
+    with app.app_context():
+        get_db().execute("UPDATE tag_stats SET posts = 5 WHERE tag_id = 1")
+        get_db().commit()
+    result = runner.invoke(args=["check-counters"])
+    assert result.exit_code != 0
+    assert "tag_stats 1: 5 instead of 2" in result.output
+    result = runner.invoke(args=["check-counters", "--repair"])
+    assert "Repaired" in result.output
+    with app.app_context():
+        assert check_counters(get_db()) == []
+
+
+def test_check_and_repair_likes(app):
+    db = get_db()
+    db.execute("UPDATE post SET likes = 3 WHERE id = 1")
+    db.execute("UPDATE post SET likes = 0 WHERE id = 6")
+    db.commit()
+    assert check_counters(db) == [("post.likes", 1, 3, 0), ("post.likes", 6, 0, 2)]
+    repair_counters(db)
+    assert check_counters(db) == []
@@ -1,7 +1,22 @@
+import re
 import sqlite3
+import threading
+import time
 
 import pytest
-from flaskr.db import get_db
+from datetime import datetime, timezone
+from flaskr.blog.blogdb import create_post
+from flaskr.db import (
+    Record,
+    get_db,
+    get_pool,
+    write,
+    Writer,
+    PoolTimeoutError,
+    WriteQueueFullError,
+    WriteTimeoutError,
+    batch_size_histogram,
+)
 
 
 def test_get_db_idempotent(app):
@@ -10,14 +25,168 @@ def test_get_db_idempotent(app):
         assert db is get_db()
 
 
-def test_get_db_closes_db(app):
+def test_get_db_returns_db_to_pool(app):
     with app.app_context():
         db = get_db()
+        db.execute("DELETE FROM post")
+
+    with app.app_context():
+        # Warm connection is reused, uncommitted changes were rolled back
+        assert get_db() is db
+        assert not db.in_transaction
+        assert db.execute("SELECT COUNT(*) FROM post").fetchone()[0] == 7
+
+
+def test_pooled_connections_are_tuned(app):
+    db = get_pool().connect()
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # NORMAL
+    assert db.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    db.close()
+
+
+def test_pool_size_is_bounded(app):
+    pool = get_pool()
+    pool.timeout = 0.01
+    borrowed = [pool.acquire() for _ in range(app.config["DATABASE_POOL_SIZE"] - 1)]
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    pool.release(borrowed.pop())
+    borrowed.append(pool.acquire())
+    for db in borrowed:
+        pool.release(db)
+
+
+@pytest.mark.parametrize(("method", "read_only"), [("GET", True), ("POST", False)])
+def test_safe_methods_use_read_only_db(app, method, read_only):
+    with app.test_request_context("/", method=method):
+        app.preprocess_request()
+        db = get_db()
+        assert db.execute("SELECT COUNT(*) FROM post").fetchone()[0] == 7
+        if read_only:
+            with pytest.raises(sqlite3.OperationalError):
+                db.execute("DELETE FROM post")
+        else:
+            db.execute("DELETE FROM post")
+            db.rollback()
+
+
+def test_write_commits_on_writer_thread(app):
+    def job(db, title):
+        assert threading.current_thread() is not threading.main_thread()
+        db.execute("UPDATE post SET title = ? WHERE id = 1", (title,))
+        return "result"
+
+    assert write(job, "written") == "result"
+    title = get_db().execute("SELECT title FROM post WHERE id = 1").fetchone()[0]
+    assert title == "written"
+
+
+def test_write_rolls_back_on_error(app):
+    def job(db):
+        db.execute("DELETE FROM post")
+        raise KeyError("oops")
+
+    with pytest.raises(KeyError):
+        write(job)
+    assert get_db().execute("SELECT COUNT(*) FROM post").fetchone()[0] == 7
+
+
+def test_write_queue_is_bounded(app):
+    writer = Writer(app.config["DATABASE"], {}, queue_size=1, timeout=0.01)
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_job(db):
+        started.set()
+        release.wait()
+
+    threads = [threading.Thread(target=writer.submit, args=(blocking_job,))]
+    threads[0].start()
+    started.wait()
+    # Writer is busy, this one waits in the queue
+    threads.append(threading.Thread(target=writer.submit, args=(lambda db: None,)))
+    threads[1].start()
+    while not writer._jobs.full():
+        pass
+    with pytest.raises(WriteQueueFullError):
+        writer.submit(lambda db: None)
+    release.set()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+
+def test_writer_survives_locked_database(app):
+    writer = Writer(
+        app.config["DATABASE"], {"busy_timeout": 10}, queue_size=10, timeout=1
+    )
+
+    def job(db):
+        db.execute("UPDATE post SET title = 'written' WHERE id = 1")
+        return "result"
+
+    other = get_pool().connect()
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError) as e:
+        writer.submit(job)
+    assert "locked" in str(e.value)
+    other.rollback()
+    other.close()
+    assert writer.submit(job) == "result"
+    writer.close()
+
+
+def test_write_times_out(app):
+    writer = Writer(
+        app.config["DATABASE"], {}, queue_size=10, timeout=1, result_timeout=0.01
+    )
+    release = threading.Event()
+    with pytest.raises(WriteTimeoutError):
+        writer.submit(lambda db: release.wait())
+    release.set()
+    writer.close()
 
-    with pytest.raises(sqlite3.ProgrammingError) as e:
-        db.execute("SELECT 1")
 
-    assert "closed" in str(e.value)
+def test_writer_group_commits(app):
+    writer = Writer(
+        app.config["DATABASE"],
+        {},
+        queue_size=10,
+        timeout=1,
+        batch_size=4,
+        batch_delay=1,
+    )
+    observed = batch_size_histogram.count
+
+    def like(db, user_id):
+        db.execute("INSERT INTO like (post_id, user_id) VALUES (1, ?)", (user_id,))
+        return user_id
+
+    results = []
+
+    def submit(user_id):
+        try:
+            results.append(writer.submit(like, user_id))
+        except sqlite3.IntegrityError as e:
+            results.append(e)
+
+    # User 2 likes twice, which violates the primary key
+    threads = [threading.Thread(target=submit, args=(uid,)) for uid in (1, 2, 2, 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    assert sorted(r for r in results if isinstance(r, int)) == [1, 2, 3]
+    assert sum(isinstance(r, sqlite3.IntegrityError) for r in results) == 1
+    # One transaction for all four jobs
+    assert batch_size_histogram.count == observed + 1
+    likers = {
+        row[0] for row in get_db().execute("SELECT user_id FROM like WHERE post_id = 1")
+    }
+    assert likers == {1, 2, 3}
 
 
 def test_init_db_command(runner, monkeypatch):
@@ -45,3 +214,116 @@ def test_timezone(app):
     db = get_db()
     timestamp = db.execute("SELECT created FROM post").fetchone()[0]
     assert timestamp.tzinfo is not None
+
+
+def batch_count(client):
+    response = client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"})
+    (count,) = re.findall(
+        r"^flaskr_write_batch_size_count (\d+)$", response.data.decode(), re.M
+    )
+    return int(count)
+
+
+def test_metrics_report_write_batch_sizes(app, client, auth):
+    app.config["METRICS_ALLOWED_IPS"] = "10.1.2.4,10.1.2.3"
+    before = batch_count(client)
+    auth.login()
+    client.post("/1/like", data={"like": "1"})
+    assert batch_count(client) == before + 1
+
+
+def test_metrics_are_private(app, client):
+    assert client.get("/metrics").status_code == 404
+    app.config["METRICS_ALLOWED_IPS"] = "127.0.0.10"
+    assert client.get("/metrics").status_code == 404
+    app.config["METRICS_ALLOWED_IPS"] = ["127.0.0.1"]
+    assert client.get("/metrics").status_code == 200
+
+
+def test_failed_job_does_not_fail_batch_when_transaction_is_lost(app):
+    writer = Writer(
+        app.config["DATABASE"],
+        {},
+        queue_size=10,
+        timeout=1,
+        batch_size=3,
+        batch_delay=1,
+    )
+
+    def insert_tag(db, name):
+        return db.execute("INSERT INTO tag (name) VALUES (?)", (name,)).lastrowid
+
+    def lose_transaction(db):
+        db.execute("ROLLBACK")
+        raise ValueError("bad job")
+
+    results = {}
+
+    def submit(key, job, *args):
+        try:
+            results[key] = writer.submit(job, *args)
+        except Exception as e:
+            results[key] = e
+
+    threads = [
+        threading.Thread(target=submit, args=("a", insert_tag, "a")),
+        threading.Thread(target=submit, args=("bad", lose_transaction)),
+        threading.Thread(target=submit, args=("b", insert_tag, "b")),
+    ]
+    for thread in threads:
+        thread.start()
+        # Keep the order within the batch deterministic
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    writer.close()
+    assert isinstance(results["bad"], ValueError)
+    assert isinstance(results["a"], int)
+    assert isinstance(results["b"], int)
+    names = {row[0] for row in get_db().execute("SELECT name FROM tag")}
+    assert {"a", "b"} <= names
+
+
+def test_timestamps_are_stored_as_integer_micros(app):
+    db = get_db()
+    created = datetime(2019, 3, 4, 5, 6, 7, 890123, tzinfo=timezone.utc)
+    post_id = create_post(1, "title", "body", [], None, created=created)
+    raw, decoded = db.execute(
+        "SELECT CAST(created AS INTEGER) = created, created FROM post WHERE id = ?",
+        (post_id,),
+    ).fetchone()
+    assert raw
+    assert decoded == created
+    # Comparisons happen on integers too
+    assert (
+        db.execute(
+            "SELECT COUNT(*) FROM post WHERE created > ?", (datetime(2019, 1, 1),)
+        ).fetchone()[0]
+        == 1
+    )
+
+
+def test_default_timestamp_is_now(app):
+    db = get_db()
+    post_id = create_post(1, "title", "body", [], None)
+    created = db.execute("SELECT created FROM post WHERE id = ?", (post_id,))
+    age = datetime.now(timezone.utc) - created.fetchone()[0]
+    assert abs(age.total_seconds()) < 5
+
+
+def test_rows_are_records(app):
+    row = get_db().execute("SELECT id, username AS name FROM user WHERE id = 1")
+    row = row.fetchone()
+    assert isinstance(row, Record)
+    assert row[0] == row["id"] == row.id == 1
+    assert row.name == "test"
+    assert tuple(row) == (1, "test")
+    assert row == {"id": 1, "name": "test"}
+    assert row != {"id": 1}
+    assert dict(row) == {"id": 1, "name": "test"}
+    assert "name" in row and "username" not in row
+    extended = row._extend(tags=["a"])
+    assert extended.tags == ["a"]
+    assert extended == {"id": 1, "name": "test", "tags": ["a"]}
+    with pytest.raises(KeyError):
+        row["username"]
@@ -0,0 +1,389 @@
+import hashlib
+import os
+import struct
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from io import BytesIO
+
+import pytest
+from flaskr.blog.blogdb import count_posts, create_post, get_post_image, update_post
+from flaskr.blog.images import (
+    BUFFERED_IMAGE_SIZE,
+    CHUNK_SIZE,
+    delete_unused_images,
+    detect_image_type,
+    get_image_store,
+    move_images,
+    sniff_image,
+)
+from flaskr.db import get_db, get_pool
+
+from common import read_post_image
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 20
+
+
+@pytest.mark.parametrize(
+    ("data", "mimetype"),
+    [
+        (PNG, "image/png"),
+        (b"\xff\xd8\xff\xe0rest", "image/jpeg"),
+        (b"GIF89a...", "image/gif"),
+        (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+        (b"RIFF\x00\x00\x00\x00WAVE", "application/octet-stream"),
+        (b"", "application/octet-stream"),
+    ],
+)
+def test_detect_image_type(data, mimetype):
+    assert detect_image_type(data) == mimetype
+
+
+def test_identical_images_are_stored_once(app):
+    first = create_post(1, "a", "a", [], PNG)
+    second = create_post(1, "b", "b", [], PNG)
+    image = get_post_image(first)
+    assert image[1:] == get_post_image(second)[1:]
+    assert image["image_size"] == len(PNG)
+    assert image["image_type"] == "image/png"
+    assert image["database_size"] is None
+    assert [image_hash for image_hash, _ in get_image_store().hashes()] == [
+        image["image_hash"]
+    ]
+
+
+def test_image_is_sent_from_the_store(app, client):
+    post_id = create_post(1, "a", "a", [], PNG)
+    response = client.get(f"/{post_id}/image.jpg")
+    assert response.data == PNG
+    assert response.mimetype == "image/png"
+    os.unlink(get_image_store().path(get_post_image(post_id)["image_hash"]))
+    assert client.get(f"/{post_id}/image.jpg").status_code == 404
+
+
+def test_move_images(app, client):
+    # Post 1 of the test data has its image in post.imagebytes
+    assert get_post_image(1)["image_hash"] is None
+    messages = []
+    assert move_images(batch_size=1, echo=messages.append) == 1
+    assert messages == ["Moved 1 images, up to post 1"]
+    image = get_post_image(1)
+    assert image["database_size"] is None
+    assert image["image_size"] == 6
+    assert client.get("/1/image.jpg").data == b"\xaa\xbb\xcc\xdd\xee\xff"
+    assert move_images() == 0
+
+
+def test_move_images_command(runner):
+    result = runner.invoke(args=["move-images"])
+    assert "Moved 1 images." in result.output
+
+
+def test_delete_unused_images(app):
+    post_id = create_post(1, "a", "a", [], PNG)
+    used = get_post_image(post_id)["image_hash"]
+    update_post(post_id, "a", "a", [], b"new", False)
+    # Too recent
+    assert delete_unused_images() == 0
+    assert delete_unused_images(grace_seconds=-1) == 1
+    assert not os.path.exists(get_image_store().path(used))
+    assert get_post_image(post_id)["image_size"] == 3
+    update_post(post_id, "a", "a", [], None, True)
+    with pytest.raises(KeyError):
+        get_post_image(post_id)
+    assert (
+        get_db()
+        .execute("SELECT has_image FROM posts_view WHERE id = ?", (post_id,))
+        .fetchone()[0]
+        == 0
+    )
+    assert delete_unused_images(grace_seconds=-1) == 1
+    assert list(get_image_store().hashes()) == []
+
+
+def test_delete_unused_images_deletes_old_temporary_files(app):
+    store = get_image_store()
+    image_hash = store.put(PNG)[0]
+    directory = os.path.dirname(store.path(image_hash))
+    old = [os.path.join(store.directory, ".tmpold"), os.path.join(directory, ".tmp1")]
+    recent = os.path.join(store.directory, ".tmprecent")
+    for path in old + [recent]:
+        open(path, "wb").close()
+    for path in old:
+        os.utime(path, (0, 0))
+    delete_unused_images(grace_seconds=60)
+    assert not any(os.path.exists(path) for path in old)
+    assert os.path.exists(recent)
+
+
+def test_stored_file_is_not_deleted_by_gc_meanwhile(app):
+    store = get_image_store()
+    image_hash = store.put(PNG)[0]
+    with ThreadPoolExecutor(1) as executor:
+        with store._locked():
+            future = executor.submit(store.put, PNG)
+            # Waits for gc-images, deleting the file
+            with pytest.raises(TimeoutError):
+                future.result(timeout=0.2)
+            os.unlink(store.path(image_hash))
+        assert future.result()[0] == image_hash
+    with open(store.path(image_hash), "rb") as fd:
+        assert fd.read() == PNG
+
+
+def test_image_caching_headers(app, client):
+    post_id = create_post(1, "a", "a", [], PNG)
+    image_hash = get_post_image(post_id)["image_hash"]
+    page = client.get(f"/{post_id}").data.decode()
+    url = f"/{post_id}/image.jpg?v={image_hash[:16]}"
+    assert f'<img src="{url}">' in page
+    response = client.get(url)
+    assert response.get_etag() == (image_hash, False)
+    assert response.last_modified is not None
+    assert response.cache_control.max_age == 365 * 24 * 3600
+    assert response.cache_control.immutable
+    assert response.cache_control.public
+    # Without the current version, cached but revalidated
+    for stale_url in [f"/{post_id}/image.jpg", f"/{post_id}/image.jpg?v=old"]:
+        response = client.get(stale_url)
+        assert response.cache_control.no_cache
+        assert not response.cache_control.immutable
+    response = client.get(url, headers={"If-None-Match": f'"{image_hash}"'})
+    assert response.status_code == 304
+    assert response.data == b""
+    response = client.get(url, headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+
+def test_image_head_does_not_open_the_file(app, client, monkeypatch):
+    post_id = create_post(1, "a", "a", [], PNG)
+    image_hash = get_post_image(post_id)["image_hash"]
+    monkeypatch.setattr("flaskr.blog.images.send_file", None)
+    response = client.head(f"/{post_id}/image.jpg")
+    assert response.status_code == 200
+    assert response.content_length == len(PNG)
+    assert response.mimetype == "image/png"
+    assert response.get_etag() == (image_hash, False)
+    response = client.head(
+        f"/{post_id}/image.jpg", headers={"If-None-Match": f'"{image_hash}"'}
+    )
+    assert response.status_code == 304
+
+
+def test_image_in_database_caching_headers(client):
+    response = client.get("/1/image.jpg")
+    # Not hashed on each request
+    etag = "post1-6"
+    assert response.get_etag() == (etag, False)
+    assert response.mimetype == "application/octet-stream"
+    assert response.cache_control.no_cache
+    response = client.get("/1/image.jpg", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 304
+
+
+def store_in_database(post_id, data):
+    get_db().execute(
+        "UPDATE post SET imagebytes = ?, image_hash = NULL WHERE id = ?",
+        (data, post_id),
+    )
+    get_db().commit()
+
+
+@pytest.mark.parametrize("in_database", [False, True])
+def test_image_range_requests(app, client, in_database):
+    data = bytes(range(256)) * 1000
+    post_id = create_post(1, "a", "a", [], data)
+    if in_database:
+        store_in_database(post_id, data)
+    url = f"/{post_id}/image.jpg"
+    response = client.get(url, headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 1000-1999/{len(data)}"
+    assert response.data == data[1000:2000]
+    etag = response.headers["ETag"]
+    if in_database:
+        assert etag == f'"post{post_id}-{len(data)}"'
+    else:
+        assert etag == '"' + hashlib.sha256(data).hexdigest() + '"'
+    response = client.get(url, headers={"Range": "bytes=-10", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.data == data[-10:]
+    # The image changed since the client got the start of it
+    response = client.get(url, headers={"Range": "bytes=-10", "If-Range": '"old"'})
+    assert response.status_code == 200
+    assert response.data == data
+    response = client.get(url, headers={"Range": f"bytes={len(data)}-"})
+    assert response.status_code == 416
+
+
+@pytest.mark.parametrize("size", [6, BUFFERED_IMAGE_SIZE + 1])
+def test_database_image_connections_are_released(app, client, size):
+    store_in_database(1, PNG + b"\x00" * (size - len(PNG)))
+    # More requests than connections in the pools. buffered closes the
+    # response as a server does once it is sent
+    for _ in range(app.config["DATABASE_POOL_SIZE"] * 2):
+        assert client.get("/1/image.jpg", buffered=True).status_code == 200
+        assert client.head("/1/image.jpg", buffered=True).status_code == 200
+        response = client.get("/1/image.jpg", headers={"Range": "bytes=1-2"})
+        assert response.status_code == 206
+        response.close()
+
+
+def test_database_image_is_streamed(app, client):
+    data = PNG + b"\x00" * (8 * 1024 * 1024)
+    store_in_database(1, data)
+    tracemalloc.start()
+    try:
+        response = client.get("/1/image.jpg", buffered=False)
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert size == len(data)
+    assert response.mimetype == "image/png"
+    assert peak < 1024 * 1024
+
+
+def test_database_image_streams_do_not_hold_request_connections(
+    app, client, monkeypatch
+):
+    store_in_database(1, PNG + b"\x00" * BUFFERED_IMAGE_SIZE)
+    responses = [
+        client.get("/1/image.jpg", buffered=False)
+        for _ in range(app.config["DATABASE_BLOB_POOL_SIZE"])
+    ]
+    # All the connections of the requests are still available
+    pool = get_pool(readonly=True)
+    monkeypatch.setattr(pool, "timeout", 0.1)
+    connections = [pool.acquire() for _ in range(app.config["DATABASE_POOL_SIZE"])]
+    for db in connections:
+        pool.release(db)
+    for response in responses:
+        response.close()
+
+
+def png_header(width, height):
+    return PNG[:8] + struct.pack(">I4sII", 13, b"IHDR", width, height) + b"\x08\x02"
+
+
+@pytest.mark.parametrize(
+    ("data", "sniffed"),
+    [
+        (png_header(640, 480), ("image/png", 640, 480)),
+        (b"GIF89a\x80\x02\xe0\x01", ("image/gif", 640, 480)),
+        (
+            # APP0, then the frame
+            b"\xff\xd8\xff\xe0\x00\x10" + b"\x00" * 14 + b"\xff\xc0\x00\x11\x08"
+            b"\x01\xe0\x02\x80",
+            ("image/jpeg", 640, 480),
+        ),
+        # The frame after the data
+        (b"\xff\xd8\xff\xe1\xff\xff" + b"\x00" * 100, ("image/jpeg", None, None)),
+        (
+            b"RIFF\x00\x00\x00\x00WEBPVP8 \x00\x00\x00\x00\x00\x00\x00\x9d\x01\x2a"
+            b"\x80\x02\xe0\x01",
+            ("image/webp", 640, 480),
+        ),
+        (
+            b"RIFF\x00\x00\x00\x00WEBPVP8L\x00\x00\x00\x00\x2f"
+            + struct.pack("<I", 639 | 479 << 14),
+            ("image/webp", 640, 480),
+        ),
+        (
+            b"RIFF\x00\x00\x00\x00WEBPVP8X\x00\x00\x00\x00\x00\x00\x00\x00"
+            b"\x7f\x02\x00\xdf\x01\x00",
+            ("image/webp", 640, 480),
+        ),
+        (b"text", ("application/octet-stream", None, None)),
+    ],
+)
+def test_sniff_image(data, sniffed):
+    assert sniff_image(data) == sniffed
+
+
+def post_image_form(client, url, data, **fields):
+    fields = {
+        "title": "a",
+        "body": "b",
+        "tags": "",
+        "g-recaptcha-response": "123",
+        "file": (BytesIO(data), "image.png"),
+        **fields,
+    }
+    return client.post(url, data=fields, content_type="multipart/form-data")
+
+
+@pytest.mark.parametrize(
+    ("data", "message"),
+    [
+        (b"A" * 100, "The file is not a PNG, JPEG, GIF or WebP image"),
+        (
+            png_header(10000, 10000),
+            "The image is too large, 10000x10000 pixels,"
+            " at most 80 megapixels are accepted",
+        ),
+    ],
+)
+@pytest.mark.parametrize("url", ["/create", "/1/update"])
+def test_invalid_uploads_are_rejected(
+    app, client, auth, monkeypatch, url, data, message
+):
+    monkeypatch.setattr("flaskr.blog.validate_recaptcha_response", lambda _: True)
+    auth.login()
+    posts = count_posts()
+    response = post_image_form(client, url, data)
+    assert response.status_code == 200
+    assert message in response.data.decode()
+    assert count_posts() == posts
+    assert read_post_image(1) == b"\xaa\xbb\xcc\xdd\xee\xff"
+    assert list(get_image_store().hashes()) == []
+
+
+def test_max_pixels_from_environment(app, client, auth, monkeypatch):
+    monkeypatch.setattr("flaskr.blog.validate_recaptcha_response", lambda _: True)
+    app.config["IMAGE_MAX_PIXELS"] = "100"
+    auth.login()
+    response = post_image_form(client, "/create", png_header(20, 10))
+    assert "at most 0.0001 megapixels are accepted" in response.data.decode()
+
+
+def test_upload_is_stored_only_after_the_checks(app, client, auth, monkeypatch):
+    monkeypatch.setattr("flaskr.blog.validate_recaptcha_response", lambda _: False)
+    auth.login()
+    data = PNG + b"\x00" * 3 * CHUNK_SIZE
+    response = post_image_form(client, "/create", data)
+    assert "Invalid captcha" in response.data.decode()
+    assert list(get_image_store().hashes()) == []
+    monkeypatch.setattr("flaskr.blog.validate_recaptcha_response", lambda _: True)
+    response = post_image_form(client, "/create", data)
+    assert response.status_code == 302
+    post_id = int(response.headers["Location"].rpartition("/")[2])
+    assert read_post_image(post_id) == data
+
+
+def test_put_file_copies_a_chunk_at_a_time(app):
+    store = get_image_store()
+    data = PNG + os.urandom(8 * 1024 * 1024)
+    with tempfile.TemporaryFile() as file:
+        file.write(data)
+        file.seek(0)
+        tracemalloc.start()
+        try:
+            stored = store.put_file(file)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # Already stored
+        file.seek(0)
+        assert store.put_file(file) == stored
+    assert peak < 1024 * 1024
+    image_hash = hashlib.sha256(data).hexdigest()
+    assert stored[:3] == (image_hash, len(data), "image/png")
+    with open(store.path(image_hash), "rb") as fd:
+        assert fd.read() == data
+    # No temporary file left
+    assert [name for name in os.listdir(store.directory) if name[0] != "."] == [
+        image_hash[:2]
+    ]
+    assert not [name for name in os.listdir(store.directory) if ".tmp" in name]
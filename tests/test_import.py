@@ -0,0 +1,104 @@
+import json
+
+import pytest
+from datetime import datetime, timezone
+from flaskr.blog.blogdb import get_post
+from flaskr.blog.importer import import_posts
+from flaskr.blog.render import get_render_version
+from flaskr.db import get_db
+
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+    return str(path)
+
+
+def test_import_jsonl(app, tmp_path):
+    (tmp_path / "cat.jpg").write_bytes(b"\xff\xd8image")
+    path = write_jsonl(
+        tmp_path / "posts.jsonl",
+        [
+            {
+                "author": "other",
+                "title": "imported",
+                "body": "body",
+                "tags": ["tag1", "new tag", "new tag"],
+                "created": "2010-02-03T04:05:06Z",
+                "image": "cat.jpg",
+            },
+            {"author": "test", "title": "second", "body": "body2"},
+        ],
+    )
+    assert import_posts(path, echo=lambda message: None) == 2
+    db = get_db()
+    post_id = db.execute("SELECT id FROM post WHERE title = 'imported'").fetchone()[0]
+    post = get_post(post_id, check_author=False)
+    assert post["username"] == "other"
+    assert post["created"] == datetime(2010, 2, 3, 4, 5, 6, tzinfo=timezone.utc)
+    assert post["has_image"]
+    assert sorted(post["tags"]) == ["new tag", "tag1"]
+    second = db.execute("SELECT id FROM post WHERE title = 'second'").fetchone()[0]
+    assert second == post_id + 1
+
+
+def test_import_csv(app, tmp_path):
+    path = tmp_path / "posts.csv"
+    path.write_text('author,title,body,tags\ntest,csv,"a, b",x\nother,csv2,c,"x, y"\n')
+    assert import_posts(str(path), echo=lambda message: None) == 2
+    rows = get_db().execute(
+        "SELECT title, body, name FROM post JOIN post_tag ON post.id = post_id"
+        " JOIN tag ON tag.id = tag_id WHERE title LIKE 'csv%' ORDER BY title, name"
+    )
+    assert [tuple(row) for row in rows] == [
+        ("csv", "a, b", "x"),
+        ("csv2", "c", "x"),
+        ("csv2", "c", "y"),
+    ]
+
+
+def test_import_resumes(app, tmp_path, monkeypatch):
+    records = [
+        {"author": "test", "title": f"post{ii}", "body": "", "tags": [f"t{ii}"]}
+        for ii in range(5)
+    ]
+    records[3]["author"] = "nobody"
+    path = write_jsonl(tmp_path / "posts.jsonl", records)
+    with pytest.raises(Exception, match="Record 4: unknown author 'nobody'"):
+        import_posts(path, batch_size=2, echo=lambda message: None)
+    records[3]["author"] = "other"
+    write_jsonl(tmp_path / "posts.jsonl", records)
+    messages = []
+    assert import_posts(path, batch_size=2, echo=messages.append) == 3
+    assert messages[0] == "Resuming after 2 records"
+    titles = get_db().execute("SELECT title FROM post WHERE title LIKE 'post%'")
+    assert sorted(row[0] for row in titles) == [f"post{ii}" for ii in range(5)]
+
+
+def test_imported_posts_are_rendered(app, tmp_path):
+    path = write_jsonl(
+        tmp_path / "posts.jsonl",
+        [{"author": "test", "title": "rendered", "body": "Some *emphasis*"}],
+    )
+    import_posts(path, echo=lambda message: None)
+    row = (
+        get_db()
+        .execute(
+            "SELECT body_html, summary_html, render_version FROM post"
+            " WHERE title = 'rendered'"
+        )
+        .fetchone()
+    )
+    assert "<em>emphasis</em>" in row["body_html"]
+    assert "<em>emphasis</em>" in row["summary_html"]
+    assert row["render_version"] == get_render_version()
+
+
+def test_import_posts_command(runner, tmp_path):
+    path = write_jsonl(
+        tmp_path / "posts.jsonl", [{"author": "test", "title": "t", "body": "b"}]
+    )
+    result = runner.invoke(args=["import-posts", path])
+    assert "Imported 1 posts" in result.output
+    result = runner.invoke(args=["import-posts", path])
+    assert "Resuming after 1 records" in result.output
+    assert "Imported 0 posts" in result.output
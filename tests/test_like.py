@@ -1,8 +1,11 @@
 import re
 import pytest
 from unittest.mock import MagicMock
+from flask import g
 from flaskr.blog.blogdb import get_post
 from flaskr.blog import build_how_many_people_like_string
+from flaskr.db import get_db
+from flaskr.tracing import start_trace
 
 
 def test_like_missing_post(client, auth):
@@ -86,3 +89,24 @@ def test_post_likes_mocking(monkeypatch, client):
 def test_like_count(client, post_id, expected):
     print(client.get(f"/{post_id}").data.decode())
     assert f"Liked by {expected}" in client.get(f"/{post_id}").data.decode()
+
+
+def test_like_twice(client, auth, app):
+    auth.login()
+    for status in ("1", "1", "0", "0"):
+        assert client.post("/1/like", data={"like": status}).status_code == 302
+    client.post("/1/like", data={"like": "1"})
+    with app.app_context():
+        assert get_post(1, check_author=False)["likes"] == 1
+
+
+def test_get_post_reads_stored_likes(app):
+    get_db().execute("UPDATE post SET likes = 42 WHERE id = 1")
+    start_trace()
+    assert get_post(1, check_author=False)["likes"] == 42
+    assert not any("FROM like" in statement.sql for statement in g.sql_trace)
+
+
+def test_listing_shows_likes(client):
+    assert "★ 1" in client.get("/?page=1").data.decode()
+    assert "★ 2" in client.get("/?page=2").data.decode()
@@ -0,0 +1,53 @@
+import pytest
+from flaskr.blog.blogdb import create_post
+from flaskr.blog.loader import load_post_details
+from flaskr.tracing import statements_counter
+
+
+def test_load_post_details(app):
+    details = load_post_details([1, 4, 6, 1000], user_id=2)
+    assert details == {
+        1: {"tags": [], "liked": False, "comments": 2},
+        4: {"tags": ["tag1", "tag2"], "liked": False, "comments": 0},
+        6: {"tags": [], "liked": True, "comments": 0},
+        1000: {"tags": [], "liked": False, "comments": 0},
+    }
+    assert load_post_details([6], user_id=None)[6]["liked"] is False
+    assert load_post_details([]) == {}
+
+
+def count_statements(client, url):
+    # Once first, so that opening the connections is not counted
+    client.get(url)
+    before = sum(statements_counter.totals.values())
+    assert client.get(url).status_code == 200
+    return sum(statements_counter.totals.values()) - before
+
+
+@pytest.mark.parametrize("url", ["/", "/?page=1", "/tags/tag1", "/?searchquery=test"])
+def test_query_count_does_not_depend_on_page_size(app, client, auth, monkeypatch, url):
+    for ii in range(10):
+        create_post(1, f"test{ii}", "body", ["tag1", f"other{ii}"], None)
+    auth.login()
+    counts = []
+    for size in (1, 10):
+        monkeypatch.setattr("flaskr.blog.blogdb.page_size", size)
+        monkeypatch.setattr("flaskr.blog.search.page_size", size)
+        monkeypatch.setattr("flaskr.blog.page_size", size)
+        counts.append(count_statements(client, url))
+    assert counts[0] == counts[1]
+
+
+def test_post_page_query_count(client, auth):
+    auth.login()
+    # User, post, tags, liked, comment count and comments
+    assert count_statements(client, "/4") == 6
+
+
+def test_listing_shows_details(client, auth):
+    auth.login("other")
+    page = client.get("/?page=2").data.decode()
+    assert 'class="like_count liked">★ 2' in page
+    page = client.get("/?page=1").data.decode()
+    assert "2 comments" in page
+    assert 'href="/tags/tag2"' in page
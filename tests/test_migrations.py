@@ -0,0 +1,155 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+from flaskr.db import get_db
+from flaskr.migrations import backfill, get_migrations, get_version, migrate
+
+# The schema before any migration, cut down to what the migrations touch
+legacy_schema = """
+CREATE TABLE user (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    registration_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE post (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    author_id INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    title TEXT NOT NULL,
+    body TEXT NOT NULL DEFAULT '',
+    imagebytes BLOB
+);
+CREATE TABLE comment (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE like (
+    post_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (post_id, user_id)
+);
+CREATE TABLE tag (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE post_tag (
+    post_id INTEGER NOT NULL,
+    tag_id INTEGER NOT NULL,
+    PRIMARY KEY (post_id, tag_id)
+);
+CREATE INDEX post__created ON post (created);
+CREATE VIEW posts_view AS
+    SELECT post.id AS id, title, created, username
+    FROM post JOIN user author ON post.author_id == author.id;
+INSERT INTO user (username, registration_time)
+VALUES ('a', '2021-01-01 00:00:00');
+INSERT INTO post (author_id, title, created)
+VALUES (1, 'naive', '2018-01-01 00:00:00'),
+    (1, 'aware', '2019-03-04 05:06:07.000123+00:00');
+INSERT INTO like (post_id, user_id) VALUES (2, 1), (2, 2);
+INSERT INTO tag (name) VALUES ('t');
+-- The second one belongs to a deleted post
+INSERT INTO post_tag (post_id, tag_id) VALUES (1, 1), (3, 1);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    db = sqlite3.connect(
+        tmp_path / "legacy.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
+    )
+    db.row_factory = sqlite3.Row
+    db.executescript(legacy_schema)
+    yield db
+    db.close()
+
+
+def test_migrations_are_numbered_in_sequence():
+    versions = [migration.version for migration in get_migrations()]
+    assert versions == list(range(1, len(versions) + 1))
+
+
+def test_schema_is_at_latest_version(app):
+    with app.app_context():
+        assert get_version(get_db()) == get_migrations()[-1].version
+
+
+def test_migrate_legacy_database(legacy_db):
+    messages = []
+    assert migrate(legacy_db, echo=messages.append) == get_migrations()[-1].version
+    assert messages[0] == "Applying 1 integer_timestamps"
+    assert [
+        tuple(row) for row in legacy_db.execute("SELECT title, created FROM posts_view")
+    ] == [
+        ("naive", datetime(2018, 1, 1, tzinfo=timezone.utc)),
+        ("aware", datetime(2019, 3, 4, 5, 6, 7, 123, tzinfo=timezone.utc)),
+    ]
+    registration_time = legacy_db.execute("SELECT typeof(registration_time) FROM user")
+    assert registration_time.fetchone()[0] == "integer"
+    indexes = {row[1] for row in legacy_db.execute("PRAGMA index_list(post)")}
+    assert {"post__created", "post__author_id__created"} <= indexes
+    counts = legacy_db.execute(
+        "SELECT posts FROM post_stats UNION ALL" " SELECT posts FROM tag_stats"
+    )
+    assert [row[0] for row in counts] == [2, 1]
+    likes = legacy_db.execute("SELECT likes FROM posts_view ORDER BY id")
+    assert [row[0] for row in likes] == [0, 2]
+    # Nothing left to do
+    messages.clear()
+    migrate(legacy_db, echo=messages.append)
+    assert messages == []
+
+
+def test_failed_migration_is_rolled_back(legacy_db, monkeypatch):
+    migration = get_migrations()[1]
+
+    def upgrade(db):
+        db.execute("CREATE INDEX half_done ON post (title)")
+        raise RuntimeError
+
+    monkeypatch.setattr(migration.module, "upgrade", upgrade)
+    with pytest.raises(RuntimeError):
+        migrate(legacy_db, echo=lambda message: None)
+    assert get_version(legacy_db) == 1
+    indexes = {row[1] for row in legacy_db.execute("PRAGMA index_list(post)")}
+    assert "half_done" not in indexes
+
+
+def test_backfill_resumes(legacy_db, monkeypatch):
+    legacy_db.execute("CREATE TABLE numbers (value INTEGER, square INTEGER)")
+    legacy_db.executemany("INSERT INTO numbers (value) VALUES (?)", zip(range(10)))
+    legacy_db.commit()
+    calls = []
+
+    def interrupt_after_two_chunks(seconds):
+        calls.append(seconds)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr("flaskr.migrations.time.sleep", interrupt_after_two_chunks)
+    arguments = (legacy_db, "squares", "numbers", "square = value * value")
+    with pytest.raises(KeyboardInterrupt):
+        backfill(*arguments, "square IS NULL", chunk_size=3)
+    done = legacy_db.execute("SELECT COUNT(*) FROM numbers WHERE square IS NOT NULL")
+    assert done.fetchone()[0] == 6
+    # A fresh run skips the completed chunks instead of scanning them again
+    assert backfill(*arguments, "1", chunk_size=3) == 4
+    squares = legacy_db.execute("SELECT value, square FROM numbers")
+    assert all(square == value * value for value, square in squares)
+    progress = legacy_db.execute("SELECT COUNT(*) FROM migration_progress")
+    assert progress.fetchone()[0] == 0
+
+
+def test_migrate_command(runner, monkeypatch):
+    result = runner.invoke(args=["migrate"])
+    assert "up to date" in result.output
+
+    monkeypatch.setattr("flaskr.db.get_db", lambda: None)
+    latest = get_migrations()[-1]
+    monkeypatch.setattr("flaskr.migrations.get_pending_migrations", lambda db: [latest])
+    result = runner.invoke(args=["migrate", "--dry-run"])
+    assert f"Pending: {latest.version} {latest.name}" in result.output
+    assert "Applying" not in result.output
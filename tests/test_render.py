@@ -0,0 +1,124 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from flaskr.blog.blogdb import create_post, update_post
+from flaskr.blog.render import (
+    Renderer,
+    create_renderer,
+    get_render_version,
+    summarize_html,
+)
+from flaskr.db import get_db
+
+
+def stored_html(post_id):
+    return tuple(
+        get_db()
+        .execute(
+            "SELECT body_html, summary_html, render_version FROM post WHERE id = ?",
+            (post_id,),
+        )
+        .fetchone()
+    )
+
+
+def test_html_is_stored_when_writing(app):
+    app.config["SUMMARY_LENGTH"] = 5
+    post_id = create_post(1, "title", "some *markdown*", [], None)
+    assert stored_html(post_id) == (
+        "<p>some <em>markdown</em></p>",
+        "<p>some [...]</p>",
+        get_render_version(),
+    )
+    update_post(post_id, "title", "new", [], None, False)
+    assert stored_html(post_id)[:2] == ("<p>new</p>", "<p>new</p>")
+
+
+def test_stored_html_is_served(app, client):
+    post_id = create_post(1, "title", "body", [], None)
+    get_db().execute(
+        "UPDATE post SET body_html = '<p>stored body</p>',"
+        " summary_html = '<p>stored summary</p>' WHERE id = ?",
+        (post_id,),
+    )
+    get_db().commit()
+    assert "stored body" in client.get(f"/{post_id}").data.decode()
+    assert "stored summary" in client.get("/").data.decode()
+
+
+def test_stale_html_is_rendered_again(app, client):
+    assert stored_html(3)[2] is None
+    assert "test3 word" in client.get("/3").data.decode()
+    assert stored_html(3) == ("<p>test3 word</p>",) * 2 + (get_render_version(),)
+    # A settings change makes all stored HTML stale
+    app.config["SUMMARY_LENGTH"] = 5
+    assert "test3[...]" in client.get("/?page=1").data.decode()
+    assert stored_html(3) == (
+        "<p>test3 word</p>",
+        "<p>test3[...]</p>",
+        get_render_version(),
+    )
+
+
+def test_renderer_cache():
+    renderer = Renderer(cache_size=2)
+    assert renderer.render("*a*") == "<p><em>a</em></p>"
+    assert renderer.render("*a*") == "<p><em>a</em></p>"
+    renderer.render("b")
+    renderer.render("c")
+    assert renderer.stats() == {"size": 2, "hits": 1, "misses": 3, "evictions": 1}
+    # The least recently used one was evicted
+    renderer.render("c")
+    renderer.render("*a*")
+    assert renderer.stats()["misses"] == 4
+
+
+def test_renderer_cache_size_from_environment(app):
+    renderer = create_renderer(dict(app.config, RENDER_CACHE_SIZE="1"))
+    renderer.render("a")
+    renderer.render("b")
+    assert renderer.stats()["size"] == 1
+
+
+def test_renderer_sanitizes_and_linkifies():
+    html = Renderer().render('a <script> http://a.com <b onclick="x">b</b>')
+    assert html == (
+        '<p>a &lt;script&gt; <a href="http://a.com" rel="nofollow">'
+        "http://a.com</a> <b>b</b></p>"
+    )
+
+
+def test_renderer_in_threads():
+    renderer = Renderer(cache_size=0)
+    texts = [f"*{ii}*\n\n- item {ii}" for ii in range(200)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(renderer.render, texts))
+    assert results == [Renderer().render(text) for text in texts]
+
+
+def test_renderer_settings_change_render_version(app):
+    version = get_render_version()
+    app.extensions["flaskr_renderer"] = Renderer(tags=["p", "em"])
+    assert get_render_version() != version
+
+
+@pytest.mark.parametrize(
+    ("html", "summary"),
+    [
+        ("<p>short</p>", "<p>short</p>"),
+        # After a word, not through one
+        ("<p>one two three</p>", "<p>one two[...]</p>"),
+        ("<p>onetwothree</p>", "<p>onetwothr[...]</p>"),
+        # Elements left open are closed
+        ("<p>a <em>b c d e f</em> g</p>", "<p>a <em>b c d e[...]</em></p>"),
+        (
+            "<ul><li>item a</li><li>item b</li></ul>",
+            "<ul><li>item a</li><li>ite[...]</li></ul>",
+        ),
+        # Whole blocks when they hold enough of the text
+        ("<p>one two</p><p>three four</p>", "<p>one two</p><p>[...]</p>"),
+        ("<p>a &amp; b</p><p>c</p>", "<p>a &amp; b</p><p>c</p>"),
+    ],
+)
+def test_summarize_html(html, summary):
+    assert summarize_html(html, 9) == summary
@@ -0,0 +1,33 @@
+from datetime import datetime, timezone
+
+from flaskr.blog.render import get_render_version
+from flaskr.blog.rerender import rerender_posts
+from flaskr.db import get_db
+
+
+def render_versions():
+    return dict(get_db().execute("SELECT id, render_version FROM post").fetchall())
+
+
+def test_rerender_posts(app):
+    app.config["SUMMARY_LENGTH"] = 5
+    messages = []
+    assert rerender_posts(chunk_size=3, workers=2, echo=messages.append) == 7
+    assert set(render_versions().values()) == {get_render_version()}
+    assert messages[0].startswith("Rendered 3 posts, up to id 3")
+    html = get_db().execute("SELECT body_html, summary_html FROM post WHERE id = 3")
+    assert tuple(html.fetchone()) == ("<p>test3 word</p>", "<p>test3[...]</p>")
+    # Nothing left to do, so a second run resumes with nothing
+    assert rerender_posts(workers=1, echo=messages.append) == 0
+
+
+def test_rerender_posts_since(app):
+    since = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    assert rerender_posts(since=since, workers=1, echo=lambda message: None) == 3
+    versions = render_versions()
+    assert [id for id, version in versions.items() if version] == [1, 2, 3]
+
+
+def test_rerender_posts_command(runner, app):
+    result = runner.invoke(args=["rerender-posts", "--since", "2019-01-01"])
+    assert "Rendered 1 posts in" in result.output
@@ -0,0 +1,81 @@
+import pytest
+from flaskr.blog.blogdb import create_post, delete_post, update_post
+from flaskr.blog.search import build_match_query, highlight_snippet, search_posts
+from flaskr.db import get_db
+
+
+@pytest.mark.parametrize(
+    ("searchquery", "expected"),
+    [
+        ("word", '"word"'),
+        ("two words", '"two" "words"'),
+        ("pre*", '"pre"*'),
+        ('"a phrase" word', '"a phrase" "word"'),
+        ('"unclosed phrase', '"unclosed phrase"'),
+        ("NOT OR AND", '"NOT" "OR" "AND"'),
+        ('wo"rd * "', '"word"'),
+        ("", ""),
+    ],
+)
+def test_build_match_query(searchquery, expected):
+    assert build_match_query(searchquery) == expected
+
+
+def titles(searchquery):
+    return [post["title"] for post in search_posts(searchquery)[1]]
+
+
+def test_search_ranks_title_matches_first(app):
+    create_post(1, "zebra", "nothing", [], None)
+    create_post(1, "other", "a zebra in the body", [], None)
+    assert titles("zebra") == ["zebra", "other"]
+
+
+def test_search_phrase_and_prefix(app):
+    create_post(1, "phrases", "quick brown fox", [], None)
+    create_post(1, "reversed", "brown quick fox", [], None)
+    assert titles('"quick brown"') == ["phrases"]
+    assert sorted(titles("quick brown")) == ["phrases", "reversed"]
+    assert sorted(titles("qui*")) == ["phrases", "reversed"]
+    assert titles("qui") == []
+
+
+def test_search_index_follows_posts(app):
+    post_id = create_post(1, "findme", "body", [], None)
+    assert titles("findme") == ["findme"]
+    update_post(post_id, "renamed", "body", [], None, False)
+    assert titles("findme") == []
+    assert titles("renamed") == ["renamed"]
+    delete_post(post_id)
+    assert titles("renamed") == []
+
+
+def test_search_count_and_pages(app):
+    for ii in range(7):
+        create_post(1, f"paged{ii}", "many", [], None)
+    count, posts = search_posts("many", page=2)
+    assert count == 7
+    assert len(posts) == 2
+
+
+def test_snippets_are_escaped_and_highlighted(app):
+    create_post(1, "t", "<script>alert()</script> needle", [], None)
+    (post,) = search_posts("needle")[1]
+    assert highlight_snippet(post["snippet"]) == (
+        "&lt;script&gt;alert()&lt;/script&gt; <mark>needle</mark>"
+    )
+
+
+def test_index_search(client):
+    data = client.get("/?searchquery=word").data.decode()
+    assert "Showing posts 1-3 out of 3" in data
+    assert "<mark>word</mark>" in data
+
+
+def test_rebuild_search_index_command(runner, app):
+    get_db().execute("INSERT INTO post_fts (post_fts) VALUES ('delete-all')")
+    get_db().commit()
+    assert titles("word") == []
+    result = runner.invoke(args=["rebuild-search-index"])
+    assert "Rebuilt" in result.output
+    assert len(titles("word")) == 3
@@ -0,0 +1,55 @@
+from flaskr.blog.blogdb import create_post, get_possibly_new_tag_id
+from flaskr.blog.tag_dictionary import get_tag_dictionary
+from flaskr.tracing import statements_counter
+
+
+def test_lookup(app):
+    tags = get_tag_dictionary()
+    assert tags.get_id("tag1") == 1
+    assert tags.get_id("nope") is None
+    assert tags.get_ids(["tag2", "nope"]) == {"tag2": 2}
+
+
+def test_suggest(app):
+    for name in ["tango", "taxi", "ta", "other"]:
+        get_possibly_new_tag_id(name)
+    tags = get_tag_dictionary()
+    assert tags.suggest("ta") == ["ta", "tag1", "tag2", "tango", "taxi"]
+    assert tags.suggest("tag") == ["tag1", "tag2"]
+    assert tags.suggest("ta", limit=2) == ["ta", "tag1"]
+    assert tags.suggest("x") == []
+
+
+def test_reloaded_only_when_tags_change(app):
+    tags = get_tag_dictionary()
+    tags.get_id("tag1")
+    reloads = tags.reloads
+    # Another connection writing something else
+    create_post(1, "title", "body", ["tag1"], None)
+    assert tags.get_id("tag1") == 1
+    assert tags.reloads == reloads
+    create_post(1, "title", "body", ["new"], None)
+    assert tags.get_id("new") is not None
+    assert tags.reloads == reloads + 1
+
+
+def test_new_tags_are_seen_from_other_connections(app):
+    tags = get_tag_dictionary()
+    assert tags.get_id("new") is None
+    other = get_possibly_new_tag_id("new")
+    assert tags.get_id("new") == other
+    assert get_possibly_new_tag_id("new") == other
+
+
+def test_suggest_endpoint(client):
+    assert client.get("/tags/suggest?prefix=tag").json == ["tag1", "tag2"]
+    assert client.get("/tags/suggest?prefix=tag2").json == ["tag2"]
+    assert client.get("/tags/suggest?prefix=").json == []
+    assert client.get("/tags/suggest").json == []
+
+
+def test_suggest_endpoint_does_not_query(client):
+    client.get("/tags/suggest?prefix=tag")
+    before = sum(statements_counter.totals.values())
+    client.get("/tags/suggest?prefix=tag")
+    assert sum(statements_counter.totals.values()) == before
@@ -4,6 +4,8 @@ import pytest
 from datetime import datetime
 from unittest.mock import MagicMock
 from flaskr.blog.blogdb import (
+    create_post,
+    delete_post,
     remove_post_tag,
     update_post,
     get_post_tags,
@@ -20,13 +22,14 @@ from common import generate_no_file_selected, generate_file_tuple, generate_post
 alltags = {"tag1", "tag2"}
 
 
-def test_display_tags_mocking_get_post_tags(client, monkeypatch):
+def test_display_tags_mocking_load_tags(client, monkeypatch):
     post_id = 1
     tags = ["tagA", "tag2", "tagQ"]
-    mock_get_post_tags = MagicMock(return_value=tags)
-    monkeypatch.setattr("flaskr.blog.blogdb.get_post_tags", mock_get_post_tags)
+    mock_load_tags = MagicMock(return_value={post_id: tags})
+    monkeypatch.setattr("flaskr.blog.loader.load_tags", mock_load_tags)
     response = client.get(f"/{post_id}").data.decode()
-    mock_get_post_tags.assert_called_once_with(post_id)
+    mock_load_tags.assert_called_once()
+    assert mock_load_tags.call_args.args[1] == [post_id]
     print(response)
     for tag in tags:
         assert f'href="/tags/{tag}"' in response
@@ -224,3 +227,25 @@ def test_empty_tags_forbidden(app):
 def test_get_possibly_new_tag_id_rejects_empty_tag(app):
     with pytest.raises(AssertionError):
         get_possibly_new_tag_id("")
+
+
+def tag_names():
+    return {row[0] for row in get_db().execute("SELECT name FROM tag")}
+
+
+def test_unused_tags_are_deleted(app):
+    update_post(2, "title", "body", ["tag2"], None, False)
+    # Still on post 4
+    assert tag_names() == alltags
+    update_post(4, "title", "body", ["tag2", "new"], None, False)
+    assert tag_names() == {"tag2", "new"}
+    delete_post(4)
+    assert tag_names() == {"tag2"}
+    assert get_db().execute("SELECT tag_id FROM tag_stats").fetchall() == [(2,)]
+
+
+def test_set_tags_ignores_empty_and_repeated_names(app):
+    post_id = create_post(1, "title", "body", ["a", "", "a", "b"], None)
+    assert sorted(get_post_tags(post_id)) == ["a", "b"]
+    update_post(post_id, "title", "body", ["b", "", "c"], None, False)
+    assert sorted(get_post_tags(post_id)) == ["b", "c"]
@@ -0,0 +1,82 @@
+import logging
+
+import pytest
+from flask import g
+from flaskr import tracing
+from flaskr.blog.blogdb import get_last_action_time_for_user, get_posts
+from flaskr.db import get_db
+from flaskr.tracing import start_trace
+
+
+def test_statements_are_traced(app):
+    start_trace()
+    count, posts = get_posts(page=1)
+    (statement,) = [
+        statement for statement in g.sql_trace if "posts_view" in statement.sql
+    ]
+    assert statement.caller == "flaskr.blog.blogdb.get_posts"
+    assert statement.rows == len(posts)
+    assert statement.seconds > 0
+    assert statement.plan
+
+
+def test_full_scans_are_flagged(app):
+    start_trace()
+    get_db().execute("SELECT id FROM post WHERE body LIKE '%test%'").fetchall()
+    assert g.sql_trace[-1].full_scans == ["post"]
+    get_last_action_time_for_user(1, "post")
+    assert g.sql_trace[-1].full_scans == []
+
+
+@pytest.mark.parametrize(
+    ("value", "enabled"),
+    [(False, False), ("0", False), ("false", False), ("", False), ("1", True)],
+)
+def test_tracing_can_be_disabled(app, value, enabled):
+    # Strings come from FLASKR_SQL_TRACE
+    app.config["SQL_TRACE"] = value
+    start_trace()
+    assert ("sql_trace" in g) == enabled
+
+
+def test_plan_cache_is_bounded(app, monkeypatch):
+    monkeypatch.setattr(tracing, "PLAN_CACHE_SIZE", 3)
+    monkeypatch.setattr(tracing, "_plans", {})
+    start_trace()
+    for value in range(5):
+        get_db().execute(f"SELECT {value}").fetchall()
+    assert list(tracing._plans) == ["SELECT 2", "SELECT 3", "SELECT 4"]
+
+
+def test_slow_queries_are_logged(app, client, caplog):
+    app.config["SLOW_QUERY_SECONDS"] = 0
+    with caplog.at_level(logging.WARNING):
+        client.get("/?searchquery=test")
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(
+        message.startswith("Slow query in blog.index") and "post_fts" in message
+        for message in messages
+    )
+
+
+def read_metrics(client):
+    metrics = client.get("/metrics").data.decode()
+    return {
+        key: float(value)
+        for key, value in (
+            line.rsplit(" ", 1) for line in metrics.splitlines() if line[0] != "#"
+        )
+    }
+
+
+def test_metrics_report_sql_per_endpoint(app, client):
+    app.config["METRICS_ALLOWED_IPS"] = "127.0.0.1"
+    requests = 'flaskr_sql_requests_total{endpoint="blog.index"}'
+    statements = 'flaskr_sql_statements_total{endpoint="blog.index"}'
+    before = read_metrics(client)
+    client.get("/")
+    client.get("/")
+    after = read_metrics(client)
+    assert after[requests] - before.get(requests, 0) == 2
+    assert after[statements] - before.get(statements, 0) >= 2
+    assert after['flaskr_sql_seconds_total{endpoint="blog.index"}'] > 0
@@ -0,0 +1,154 @@
+import io
+import os
+
+import pytest
+from flaskr.blog import variants
+from flaskr.blog.blogdb import create_post, get_post_image
+from flaskr.blog.images import delete_unused_images, get_image_store, measure_images
+from flaskr.blog.variants import get_variant_generator, image_dimensions
+from flaskr.db import get_db
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_image(size, format="PNG", **params):
+    output = io.BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(output, format, **params)
+    return output.getvalue()
+
+
+def dimensions(data):
+    return image_dimensions(io.BytesIO(data))
+
+
+def open_image(data):
+    return Image.open(io.BytesIO(data))
+
+
+def create_post_with_variants(data):
+    post_id = create_post(1, "a", "a", [], data)
+    image = get_post_image(post_id)
+    get_variant_generator().submit(image["image_hash"]).result()
+    return post_id, image
+
+
+def test_image_dimensions():
+    assert dimensions(make_image((30, 20))) == (30, 20)
+    exif = Image.Exif()
+    # Shown turned a quarter
+    exif[0x0112] = 6
+    assert dimensions(make_image((30, 20), "JPEG", exif=exif)) == (20, 30)
+    assert dimensions(b"not an image") == (None, None)
+    frames = [Image.new("RGB", (30, 20), color) for color in ("red", "blue")]
+    output = io.BytesIO()
+    frames[0].save(output, "GIF", save_all=True, append_images=frames[1:])
+    # No variants of animations
+    assert dimensions(output.getvalue()) == (None, None)
+
+
+def test_make_variants():
+    made = variants.make_variants(
+        io.BytesIO(make_image((1000, 500), "JPEG")), [320, 640, 1280]
+    )
+    assert sorted(made) == [320, 640]
+    for width, data in made.items():
+        with open_image(data) as image:
+            assert image.format == "WEBP"
+            assert image.size == (width, width // 2)
+
+
+def test_variants_are_made_on_upload(app):
+    post_id, image = create_post_with_variants(make_image((700, 350)))
+    assert image["image_width"] == 700
+    store = get_image_store()
+    assert os.path.exists(store.variant_path(image["image_hash"], 320))
+    assert os.path.exists(store.variant_path(image["image_hash"], 640))
+    assert not os.path.exists(store.variant_path(image["image_hash"], 1280))
+    # Variants are not listed as images of their own
+    assert [image_hash for image_hash, _ in store.hashes()] == [image["image_hash"]]
+
+
+def test_variant_is_sent(app, client):
+    post_id, image = create_post_with_variants(make_image((700, 350)))
+    version = image["image_hash"][:16]
+    response = client.get(f"/{post_id}/image.jpg?v={version}&w=320")
+    assert response.mimetype == "image/webp"
+    assert response.get_etag() == (image["image_hash"] + ".w320", False)
+    assert response.cache_control.immutable
+    with open_image(response.data) as variant:
+        assert variant.size == (320, 160)
+    response = client.head(f"/{post_id}/image.jpg?v={version}&w=320")
+    assert response.content_length == len(
+        open(get_image_store().variant_path(image["image_hash"], 320), "rb").read()
+    )
+    # Not a width of the variants: the image itself
+    response = client.get(f"/{post_id}/image.jpg?v={version}&w=100")
+    assert response.mimetype == "image/png"
+
+
+def test_missing_variant_is_made_on_request(app, client):
+    post_id, image = create_post_with_variants(make_image((700, 350)))
+    path = get_image_store().variant_path(image["image_hash"], 320)
+    os.unlink(path)
+    url = f"/{post_id}/image.jpg?v={image['image_hash'][:16]}&w=320"
+    response = client.get(url)
+    # The image meanwhile, not cached for the variant URL
+    assert response.mimetype == "image/png"
+    assert response.cache_control.no_cache
+    get_variant_generator().submit(image["image_hash"]).result()
+    assert os.path.exists(path)
+    assert client.get(url).mimetype == "image/webp"
+
+
+def test_listing_has_srcset(app, client):
+    post_id, image = create_post_with_variants(make_image((700, 350)))
+    url = f"/{post_id}/image.jpg?v={image['image_hash'][:16]}"
+    html = client.get("/").data.decode()
+    assert f'srcset="{url}&amp;w=320 320w, {url}&amp;w=640 640w, {url} 700w"' in html
+    # Too small for variants
+    create_post(1, "b", "b", [], make_image((100, 50)))
+    assert client.get("/").data.decode().count("srcset=") == 1
+
+
+def test_variant_settings_from_environment(app):
+    config = dict(
+        app.config,
+        IMAGE_VARIANT_WIDTHS="640, 320",
+        IMAGE_VARIANT_QUALITY="70",
+        IMAGE_VARIANT_WORKERS="1",
+    )
+    generator = variants.create_variant_generator(config, get_image_store())
+    assert generator.widths == [320, 640]
+    assert (generator.quality, generator.workers) == (70, 1)
+    assert generator.widths_for(700) == [320, 640]
+
+
+def test_no_variants_without_pillow(app, client, monkeypatch):
+    monkeypatch.setattr(variants, "Image", None)
+    app.extensions["flaskr_image_variants"] = variants.create_variant_generator(
+        app.config, get_image_store()
+    )
+    post_id = create_post(1, "a", "a", [], make_image((700, 350)))
+    assert get_post_image(post_id)["image_width"] is None
+    assert "srcset=" not in client.get("/").data.decode()
+    assert client.get(f"/{post_id}/image.jpg?w=320").mimetype == "image/png"
+
+
+def test_measure_images(app):
+    post_id = create_post(1, "a", "a", [], make_image((700, 350)))
+    create_post(1, "b", "b", [], b"not an image")
+    get_db().execute("UPDATE post SET image_width = NULL, image_height = NULL")
+    get_db().commit()
+    messages = []
+    assert measure_images(echo=messages.append) == 1
+    assert messages == [f"Measured 1 images, up to post {post_id + 1}"]
+    assert get_post_image(post_id)["image_width"] == 700
+
+
+def test_variants_are_deleted_with_the_image(app):
+    post_id, image = create_post_with_variants(make_image((700, 350)))
+    get_db().execute("UPDATE post SET image_hash = NULL WHERE id = ?", (post_id,))
+    get_db().commit()
+    assert delete_unused_images(grace_seconds=-1) == 1
+    directory = os.path.dirname(get_image_store().path(image["image_hash"]))
+    assert os.listdir(directory) == []